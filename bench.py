@@ -0,0 +1,422 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lock
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+startup_commands = [["--lock-owners"], ["--lock-history"]]
+
+# Import time of main.py and everything it loads for a read only command,
+# interpreter startup not included.
+startup_budget_ms = 150
+
+# Modules a read only command must never load
+startup_forbidden = ["gsheet", "gspread", "oauth2client", "smtplib", "ssl", "subprocess",
+                     "lock_watch", "concurrent.futures", "tempfile"]
+
+# A case regresses when its best run is this much slower than in the
+# baseline. Most cases fsync, the median is too noisy to compare.
+micro_tolerance = 0.5
+micro_baseline_file = "bench_baseline.json"
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    index = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _print_latencies(title, samples):
+    print(f"{title!s}")
+    print(f"  samples : {len(samples)!s}")
+    print(f"  p50     : {_percentile(samples, 50) * 1000:.3f} ms")
+    print(f"  p90     : {_percentile(samples, 90) * 1000:.3f} ms")
+    print(f"  p99     : {_percentile(samples, 99) * 1000:.3f} ms")
+    print(f"  max     : {max(samples, default=0) * 1000:.3f} ms")
+
+
+"""
+******************************
+******* Contention ***********
+******************************
+"""
+
+
+def _contend(lock_dir, index, barrier, results):
+    lock.lock_file_path = lock_dir
+    email = f"user{index!s}@pavilion.io"
+
+    barrier.wait()
+    start = time.perf_counter()
+    success, error = lock.Lock().lock("exclusive", f"user{index!s}", email)
+    results.put((index, success, error, time.perf_counter() - start))
+
+
+def run_contention(callers):
+    lock_dir = tempfile.mkdtemp(prefix="chm_bench_")
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(callers)
+    results = ctx.Queue()
+
+    try:
+        procs = [ctx.Process(target=_contend, args=(lock_dir, i, barrier, results)) for i in range(callers)]
+
+        for proc in procs:
+            proc.start()
+
+        outcomes = [results.get() for _ in procs]
+
+        for proc in procs:
+            proc.join()
+
+        lock.lock_file_path = lock_dir
+        final = lock.Lock()
+    finally:
+        shutil.rmtree(lock_dir, ignore_errors=True)
+
+    winners = [outcome for outcome in outcomes if outcome[1]]
+    return {
+        "latencies": [outcome[3] for outcome in outcomes],
+        "winners": len(winners),
+        "owners": len(final.owners()),
+        "type": final.lock_name()
+    }
+
+
+"""
+******************************
+******* Startup **************
+******************************
+"""
+
+
+def _parse_importtime(output):
+    modules = set()
+    total_us = 0
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        top_level = not name.startswith("  ")
+
+        # Everything up to site is interpreter startup, the command starts after it
+        if top_level and name.strip() == "site":
+            modules = set()
+            total_us = 0
+            continue
+
+        modules.add(name.strip())
+
+        if top_level:
+            total_us += int(cumulative_us)
+
+    return modules, total_us
+
+
+def run_startup(command, runs=5):
+    # Run main.py from a scratch copy so the benchmark never touches the
+    # real lock, and with a configured chassis so no DNS lookups are timed.
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="chm_bench_")
+    import_ms = []
+    wall_ms = []
+    modules = set()
+
+    try:
+        for path in glob.glob(os.path.join(src_dir, "*.py")):
+            shutil.copy(path, work_dir)
+
+        with open(os.path.join(work_dir, "chm_config.conf"), "w") as config_file:
+            config_file.write("[Chassis]\nname = bench\nip = 127.0.0.1\n")
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-X", "importtime", os.path.join(work_dir, "main.py"),
+                                   "--no-daemon"] + command,
+                                  cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            wall_ms.append((time.perf_counter() - start) * 1000)
+
+            modules, total_us = _parse_importtime(proc.stderr)
+            import_ms.append(total_us / 1000)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "import_ms": statistics.median(import_ms),
+        "wall_ms": statistics.median(wall_ms),
+        "modules": modules
+    }
+
+
+"""
+******************************
+******* Micro Benchmarks *****
+******************************
+"""
+
+
+def _time_case(func, runs, setup=None):
+    samples = []
+
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter_ns()
+        func()
+        samples.append((time.perf_counter_ns() - start) / 1000)
+
+    return {
+        "runs": runs,
+        "median_us": statistics.median(samples),
+        "p90_us": _percentile(samples, 90),
+        "min_us": min(samples)
+    }
+
+
+def _fill_history(lck):
+    with lck.transaction():
+        for index in range(lock.max_history):
+            lck.add_history(f"user{index!s}@pavilion.io", "Queried")
+
+
+def _micro_cases(work_dir):
+    import chassis_manager
+    import fake_gsheet
+    import gsheet
+    import sheet_sync
+
+    # Every module keeps its files next to itself, point them all at the
+    # scratch directory.
+    lock.lock_file_path = work_dir
+    chassis_manager.config_file_path = work_dir
+    sheet_sync.spool_file_path = work_dir
+    gsheet.row_cache_file_path = work_dir
+
+    with open(chassis_manager._get_config_file_path(), "w") as config_file:
+        config_file.write("[Chassis]\nname = bench\nip = 127.0.0.1\n")
+
+    worksheet = fake_gsheet.FakeWorksheet()
+    sheets = {}
+
+    def sheet_factory(name, ip):
+        if (name, ip) not in sheets:
+            sheets[(name, ip)] = gsheet.GSheet(name, ip, worksheet)
+
+        return sheets[(name, ip)]
+
+    # A shared lock with a few owners and a full history, like a busy chassis
+    lck = lock.Lock()
+    for index in range(8):
+        lck.lock("shared", f"user{index!s}", f"user{index!s}@pavilion.io")
+
+    _fill_history(lck)
+
+    def lock_unlock():
+        lck.lock("shared", "bench", "bench@pavilion.io")
+        lck.unlock("bench@pavilion.io")
+
+    def chm_init_update():
+        # A command that opens the sheet and pushes the chassis state
+        chm = chassis_manager.ChassisManager()
+        sheet = gsheet.GSheet(chm._chassis_name, chm._chassis_ip, worksheet)
+        sheet.update_info(chm._lock.lock_name(), chm._lock.owners(), chm._lock.waiters())
+
+    def chm_lock_unlock():
+        chm = chassis_manager.ChassisManager()
+        chm.set_sheet_flusher(lambda: sheet_sync.run_flusher(sheet_factory))
+        chm.lock("shared", "bench@pavilion.io", "bench", False)
+        chm.unlock("bench@pavilion.io")
+
+    return [
+        ("load_lock", lck.load_lock, None),
+        ("save_lock", lck.save_lock, None),
+        ("lock_unlock", lock_unlock, None),
+        ("history_append_at_capacity", lambda: lck.add_history("bench@pavilion.io", "Queried"), None),
+        ("history_read_at_capacity", lck.history, None),
+        ("chassis_manager_init_update", chm_init_update, None),
+        ("chassis_manager_lock_unlock", chm_lock_unlock, None)
+    ]
+
+
+def run_micro(runs=200, cases=None):
+    import chassis_manager
+    import gsheet
+    import sheet_sync
+
+    work_dir = tempfile.mkdtemp(prefix="chm_bench_")
+    old_paths = (lock.lock_file_path, chassis_manager.config_file_path, sheet_sync.spool_file_path,
+                 gsheet.row_cache_file_path)
+    results = {}
+
+    try:
+        for name, func, setup in _micro_cases(work_dir):
+            if cases and name not in cases:
+                continue
+
+            results[name] = _time_case(func, runs, setup)
+    finally:
+        (lock.lock_file_path, chassis_manager.config_file_path, sheet_sync.spool_file_path,
+         gsheet.row_cache_file_path) = old_paths
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance=None):
+    tolerance = micro_tolerance if tolerance is None else tolerance
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        allowed = baseline[name]["min_us"] * (1 + tolerance)
+
+        if result["min_us"] > allowed:
+            regressions.append((name, baseline[name]["min_us"], result["min_us"]))
+
+    return regressions
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager benchmarks")
+    sub = parser.add_subparsers(dest="BENCH", required=True)
+
+    contention = sub.add_parser("contention", help="N processes racing for one exclusive lock")
+    contention.add_argument('-n', '--callers', dest="CALLERS", type=int, default=32,
+                            help="Number of concurrent lock callers")
+    contention.add_argument('-r', '--rounds', dest="ROUNDS", type=int, default=5,
+                            help="Number of rounds to run")
+
+    startup = sub.add_parser("startup", help="Import time of the read only commands")
+    startup.add_argument('-r', '--runs', dest="RUNS", type=int, default=5,
+                         help="Number of runs per command")
+
+    micro = sub.add_parser("micro", help="Latency of the lock and chassis manager hot paths")
+    micro.add_argument('-r', '--runs', dest="RUNS", type=int, default=200,
+                       help="Number of runs per case")
+    micro.add_argument('--case', dest="CASES", action='append', required=False,
+                       help="Only run this case, can be given more than once")
+    micro.add_argument('--json', action='store_true', dest="JSON", required=False,
+                       help="Print the results as JSON")
+    micro.add_argument('--baseline', dest="BASELINE", required=False, nargs='?', const=micro_baseline_file,
+                       help=f"Fail when a case is slower than in this baseline [{micro_baseline_file!s}]")
+    micro.add_argument('--tolerance', dest="TOLERANCE", type=float, default=micro_tolerance,
+                       help=f"Allowed slow down over the baseline, 1.0 is twice as slow [{micro_tolerance!s}]")
+    micro.add_argument('--save-baseline', dest="SAVE_BASELINE", required=False, nargs='?',
+                       const=micro_baseline_file, help="Store the results as the new baseline")
+
+    return parser.parse_args()
+
+
+def micro_main(args):
+    results = run_micro(args.RUNS, args.CASES)
+
+    if args.JSON:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for name, result in results.items():
+            print(f"{name!s:<30} median {result['median_us']:10.1f} us   "
+                  f"p90 {result['p90_us']:10.1f} us   min {result['min_us']:10.1f} us")
+
+    if args.SAVE_BASELINE:
+        with open(args.SAVE_BASELINE, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+
+    if not args.BASELINE:
+        return True
+
+    with open(args.BASELINE) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.TOLERANCE)
+
+    for name, before, after in regressions:
+        print(f"Regression in {name!s}: {before:.1f} us -> {after:.1f} us", file=sys.stderr)
+
+    return not regressions
+
+
+def startup_main(args):
+    ok = True
+
+    for command in startup_commands:
+        result = run_startup(command, args.RUNS)
+        loaded = sorted(set(startup_forbidden) & result["modules"])
+
+        print(f"main.py {' '.join(command)!s}")
+        print(f"  imports : {result['import_ms']:.1f} ms (budget {startup_budget_ms!s} ms)")
+        print(f"  wall    : {result['wall_ms']:.1f} ms")
+
+        if loaded:
+            print(f"  loaded  : {', '.join(loaded)!s}")
+
+        if loaded or result["import_ms"] > startup_budget_ms:
+            ok = False
+
+    print("Startup is within budget" if ok else "Startup budget EXCEEDED")
+    return ok
+
+
+def contention_main(args):
+    latencies = []
+    ok = True
+
+    for _ in range(args.ROUNDS):
+        result = run_contention(args.CALLERS)
+        latencies.extend(result["latencies"])
+
+        if result["winners"] != 1 or result["owners"] != 1 or result["type"] != "EXCLUSIVE":
+            print(f"Invariant violated: {result['winners']!s} winners, "
+                  f"{result['owners']!s} owners, lock {result['type']!s}")
+            ok = False
+
+    _print_latencies(f"Exclusive acquire latency, {args.CALLERS!s} callers x {args.ROUNDS!s} rounds", latencies)
+    print("Exactly one exclusive owner won every round" if ok else "Exclusive lock invariant FAILED")
+    return ok
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.BENCH == "contention":
+        exit(0 if contention_main(args) else 1)
+
+    if args.BENCH == "startup":
+        exit(0 if startup_main(args) else 1)
+
+    if args.BENCH == "micro":
+        exit(0 if micro_main(args) else 1)
+
+    exit(1)
@@ -0,0 +1,38 @@
+import unittest
+import bench
+import gsheet
+import lock
+from unittest import mock
+
+
+class MicroBenchTest(unittest.TestCase):
+    def test_all_cases_run(self):
+        old_path = lock.lock_file_path
+        update_info = gsheet.GSheet.update_info
+
+        with mock.patch.object(gsheet.GSheet, "update_info", autospec=True, side_effect=update_info) as pushed:
+            results = bench.run_micro(runs=3, cases=["chassis_manager_init_update"])
+
+        # Every run pushes to the in memory sheet, plus the warm up
+        self.assertGreaterEqual(pushed.call_count, 3)
+
+        results = bench.run_micro(runs=3)
+
+        self.assertEqual(lock.lock_file_path, old_path)
+        self.assertIn("lock_unlock", results)
+        self.assertIn("chassis_manager_lock_unlock", results)
+
+        for name, result in results.items():
+            self.assertEqual(result["runs"], 3)
+            self.assertLessEqual(result["min_us"], result["median_us"])
+
+    def test_compare(self):
+        baseline = {"fast": {"min_us": 100.0}, "slow": {"min_us": 100.0}}
+        results = {"fast": {"min_us": 150.0}, "slow": {"min_us": 250.0}, "new": {"min_us": 1.0}}
+
+        self.assertEqual(bench.compare(results, baseline, 1.0), [("slow", 100.0, 250.0)])
+        self.assertEqual(bench.compare(results, baseline, 0.2), [("fast", 100.0, 150.0), ("slow", 100.0, 250.0)])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
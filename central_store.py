@@ -0,0 +1,148 @@
+import fcntl
+import json
+import os
+import re
+import sqlite3
+
+import lock
+import timing
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+# Guards, change bells and histories live next to the database
+state_dir_suffix = ".chassis"
+busy_timeout = 10
+
+chassis_name_pattern = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS locks ("
+    "chassis TEXT PRIMARY KEY, ip TEXT NOT NULL DEFAULT '', data TEXT, version INTEGER NOT NULL DEFAULT 0)",
+]
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _check_chassis(chassis):
+    # The name is part of the guard and history paths
+    if chassis is None or not chassis_name_pattern.match(chassis):
+        raise lock.InvalidLock(f"Invalid chassis name '{chassis!s}'")
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+
+    # WAL keeps the readers of one chassis off the writers of another. The
+    # lock state is the source of truth, every commit is synced.
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = FULL")
+
+    for statement in schema:
+        conn.execute(statement)
+
+    return conn
+
+
+def list_chassis(path):
+    conn = _connect(path)
+
+    try:
+        rows = conn.execute("SELECT chassis, ip, data FROM locks ORDER BY chassis").fetchall()
+    finally:
+        conn.close()
+
+    return [(chassis, ip, json.loads(data) if data else None) for chassis, ip, data in rows]
+
+
+"""
+******************************
+******* Central Store ********
+******************************
+"""
+
+
+class SQLiteLockStore:
+    # The lock of one chassis on a manager host that tracks many of them, a
+    # row in a shared database keyed by the chassis name. Writers of one
+    # chassis serialize on its own guard file, so a busy chassis never holds
+    # up the others, and every query is a primary key lookup of one row.
+    def __init__(self, path, chassis):
+        _check_chassis(chassis)
+
+        self._chassis = chassis
+        self._state_dir = path + state_dir_suffix
+        os.makedirs(self._state_dir, exist_ok=True)
+        self._conn = _connect(path)
+
+    def _state_path(self, suffix):
+        return os.path.join(self._state_dir, self._chassis + suffix)
+
+    def close(self):
+        self._conn.close()
+
+    def acquire(self):
+        guard_fd = os.open(self._state_path(".guard"), os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            with timing.span("lock.guard"):
+                fcntl.flock(guard_fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(guard_fd)
+            raise
+
+        return guard_fd
+
+    def release(self, guard):
+        try:
+            fcntl.flock(guard, fcntl.LOCK_UN)
+        finally:
+            os.close(guard)
+
+    def stamp(self):
+        row = self._conn.execute("SELECT version FROM locks WHERE chassis = ?", (self._chassis,)).fetchone()
+        return None if row is None or row[0] == 0 else row[0]
+
+    def load(self):
+        with timing.span("lock.load"):
+            row = self._conn.execute("SELECT data, version FROM locks WHERE chassis = ?",
+                                     (self._chassis,)).fetchone()
+
+        if row is None or row[0] is None:
+            return None, None
+
+        return json.loads(row[0]), row[1]
+
+    def write(self, data):
+        # Only ever called under the guard, nobody else bumps the version
+        # between the two statements.
+        with timing.span("lock.write"):
+            self._conn.execute("INSERT INTO locks (chassis, data, version) VALUES (?, ?, 1) "
+                               "ON CONFLICT (chassis) DO UPDATE SET data = excluded.data, version = version + 1",
+                               (self._chassis, json.dumps(data)))
+            version = self.stamp()
+
+        # Waiters watch the bell of their chassis, closing it after a write
+        # wakes them the same way the rename of a lock file does.
+        os.close(os.open(self.watch_path(), os.O_WRONLY | os.O_CREAT, 0o666))
+        return version
+
+    def history_dir(self):
+        return self._state_path(".history")
+
+    def watch_path(self):
+        return self._state_path(".bell")
+
+    def ip(self):
+        row = self._conn.execute("SELECT ip FROM locks WHERE chassis = ?", (self._chassis,)).fetchone()
+        return row[0] if row is not None and row[0] else None
+
+    def set_ip(self, ip):
+        self._conn.execute("INSERT INTO locks (chassis, ip) VALUES (?, ?) "
+                           "ON CONFLICT (chassis) DO UPDATE SET ip = excluded.ip", (self._chassis, ip))
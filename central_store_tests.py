@@ -0,0 +1,184 @@
+import unittest
+import central_store
+import chassis_manager
+import chm_daemon
+import contextlib
+import io
+import lock
+import main
+import os
+import sheet_sync
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+
+class CentralStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._database = os.path.join(self._dir, "locks.db")
+        self._old_spool_path = sheet_sync.spool_file_path
+        sheet_sync.spool_file_path = self._dir
+
+    def tearDown(self) -> None:
+        sheet_sync.spool_file_path = self._old_spool_path
+        shutil.rmtree(self._dir)
+
+    def _lock(self, chassis):
+        return lock.Lock(store=central_store.SQLiteLockStore(self._database, chassis))
+
+    def _daemon(self):
+        # Not serving, only for calling its command and timer paths directly
+        daemon = chm_daemon.ChassisDaemon()
+        daemon._stdout = chm_daemon._ThreadOutput(sys.stdout)
+        daemon._stderr = chm_daemon._ThreadOutput(sys.stderr)
+        daemon._flush_sheet = lambda: None
+        return daemon
+
+    def test_chassis_are_independent(self):
+        gullu = self._lock("gullu")
+        pillu = self._lock("pillu")
+
+        self.assertEqual(gullu.lock("exclusive", "a", "a@pavilion.io"), (True, None))
+        self.assertEqual(pillu.lock("exclusive", "b", "b@pavilion.io"), (True, None))
+
+        self.assertEqual([a_owner["Email"] for a_owner in self._lock("gullu").owners()], ["a@pavilion.io"])
+        self.assertEqual([a_owner["Email"] for a_owner in self._lock("pillu").owners()], ["b@pavilion.io"])
+        self.assertEqual(self._lock("tillu").type(), lock.LockType.FREE)
+
+        self.assertEqual(gullu.unlock("a@pavilion.io"), (True, None))
+        self.assertEqual(self._lock("pillu").type(), lock.LockType.EXCLUSIVE)
+        self.assertEqual([a_record["Action"] for a_record in self._lock("gullu").history()],
+                         ["Exclusive lock", "Unlock"])
+        self.assertEqual([a_record["Action"] for a_record in self._lock("pillu").history()], ["Exclusive lock"])
+
+    def test_write_to_another_chassis_does_not_reload(self):
+        gullu = self._lock("gullu")
+        gullu.lock("shared", "a", "a@pavilion.io")
+
+        with mock.patch.object(gullu, "load_lock") as load:
+            self._lock("pillu").lock("shared", "b", "b@pavilion.io")
+            gullu.refresh()
+            load.assert_not_called()
+
+            self._lock("gullu").lock("shared", "c", "c@pavilion.io")
+            gullu.refresh()
+            load.assert_called_once()
+
+    def test_busy_chassis_does_not_block_others(self):
+        gullu = self._lock("gullu")
+        done = threading.Event()
+
+        def other():
+            self._lock("pillu").lock("exclusive", "b", "b@pavilion.io")
+            done.set()
+
+        with gullu.transaction():
+            thread = threading.Thread(target=other)
+            thread.start()
+            self.assertTrue(done.wait(5))
+
+        thread.join()
+
+    def test_invalid_chassis_name(self):
+        for name in [None, "", "../etc", ".hidden", "a/b"]:
+            with self.assertRaises(lock.InvalidLock):
+                central_store.SQLiteLockStore(self._database, name)
+
+    def test_manager_host(self):
+        old_path = chassis_manager.config_file_path
+        chassis_manager.config_file_path = self._dir
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write(f"[Central]\ndatabase = {self._database!s}\n")
+
+        try:
+            chm = chassis_manager.ChassisManager("gullu", "10.10.10.10")
+            chm.set_sheet_flusher(lambda: None)
+            chm._central.set_ip("10.10.10.10")
+            self.assertEqual(chm.lock("exclusive", "a@pavilion.io", "a", False), (True, None))
+
+            # A waiter on the manager host is woken by the bell of its chassis
+            results = {}
+            waiter = chassis_manager.ChassisManager("gullu")
+            waiter.set_sheet_flusher(lambda: None)
+            self.assertEqual(waiter._chassis_ip, "10.10.10.10")
+
+            thread = threading.Thread(target=lambda: results.setdefault(
+                "waiter", waiter.lock_wait("exclusive", "b@pavilion.io", "b", 10)))
+            thread.start()
+
+            while not chm._lock.is_waiting("b@pavilion.io"):
+                chm.refresh()
+
+            start = time.monotonic()
+            self.assertEqual(chm.unlock("a@pavilion.io")[:2], (True, None))
+            thread.join()
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(results["waiter"], (True, None))
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(chassis_manager.print_chassis_list(), (True, None))
+
+            self.assertEqual(output.getvalue(), "gullu [10.10.10.10] EXCLUSIVE owners: b@pavilion.io waiters: \n")
+        finally:
+            chassis_manager.config_file_path = old_path
+
+    def test_commands_need_a_chassis(self):
+        old_path = chassis_manager.config_file_path
+        chassis_manager.config_file_path = self._dir
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write(f"[Central]\ndatabase = {self._database!s}\n")
+
+        try:
+            for argv in [["--lock-owners"], ["--lock", "--wait", "--lock-type", "exclusive", "--name", "a",
+                                             "--email", "a@pavilion.io"]]:
+                output = io.StringIO()
+
+                with contextlib.redirect_stdout(output):
+                    self.assertEqual(main.run(main.parse_user_args(argv)), 1)
+
+                self.assertEqual(output.getvalue(), "Please specify --chassis\n")
+
+                daemon = self._daemon()
+
+                with contextlib.redirect_stdout(daemon._stdout):
+                    code, output = daemon._run(argv)
+
+                self.assertEqual((code, output), (1, "Please specify --chassis\n"))
+
+            self.assertFalse(main.missing_chassis(main.parse_user_args(["--list-chassis"])))
+        finally:
+            chassis_manager.config_file_path = old_path
+
+    def test_daemon_reaps_every_chassis(self):
+        old_path = chassis_manager.config_file_path
+        chassis_manager.config_file_path = self._dir
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write(f"[Central]\ndatabase = {self._database!s}\n")
+
+        try:
+            for name in ["gullu", "pillu"]:
+                chm = chassis_manager.ChassisManager(name, "10.10.10.10")
+                chm.set_sheet_flusher(lambda: None)
+                self.assertEqual(chm.lock("exclusive", "a@pavilion.io", "a", False, ttl=0.05), (True, None))
+
+            time.sleep(0.1)
+
+            # A fresh daemon has not served any of them yet
+            self._daemon()._reap()
+
+            self.assertEqual([(name, data["Type"]) for name, ip, data in central_store.list_chassis(self._database)],
+                             [("gullu", "FREE"), ("pillu", "FREE")])
+        finally:
+            chassis_manager.config_file_path = old_path
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -1,14 +1,21 @@
 import configparser
-import socket
 import lock
+import metrics
 import os
-import subprocess
-import gsheet
+import history
+import notifier
 import pathlib
+import sheet_sync
+import time
+import timing
 
 config_file_path = str(pathlib.Path(__file__).parent.absolute())
 config_file_name = "/chm_config.conf"
 
+# A chassis with a broken resolv.conf can block in the resolver for seconds
+resolve_timeout = 1.0
+fallback_ip = "127.0.0.1"
+
 
 def _build_email_body(chassis_name, chassis_ip):
     if chassis_name is None or chassis_name == '':
@@ -28,19 +35,77 @@ def _build_email_body(chassis_name, chassis_ip):
     return msg
 
 
+def _build_grant_email_body(chassis_name, chassis_ip, lock_name):
+    if chassis_name is None or chassis_name == '':
+        chassis_name = 'Chassis'
+
+    msg = f"""Subject: Chassis '{chassis_name!s}' is yours now.
+    
+    Hi, 
+    
+    The chassis '{chassis_name!s}' [{chassis_ip!s}], that you were waiting for, was released 
+    and you now hold a {lock_name.lower()!s} lock on it. Please unlock it once you are done. 
+    
+    Your friendly, 
+    Chassis Manager
+    """
+
+    return msg
+
+
 def _get_config_file_path():
     return config_file_path + config_file_name
 
 
 def _get_default_name():
+    import socket
     return socket.gethostname()
 
 
+def _get_interface_ip():
+    import socket
+
+    # Connecting a UDP socket sends nothing, it only picks the interface
+    # that routes outside, no resolver involved.
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        probe.connect(("10.255.255.255", 1))
+        return probe.getsockname()[0]
+    except OSError:
+        return fallback_ip
+    finally:
+        probe.close()
+
+
 def _get_default_ip():
-    return socket.gethostbyname(socket.gethostname())
+    import socket
+    import threading
+
+    resolved = []
+
+    def resolve():
+        try:
+            resolved.append(socket.gethostbyname(socket.gethostname()))
+        except OSError:
+            pass
+
+    # gethostbyname can not be interrupted, a daemon thread is left behind
+    # when it hangs and the process exits without waiting for it.
+    resolver = threading.Thread(target=resolve, daemon=True)
+    resolver.start()
+    resolver.join(resolve_timeout)
+
+    if resolved:
+        return resolved[0]
+
+    return _get_interface_ip()
 
 
 def _is_git_directory(path):
+    # Only the git commands need it, keep it off the startup path
+    import subprocess
+
     try:
         return subprocess.call(['git', '-C', path, 'status'], stderr=subprocess.STDOUT, stdout=open(os.devnull, 'w')) == 0
     except Exception:
@@ -48,6 +113,8 @@ def _is_git_directory(path):
 
 
 def _git_init(path):
+    import subprocess
+
     try:
         success = subprocess.call(['git', '-C', path, 'init'], stderr=subprocess.STDOUT, stdout=open(os.devnull, 'w')) == 0
         if not success:
@@ -74,6 +141,8 @@ def _git_init(path):
 
 
 def _is_git_installed():
+    import subprocess
+
     try:
         return subprocess.call(['git', '--version'], stderr=subprocess.STDOUT, stdout=open(os.devnull, 'w')) == 0
     except Exception:
@@ -81,6 +150,8 @@ def _is_git_installed():
 
 
 def _git_install_command():
+    import subprocess
+
     try:
         return subprocess.call(['yum', 'install', 'git', '-y'], stderr=subprocess.STDOUT, stdout=open(os.devnull, 'w')) == 0
     except Exception:
@@ -124,80 +195,304 @@ def init_git_repo(path):
     return _git_init(path), None
 
 
+def _central_database(config):
+    # [Central] database = /srv/chm/locks.db, one manager host for many chassis
+    if 'Central' not in config or not config['Central'].get('database'):
+        return None
+
+    return config['Central'].get('database')
+
+
+def central_database():
+    config = configparser.ConfigParser()
+    config.read(_get_config_file_path())
+    return _central_database(config)
+
+
+def _history_log(config, store):
+    segment_bytes = None
+    keep_bytes = None
+    keep_days = None
+
+    if 'History' in config:
+        segment_bytes = config['History'].getint('segment_bytes', fallback=None)
+        keep_bytes = config['History'].getint('retention_bytes', fallback=None)
+        keep_days = config['History'].getfloat('retention_days', fallback=None)
+
+    return history.HistoryLog(store.history_dir(), segment_bytes, keep_bytes, keep_days)
+
+
 class ChassisManager:
     def __init__(self, name=None, ip=None):
-        self._lock = lock.Lock()
-        self._config = configparser.ConfigParser()
-        self._config.read(_get_config_file_path())
+        with timing.span("config"):
+            self._config = configparser.ConfigParser()
+            self._config.read(_get_config_file_path())
+
+        timing.configure(self._config)
+
+        self._chassis_name = name or None
+        self._chassis_ip = ip or None
+        self._central = None
+        database = _central_database(self._config)
+
+        if database is not None:
+            # Every chassis is named on the command line, the identity of the
+            # manager host has nothing to do with them.
+            import central_store
+
+            self._central = central_store.SQLiteLockStore(database, self._chassis_name)
+            self._chassis_ip = self._chassis_ip or self._central.ip() or ''
+            metrics_labels = {"chassis": self._chassis_name}
+        else:
+            self._resolve_identity()
+            metrics_labels = None
+
+        store = self._central or lock.FileLockStore()
+        self._lock = lock.Lock(history_log=_history_log(self._config, store),
+                               metrics=metrics.from_config(self._config, metrics_labels), store=store)
+        self._notifier = notifier.from_config(self._config)
+
+        # The sheet is only needed when the lock state changes, connecting to
+        # it costs an OAuth exchange and a row lookup over the network.
+        self._status_backend = None
+        self._sheet_flusher = sheet_sync.start_flusher
+
+    def _resolve_identity(self):
+        # The identity saved by ch_init wins over anything looked up, the
+        # host is only asked when the chassis was never initialized.
+        if 'Chassis' in self._config:
+            self._chassis_name = self._chassis_name or self._config['Chassis'].get('name') or None
+            self._chassis_ip = self._chassis_ip or self._config['Chassis'].get('ip') or None
 
-        self._chassis_name = _get_default_name()
-        self._chassis_ip = _get_default_ip()
+        if self._chassis_name is None:
+            with timing.span("identity.name"):
+                self._chassis_name = _get_default_name()
 
-        if 'Chassis' in self._config:
-            if 'ip' in self._config['Chassis']:
-                self._chassis_ip = self._config['Chassis']['ip']
+        if self._chassis_ip is None:
+            with timing.span("identity.ip"):
+                self._chassis_ip = _get_default_ip()
 
-            if 'name' in self._config['Chassis']:
-                self._chassis_name = self._config['Chassis']['name']
+    def set_sheet_flusher(self, flusher):
+        self._sheet_flusher = flusher
 
-        if name is not None and name != '':
-            self._chassis_name = name
+    def refresh(self):
+        self._lock.refresh()
 
-        if ip is not None and ip != '':
-            self._chassis_ip = ip
+    def _get_status_backend(self):
+        if self._status_backend is None:
+            # gspread and the oauth client take longer to import than the
+            # whole command, load them only when the sheet is needed.
+            import status_backend
 
+            with timing.span("status.open"):
+                self._status_backend = status_backend.open_backend(self._chassis_name, self._chassis_ip,
+                                                                   self._config)
 
-        self._gsheet = gsheet.GSheet(self._chassis_name, self._chassis_ip)
-        self._update_gsheet()
+        return self._status_backend
 
     def _update_gsheet(self):
-        return self._gsheet.update_info(self._lock.lock_name(), self._lock.owners(), self._lock.waiters())
+        # The lock file is already committed, the sheet is only a consolidated
+        # view. Spool the new state and let a background flusher push it.
+        with timing.span("sheet.enqueue"):
+            sheet_sync.enqueue(self._chassis_name, self._chassis_ip,
+                               self._lock.lock_name(), self._lock.owners(), self._lock.waiters())
+
+        with timing.span("sheet.flusher"):
+            self._sheet_flusher()
+
+        return True, None
 
-    def lock(self, lock_name, email, name, wait):
-        success, error = self._lock.lock(lock_name, name, email)
+    def _notify_waiters(self):
+        notified = self._lock.notify_granted(
+            _build_grant_email_body(self._chassis_name, self._chassis_ip, self._lock.lock_name()), self._notifier)
+
+        if self._lock.type() == lock.LockType.FREE and len(self._lock.waiters()):
+            notified += self._lock.notify_waiters(_build_email_body(self._chassis_name, self._chassis_ip),
+                                                  self._notifier)
+
+        return notified
+
+    def reap(self):
+        # Release the owners whose lease ran out, hand the lock on and turn
+        # open reservations into locks. Every state changing command does
+        # this first and the daemon does it on a timer. The read only
+        # commands never write, they show an expired lease as it is.
+        expired = self._lock.reap_expired()
+
+        if expired or self._lock.granted():
+            self._notify_waiters()
+            self._update_gsheet()
+
+        return expired
+
+    def lock(self, lock_name, email, name, wait, ttl=None, resource=None, queue=False, priority=0):
+        self.reap()
+        success, error = self._lock.lock(lock_name, name, email, ttl=ttl, resource=resource)
 
         if success:
             return self._update_gsheet()
 
-        if error in [lock.ErrNotAvailable, lock.ErrOnlySharedAllowed] and wait:
-            self._lock.add_to_waiting_queue(email, True)
+        # --queue stays in the queue without blocking and is handed the lock
+        # on release, --notify only asks for an email once the chassis is free.
+        if error in [lock.ErrNotAvailable, lock.ErrOnlySharedAllowed] and (wait or queue) and resource is None:
+            if queue:
+                self._lock.add_to_waiting_queue(email, True, lock_name, name=name, priority=priority, ttl=ttl,
+                                                queue=True)
+                error = lock.ErrQueued
+            else:
+                self._lock.add_to_waiting_queue(email, True)
 
-            success, error = self._update_gsheet()
-            if not success:
-                return False, error
+            synced, sync_error = self._update_gsheet()
+            if not synced:
+                return False, sync_error
 
         return False, error
 
-    def print_lock_history(self):
-        self._lock.print_history()
+    def lock_wait(self, lock_name, email, name, timeout=None, cancel=None, priority=0, ttl=None):
+        self.reap()
+        success, error = self._lock.lock(lock_name, name, email, ttl=ttl)
+
+        if success:
+            return self._update_gsheet()
+
+        if error not in [lock.ErrNotAvailable, lock.ErrOnlySharedAllowed]:
+            return False, error
+
+        import lock_watch
+
+        # Watch before queueing so a release in between is not missed
+        watcher = lock_watch.watch(self._lock.watch_path())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        granted = False
+
+        try:
+            self._lock.add_to_waiting_queue(email, True, lock_name, wait=True, name=name, priority=priority, ttl=ttl)
+            self._update_gsheet()
+
+            while True:
+                # The lock is usually handed over by the releasing owner, or
+                # by us when the owner's lease runs out.
+                self._lock.refresh()
+                self.reap()
+
+                if self._lock.is_lock_owner(email):
+                    granted = True
+                    return True, None
+
+                success, error = self._lock.lock(lock_name, name, email, quiet=True, ttl=ttl)
+
+                if success:
+                    granted = True
+                    return self._update_gsheet()
+
+                if error == lock.ErrAlreadyOwner:
+                    # Handed over between the check above and this call, we
+                    # were not an owner when we started waiting.
+                    granted = True
+                    return True, None
+
+                if error not in [lock.ErrNotAvailable, lock.ErrOnlySharedAllowed]:
+                    return False, error
+
+                if cancel is not None and cancel.is_set():
+                    return False, lock.ErrCancelled
 
-    def print_lock_owners(self):
-        self._lock.print_owners()
+                remaining = None if deadline is None else deadline - time.monotonic()
 
-    def unlock(self, email):
-        success, error = self._lock.unlock(email)
+                if remaining is not None and remaining <= 0:
+                    return False, lock.ErrTimeout
+
+                # Nothing touches the lock file when a lease runs out, wake up
+                # for the next expiry as well.
+                expiry = self._lock.next_expiry()
+
+                if expiry is not None:
+                    remaining = expiry if remaining is None else min(remaining, expiry)
+
+                watcher.wait(remaining, cancel)
+        finally:
+            watcher.close()
+
+            if not granted:
+                self._lock.remove_waiter(email)
+                self._update_gsheet()
+
+    def print_lock_history(self, email=None, action=None, since=None, until=None, limit=None, tail=None,
+                           resource=None):
+        self._lock.print_history(email, action, since, until, limit, tail, resource)
+
+    def print_lock_owners(self, resource=None):
+        self._lock.print_owners(resource)
+
+    def renew(self, email, ttl=None, resource=None):
+        self.reap()
+        return self._lock.renew(email, ttl, resource)
+
+    def unlock(self, email, resource=None):
+        self.reap()
+        success, error = self._lock.unlock(email, resource)
         if not success:
             return success, error, 0
 
-        if self._lock.type() == lock.LockType.FREE and len(self._lock.waiters()):
-            notified = self._lock.notify_waiters(_build_email_body(self._chassis_name, self._chassis_ip))
-            success, error = self._update_gsheet()
-            return success, error, notified
+        notified = self._notify_waiters()
 
         success, error = self._update_gsheet()
-        return success, error, 0
+        return success, error, notified
+
+    def reserve(self, lock_name, email, name, start, end):
+        self.reap()
+        return self._lock.reserve(lock_name, name, email, start, end)
+
+    def cancel_reservation(self, email, reservation_id):
+        self.reap()
+        return self._lock.cancel_reservation(email, reservation_id)
+
+    def print_reservations(self):
+        self._lock.print_reservations()
+
+    def next_free(self, lock_name, duration, after=None):
+        return self._lock.next_free(lock_name, duration, after)
+
+    def handed_over(self):
+        return [a_waiter['Email'] for a_waiter in self._lock.granted()]
 
     def ch_init(self, name, ip):
         self._chassis_name = name
         self._chassis_ip = ip
 
-        self._config['Chassis'] = {
-            'name': name,
-            'ip': ip
-        }
+        if self._central is not None:
+            # The manager host keeps its own config, the chassis is
+            # registered in the central store.
+            self._central.set_ip(ip)
+        else:
+            self._config['Chassis'] = {
+                'name': name,
+                'ip': ip
+            }
+
+            with open(_get_config_file_path(), "w") as config_file:
+                self._config.write(config_file)
+
+        self._status_backend = None
+        return self._get_status_backend().update_info(self._lock.lock_name(), self._lock.owners(), self._lock.waiters())
+
+
+def print_chassis_list():
+    database = central_database()
+
+    if database is None:
+        return False, "No central lock store configured"
+
+    import central_store
+    chassis = central_store.list_chassis(database)
+
+    if not chassis:
+        print("No chassis")
 
-        with open(_get_config_file_path(), "w") as config_file:
-            self._config.write(config_file)
+    for name, ip, data in chassis:
+        data = data or {"Type": "FREE", "Owners": [], "Waiters": []}
+        print(f"{name!s} [{ip!s}] {data['Type']!s} "
+              f"owners: {', '.join(a_owner['Email'] for a_owner in data['Owners'])!s} "
+              f"waiters: {', '.join(a_waiter['Email'] for a_waiter in data['Waiters'])!s}")
 
-        self._gsheet = gsheet.GSheet(self._chassis_name, self._chassis_ip)
-        return self._update_gsheet()
+    return True, None
@@ -1,40 +1,55 @@
 import unittest
 import chassis_manager
+import contextlib
+import io
+import main
 import os
 import lock
+import lock_watch
+import sheet_sync
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
 
-class ChassisManagerCreationFromConfFileTest(unittest.TestCase):
+class _ChassisManagerTestCase(unittest.TestCase):
+    # The config, the lock and the sheet spool live in a directory of their
+    # own, and no sheet flusher process is started.
     def setUp(self) -> None:
-        chassis_manager.config_file_path = os.getcwd()
+        self._dir = tempfile.mkdtemp()
+        self._old_paths = (chassis_manager.config_file_path, lock.lock_file_path, sheet_sync.spool_file_path)
+        chassis_manager.config_file_path = self._dir
+        lock.lock_file_path = self._dir
+        sheet_sync.spool_file_path = self._dir
 
-        with open(chassis_manager._get_config_file_path(), "a+") as config_file:
+    def tearDown(self) -> None:
+        chassis_manager.config_file_path, lock.lock_file_path, sheet_sync.spool_file_path = self._old_paths
+        shutil.rmtree(self._dir)
+
+    def _chm(self, name=None, ip=None):
+        chm = chassis_manager.ChassisManager(name, ip)
+        chm.set_sheet_flusher(lambda: None)
+        return chm
+
+
+class ChassisManagerCreationFromConfFileTest(_ChassisManagerTestCase):
+    def test_chassis_manager(self):
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
             config_file.write("[Chassis]\n")
             config_file.write("ip = 10.10.10.10\n")
             config_file.write("name = gullu\n")
 
-    def tearDown(self) -> None:
-        try:
-            os.remove(chassis_manager._get_config_file_path())
-            os.remove(lock._get_lock_file_path())
-        except Exception as e:
-            pass
-
-    def test_chassis_manager(self):
-        chm = chassis_manager.ChassisManager()
+        chm = self._chm()
         self.assertEqual(chm._chassis_ip, "10.10.10.10")
         self.assertEqual(chm._chassis_name, "gullu")
 
 
-class ChassisManagerLock(unittest.TestCase):
-    def tearDown(self) -> None:
-        try:
-            os.remove(lock._get_lock_file_path())
-        except Exception as e:
-            pass
-
+class ChassisManagerLock(_ChassisManagerTestCase):
     def test_chm_lock(self):
-        chm = chassis_manager.ChassisManager()
+        chm = self._chm()
         success, error = chm.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE),
                              "gullu.kale@gmail.com", "gullu", False)
         self.assertEqual(success, True)
@@ -46,16 +61,63 @@ class ChassisManagerLock(unittest.TestCase):
         self.assertEqual(error, lock.ErrNotAvailable)
         self.assertEqual(len(chm._lock.waiters()), 0)
 
+    def test_invalid_resource_is_reported(self):
+        chm = self._chm("gullu", "10.10.10.10")
 
-class ChassisManagerUnlock(unittest.TestCase):
-    def tearDown(self) -> None:
-        try:
-            os.remove(lock._get_lock_file_path())
-        except Exception as e:
-            pass
+        for argv in [["--lock", "--lock-type", "exclusive", "--name", "x", "--email", "x@pavilion.io"],
+                     ["--unlock", "--email", "x@pavilion.io"], ["--lock-owners"], ["--lock-history"]]:
+            output = io.StringIO()
+
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(main.run(main.parse_user_args(argv + ["--resource", "slot3/../drive2"]), chm), 1)
+
+            self.assertIn("slot3/../drive2", output.getvalue())
+
+
+class ChassisManagerHistory(_ChassisManagerTestCase):
+    def test_negative_counts_are_rejected(self):
+        chm = self._chm("gullu", "10.10.10.10")
+        chm.lock("exclusive", "x@pavilion.io", "x", False)
+
+        for option in ["--limit", "--tail"]:
+            output = io.StringIO()
+
+            with contextlib.redirect_stdout(output):
+                main.run(main.parse_user_args(["--lock-history", option, "-1"]), chm)
+
+            self.assertEqual(output.getvalue(), "Please specify --limit and --tail as a number of entries, 0 or more\n")
 
+
+class ChassisManagerReservation(_ChassisManagerTestCase):
+    def _run(self, chm, argv):
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            main.run(main.parse_user_args(argv), chm)
+
+        return output.getvalue()
+
+    def test_times_with_an_offset_are_local(self):
+        chm = self._chm("gullu", "10.10.10.10")
+        start = datetime(2030, 6, 1, 9, 0, tzinfo=timezone(timedelta(hours=2))).astimezone().replace(tzinfo=None)
+        end = datetime(2030, 6, 1, 17, 0, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+        output = self._run(chm, ["--reserve", "--lock-type", "exclusive", "--name", "a", "--email", "a@pavilion.io",
+                                 "--from", "2030-06-01T09:00+02:00", "--to", "2030-06-01T17:00Z"])
+        self.assertTrue(output.startswith("Reserved "), output)
+        self.assertTrue(output.endswith(f" from {start!s} to {end!s}\n"), output)
+
+    def test_next_free_from_with_an_offset(self):
+        chm = self._chm("gullu", "10.10.10.10")
+        after = datetime(2030, 6, 1, 9, 0, tzinfo=timezone(timedelta(hours=2))).astimezone().replace(tzinfo=None)
+
+        output = self._run(chm, ["--next-free", "2h", "--lock-type", "exclusive", "--from", "2030-06-01T09:00+02:00"])
+        self.assertEqual(output, f"Free from {after!s}\n")
+
+
+class ChassisManagerUnlock(_ChassisManagerTestCase):
     def test_unlock(self):
-        chm = chassis_manager.ChassisManager()
+        chm = self._chm()
         success, error = chm.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE),
                              "gullu.kale@gmail.com", "gullu", True)
         self.assertEqual(success, True)
@@ -73,5 +135,200 @@ class ChassisManagerUnlock(unittest.TestCase):
         self.assertEqual(len(chm._lock.waiters()), 0)
 
 
+    def test_notify_waiter_is_not_granted(self):
+        chm = self._chm()
+        chm.lock("exclusive", "gullu.kale@gmail.com", "gullu", False)
+        self.assertEqual(chm.lock("exclusive", "pillu.kale@gmail.com", "pillu", True), (False, lock.ErrNotAvailable))
+        self.assertEqual([a_waiter["Email"] for a_waiter in chm._lock.waiters()], ["pillu.kale@gmail.com"])
+
+        chm.unlock("gullu.kale@gmail.com")
+        self.assertEqual(chm.handed_over(), [])
+        self.assertEqual(chm._lock.type(), lock.LockType.FREE)
+        self.assertEqual(chm._lock.waiters(), [])
+
+    def test_queued_request_is_granted_on_release(self):
+        chm = self._chm()
+        chm.lock("exclusive", "gullu.kale@gmail.com", "gullu", False)
+        self.assertEqual(chm.lock("shared", "pillu.kale@gmail.com", "pillu", False, queue=True),
+                         (False, lock.ErrQueued))
+
+        # Nobody waits on the lock file, the release alone hands it over
+        chm._notifier = mock.Mock()
+        chm._notifier.post.return_value = 1
+        self.assertEqual(chm.unlock("gullu.kale@gmail.com")[:2], (True, None))
+
+        self.assertEqual(chm._notifier.post.call_args[0][0], ["pillu.kale@gmail.com"])
+        self.assertEqual(chm.handed_over(), ["pillu.kale@gmail.com"])
+        self.assertEqual(chm._lock.type(), lock.LockType.SHARED)
+        self.assertTrue(chm._lock.is_lock_owner("pillu.kale@gmail.com"))
+        self.assertEqual(chm._lock.waiters(), [])
+
+
+class ChassisManagerLazySheet(_ChassisManagerTestCase):
+    def test_read_only_commands(self):
+        with mock.patch("gsheet.GSheet") as sheet:
+            chm = self._chm("gullu", "10.10.10.10")
+            chm.print_lock_owners()
+            chm.print_lock_history()
+            sheet.assert_not_called()
+
+    def test_read_only_commands_do_not_reap(self):
+        self._chm("gullu", "10.10.10.10").lock("exclusive", "gullu.kale@gmail.com", "gullu", False, ttl=0.1)
+        time.sleep(0.2)
+
+        with mock.patch("sheet_sync.start_flusher") as flusher, \
+                mock.patch("lock.Lock.transaction") as transaction:
+            chm = chassis_manager.ChassisManager("gullu", "10.10.10.10")
+            chm.print_lock_owners()
+            chm.print_lock_history()
+            chm.print_reservations()
+            flusher.assert_not_called()
+            transaction.assert_not_called()
+
+        self.assertEqual([a_owner["Email"] for a_owner in lock.Lock().owners()], ["gullu.kale@gmail.com"])
+
+    def test_state_change_is_spooled(self):
+        with mock.patch("gsheet.GSheet") as sheet, mock.patch("sheet_sync.start_flusher") as flusher:
+            chm = chassis_manager.ChassisManager("gullu", "10.10.10.10")
+            chm.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE), "gullu.kale@gmail.com", "gullu", False)
+            chm.unlock("gullu.kale@gmail.com")
+            sheet.assert_not_called()
+            self.assertEqual(flusher.call_count, 2)
+
+        records = sheet_sync.pending()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["Name"], "gullu")
+        self.assertEqual(records[0]["Lock"], "FREE")
+
+
+class ChassisManagerIdentity(_ChassisManagerTestCase):
+    def test_configured_identity_skips_resolver(self):
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write("[Chassis]\nname = gullu\nip = 10.10.10.10\n")
+
+        with mock.patch("socket.gethostname") as hostname, mock.patch("socket.gethostbyname") as resolver:
+            chm = self._chm()
+            hostname.assert_not_called()
+            resolver.assert_not_called()
+
+        self.assertEqual((chm._chassis_name, chm._chassis_ip), ("gullu", "10.10.10.10"))
+
+    def test_hung_resolver_falls_back(self):
+        release = threading.Event()
+
+        with mock.patch("socket.gethostbyname", side_effect=lambda host: release.wait(10)), \
+                mock.patch("chassis_manager.resolve_timeout", 0.1):
+            start = time.monotonic()
+            chm = self._chm()
+            release.set()
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(chm._chassis_ip, chassis_manager._get_interface_ip())
+
+    def test_init_without_google(self):
+        database = os.path.join(self._dir, "status.db")
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write(f"[Sync]\nbackend = sqlite\ndatabase = {database!s}\n")
+
+        with mock.patch("gsheet.GSheet") as sheet:
+            chm = self._chm("gullu", "10.10.10.10")
+            self.assertEqual(chm.ch_init("gullu", "10.10.10.10"), (True, None))
+            sheet.assert_not_called()
+
+        import sqlite_backend
+        store = sqlite_backend.SQLiteStore(database)
+        self.assertEqual(store.chassis("gullu")["Ip"], "10.10.10.10")
+        store.close()
+
+
+class ChassisManagerWait(_ChassisManagerTestCase):
+    def _chm(self, name="gullu", ip="10.10.10.10"):
+        return super()._chm(name, ip)
+
+    def _wait_in_thread(self, email, results, timeout=10):
+        def wait():
+            results[email] = self._chm().lock_wait("exclusive", email, "x", timeout)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        return thread
+
+    def _wait_for_waiters(self, count):
+        for _ in range(500):
+            lck = lock.Lock()
+            if len(lck.waiters()) == count:
+                return
+            time.sleep(0.01)
+
+        self.fail("waiters did not queue up")
+
+    def test_timeout(self):
+        chm = self._chm()
+        chm.lock("exclusive", "owner@pavilion.io", "x", False)
+
+        start = time.monotonic()
+        success, error = self._chm().lock_wait("exclusive", "waiter@pavilion.io", "x", 0.2)
+        self.assertEqual((success, error), (False, lock.ErrTimeout))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(lock.Lock().waiters(), [])
+
+    def test_fifo_handoff(self):
+        owner = self._chm()
+        owner.lock("exclusive", "owner@pavilion.io", "x", False)
+        results = {}
+
+        first = self._wait_in_thread("first@pavilion.io", results)
+        self._wait_for_waiters(1)
+        second = self._wait_in_thread("second@pavilion.io", results)
+        self._wait_for_waiters(2)
+
+        owner.unlock("owner@pavilion.io")
+        first.join(5)
+        self.assertEqual(results["first@pavilion.io"], (True, None))
+        self.assertEqual(second.is_alive(), True)
+
+        self._chm().unlock("first@pavilion.io")
+        second.join(5)
+        self.assertEqual(results["second@pavilion.io"], (True, None))
+
+        lck = lock.Lock()
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["second@pavilion.io"])
+        self.assertEqual(lck.waiters(), [])
+
+    def test_cancel(self):
+        self._chm().lock("exclusive", "owner@pavilion.io", "x", False)
+        cancel = lock_watch.CancelEvent()
+        results = {}
+
+        def wait():
+            results["waiter"] = self._chm().lock_wait("exclusive", "waiter@pavilion.io", "x", None, cancel)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        self._wait_for_waiters(1)
+        cancel.set()
+        thread.join(5)
+        cancel.close()
+
+        self.assertEqual(results["waiter"], (False, lock.ErrCancelled))
+        self.assertEqual(lock.Lock().waiters(), [])
+
+    def test_expired_lease_is_handed_over(self):
+        self._chm().lock("exclusive", "owner@pavilion.io", "x", False, ttl=0.3)
+        results = {}
+
+        start = time.monotonic()
+        waiter = self._wait_in_thread("waiter@pavilion.io", results)
+        waiter.join(5)
+
+        self.assertEqual(results["waiter@pavilion.io"], (True, None))
+        self.assertLess(time.monotonic() - start, 3)
+
+        lck = lock.Lock()
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["waiter@pavilion.io"])
+        self.assertIn("Expired", [a_entry["Action"] for a_entry in lck.history()])
+
+
 if __name__ == "__main__":
     runner = unittest.main()
@@ -27,6 +27,31 @@ c_lock()
   fi
 }
 
+c_wait()
+{
+  is_init || return
+  read -p "Please tell me your pavilion email address: " email
+  read -p "What kind of lock would you like to acquire(Exclusive/Shared) [Exclusive]: " lock_type
+  lock_type=${lock_type:-'Exclusive'}
+  python3 ${src_dir}/main.py --lock --lock-type "${lock_type}" --name "shell" --email "${email}" --wait
+}
+
+c_queue()
+{
+  is_init || return
+  read -p "Please tell me your pavilion email address: " email
+  read -p "What kind of lock would you like to acquire(Exclusive/Shared) [Exclusive]: " lock_type
+  lock_type=${lock_type:-'Exclusive'}
+  python3 ${src_dir}/main.py --lock --lock-type "${lock_type}" --name "shell" --email "${email}" --queue
+}
+
+c_renew()
+{
+  is_init || return
+  read -p "Please tell me your pavilion email address: " email
+  python3 ${src_dir}/main.py --renew --email "${email}"
+}
+
 c_unlock()
 {
   is_init || return
@@ -62,3 +87,9 @@ c_gitdir()
   read -p "Please tell me the directory path: " path
   python3 ${src_dir}/main.py --git-init "${path}"
 }
+
+c_daemon()
+{
+  is_init || return
+  python3 ${src_dir}/chm_daemon.py --detach
+}
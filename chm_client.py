@@ -0,0 +1,84 @@
+import json
+import pathlib
+import socket
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+socket_file_path = str(pathlib.Path(__file__).parent.absolute())
+socket_file_name = "/.chm_daemon.sock"
+connect_timeout = 0.5
+reply_timeout = 60
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_socket_file_path():
+    return socket_file_path + socket_file_name
+
+
+def _read_line(conn):
+    chunks = []
+
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+
+    return b"".join(chunks)
+
+
+"""
+******************************
+******* The Client ***********
+******************************
+"""
+
+
+def call(message, timeout=reply_timeout):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        conn.settimeout(connect_timeout)
+
+        try:
+            conn.connect(_get_socket_file_path())
+        except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+            return None
+
+        try:
+            conn.settimeout(timeout)
+            conn.sendall(json.dumps(message).encode() + b"\n")
+            line = _read_line(conn)
+        except OSError:
+            line = b""
+    finally:
+        conn.close()
+
+    if not line:
+        # The daemon took the request, running it again in process could
+        # apply it twice.
+        return {"Code": 1, "Output": "Chassis manager daemon did not reply\n"}
+
+    return json.loads(line)
+
+
+def request(argv, timeout=reply_timeout):
+    # Returns None when no daemon is running, the caller then runs the
+    # command in process. A timeout of None waits for the reply forever.
+    reply = call({"Argv": list(argv)}, timeout)
+
+    if reply is None:
+        return None
+
+    return reply["Code"], reply["Output"]
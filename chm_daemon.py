@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import chassis_manager
+import chm_client
+import lock
+import lock_watch
+import main
+import sheet_sync
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+max_waiters = 64
+
+# How often expired leases are released while nobody runs a command
+reap_interval = 30
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _config_stamp():
+    try:
+        stat = os.stat(chassis_manager._get_config_file_path())
+    except FileNotFoundError:
+        return None
+
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextlib.contextmanager
+def _capture_both(stdout, stderr, output):
+    with stdout.capture(output), stderr.capture(output):
+        yield output
+
+
+class _ThreadOutput:
+    # Commands run on several threads at once, each one collects its own
+    # output while anything else still goes to the real stream.
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = None
+
+    def write(self, data):
+        buffer = getattr(self._local, "buffer", None)
+        return (buffer or self._stream).write(data)
+
+    def flush(self):
+        buffer = getattr(self._local, "buffer", None)
+        (buffer or self._stream).flush()
+
+
+"""
+******************************
+******* The Daemon ***********
+******************************
+"""
+
+
+class ChassisDaemon:
+    def __init__(self, sheet_factory=None):
+        self._sheet_factory = sheet_factory or sheet_sync._default_sheet_factory
+        self._sheets = {}
+        self._chms = {}
+        self._config_stamp = None
+        self._mutex = None
+        self._server = None
+        self._commands = ThreadPoolExecutor(max_workers=1)
+        self._waits = ThreadPoolExecutor(max_workers=max_waiters)
+        self._flusher = ThreadPoolExecutor(max_workers=1)
+        self._stdout = None
+        self._stderr = None
+        self._cancels = set()
+
+    def _warm_sheet(self, name, ip):
+        # Keep one authenticated sheet client per chassis for the lifetime of
+        # the daemon instead of logging in for every push.
+        if (name, ip) not in self._sheets:
+            self._sheets[(name, ip)] = self._sheet_factory(name, ip)
+
+        return self._sheets[(name, ip)]
+
+    def _flush_sheet(self):
+        self._flusher.submit(sheet_sync.run_flusher, self._warm_sheet)
+
+    def _chassis_manager(self, chassis=None):
+        # One ChassisManager per chassis, a central lock store serves many
+        stamp = _config_stamp()
+
+        if stamp != self._config_stamp:
+            self._chms = {}
+            self._config_stamp = stamp
+
+        if chassis not in self._chms:
+            chm = chassis_manager.ChassisManager(chassis)
+            chm.set_sheet_flusher(self._flush_sheet)
+            self._chms[chassis] = chm
+
+        self._chms[chassis].refresh()
+        return self._chms[chassis]
+
+    def _capture(self, output):
+        return _capture_both(self._stdout, self._stderr, output)
+
+    def _parse(self, argv):
+        with self._capture(io.StringIO()):
+            try:
+                return main.parse_user_args(argv)
+            except SystemExit:
+                return None
+
+    def _run(self, argv, chm=None, cancel=None):
+        output = io.StringIO()
+
+        with self._capture(output):
+            try:
+                args = main.parse_user_args(argv)
+
+                # init and the chassis list make their own, init changes the
+                # identity the cached ones were made with.
+                if args.INIT or args.LIST_CHASSIS:
+                    self._chms = {}
+                elif chm is None and not main.missing_chassis(args):
+                    chm = self._chassis_manager(args.CHASSIS)
+
+                code = main.run(args, chm, cancel)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print(f"{lock.ErrInternal!s}: {e!s}")
+                code = 1
+
+        return code, output.getvalue()
+
+    def _run_wait(self, argv, chassis, cancel):
+        # A waiting command must not hold up the others, it gets its own
+        # ChassisManager and sleeps on the lock file on its own thread.
+        chm = chassis_manager.ChassisManager(chassis)
+        chm.set_sheet_flusher(self._flush_sheet)
+        return self._run(argv, chm, cancel)
+
+    async def _wait(self, reader, argv, chassis):
+        loop = asyncio.get_running_loop()
+        cancel = lock_watch.CancelEvent()
+        self._cancels.add(cancel)
+
+        try:
+            job = loop.run_in_executor(self._waits, self._run_wait, argv, chassis, cancel)
+            gone = asyncio.ensure_future(reader.read())
+
+            # A client that disconnects gives up its place in the queue
+            await asyncio.wait({job, gone}, return_when=asyncio.FIRST_COMPLETED)
+            if not job.done():
+                cancel.set()
+
+            result = await job
+            gone.cancel()
+            return result
+        finally:
+            self._cancels.discard(cancel)
+            cancel.close()
+
+    def _chassis_names(self):
+        database = chassis_manager.central_database()
+
+        if database is None:
+            return [None]
+
+        # Every chassis in the store, not only the ones a command was served
+        # for since the daemon started.
+        import central_store
+        return [name for name, ip, data in central_store.list_chassis(database)]
+
+    def _reap(self):
+        with self._capture(io.StringIO()):
+            try:
+                chassis_names = self._chassis_names()
+            except Exception:
+                return
+
+            for chassis in chassis_names:
+                try:
+                    self._chassis_manager(chassis).reap()
+                except Exception:
+                    pass
+
+    async def _reaper(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(reap_interval)
+
+            async with self._mutex:
+                await loop.run_in_executor(self._commands, self._reap)
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            request = json.loads(line)
+
+            if request.get("Ping"):
+                reply = {"Code": 0, "Output": ""}
+            else:
+                args = self._parse(request["Argv"])
+
+                if args is not None and args.LOCK and args.WAIT and not main.missing_chassis(args):
+                    code, output = await self._wait(reader, request["Argv"], args.CHASSIS)
+                else:
+                    # One command at a time, the same order the clients connected
+                    async with self._mutex:
+                        loop = asyncio.get_running_loop()
+                        code, output = await loop.run_in_executor(self._commands, self._run, request["Argv"])
+
+                reply = {"Code": code, "Output": output}
+
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        except (ValueError, KeyError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        socket_path = chm_client._get_socket_file_path()
+        self._mutex = asyncio.Lock()
+
+        if os.path.exists(socket_path):
+            if chm_client.call({"Ping": True}) is not None:
+                raise RuntimeError("Chassis manager daemon is already running")
+
+            os.remove(socket_path)
+
+        self._server = await asyncio.start_unix_server(self._handle, path=socket_path)
+        os.chmod(socket_path, 0o666)
+
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        self._stdout = sys.stdout = _ThreadOutput(old_stdout)
+        self._stderr = sys.stderr = _ThreadOutput(old_stderr)
+
+        if ready is not None:
+            ready()
+
+        reaper = asyncio.ensure_future(self._reaper())
+
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            reaper.cancel()
+            await asyncio.gather(reaper, return_exceptions=True)
+
+            try:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                pass
+
+            for cancel in list(self._cancels):
+                cancel.set()
+
+            self._commands.shutdown(wait=True)
+            self._waits.shutdown(wait=True)
+            self._flusher.shutdown(wait=True)
+
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            self._stdout = self._stderr = None
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager daemon")
+
+    parser.add_argument('--detach', action='store_true', dest="DETACH", required=False,
+                        help="Run the daemon in the background")
+
+    return parser.parse_args()
+
+
+def _serve_forever():
+    daemon = ChassisDaemon()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(daemon.serve())
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, task.cancel)
+
+    try:
+        loop.run_until_complete(task)
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.DETACH:
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, start_new_session=True)
+        exit(0)
+
+    try:
+        _serve_forever()
+    except RuntimeError as e:
+        print(e)
+        exit(1)
+
+    exit(0)
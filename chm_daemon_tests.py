@@ -0,0 +1,140 @@
+import unittest
+import asyncio
+import chassis_manager
+import chm_client
+import chm_daemon
+import fake_gsheet
+import gsheet
+import lock
+import sheet_sync
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChassisDaemonTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._old_paths = (lock.lock_file_path, chassis_manager.config_file_path, sheet_sync.spool_file_path,
+                           chm_client.socket_file_path, gsheet.row_cache_file_path)
+        lock.lock_file_path = self._dir
+        chassis_manager.config_file_path = self._dir
+        sheet_sync.spool_file_path = self._dir
+        chm_client.socket_file_path = self._dir
+        gsheet.row_cache_file_path = self._dir
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write("[Chassis]\nname = gullu\nip = 10.10.10.10\n")
+
+        self._worksheet = fake_gsheet.FakeWorksheet()
+        self._daemon = chm_daemon.ChassisDaemon(lambda name, ip: gsheet.GSheet(name, ip, self._worksheet))
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._task = None
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._task = self._loop.create_task(self._daemon.serve(ready.set))
+            self._loop.run_until_complete(self._task)
+
+        self._thread = threading.Thread(target=serve)
+        self._thread.start()
+        ready.wait(5)
+
+    def tearDown(self) -> None:
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(5)
+        self._loop.close()
+        (lock.lock_file_path, chassis_manager.config_file_path, sheet_sync.spool_file_path,
+         chm_client.socket_file_path, gsheet.row_cache_file_path) = self._old_paths
+        shutil.rmtree(self._dir)
+
+    def _lock_argv(self, email, lock_type="exclusive"):
+        return ["--lock", "--lock-type", lock_type, "--name", "x", "--email", email]
+
+    def test_lock_cycle(self):
+        code, output = chm_client.request(self._lock_argv("gullu.kale@pavilion.io"))
+        self.assertEqual((code, output), (0, "Lock acquired successfully\n"))
+
+        code, output = chm_client.request(["--lock-owners"])
+        self.assertEqual(output, "gullu.kale@pavilion.io\n")
+
+        code, output = chm_client.request(["--unlock", "--email", "gullu.kale@pavilion.io"])
+        self.assertEqual(output, "Lock released successfully\n")
+
+        code, output = chm_client.request(["--lock-owners"])
+        self.assertEqual(output, "Lock is free\n")
+
+        self._daemon._flusher.submit(lambda: None).result(5)
+        self.assertEqual(self._worksheet.row_values(2)[:3], ["gullu", "10.10.10.10", "FREE"])
+
+    def test_concurrent_requests(self):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            replies = list(pool.map(lambda i: chm_client.request(self._lock_argv(f"user{i!s}@pavilion.io")), range(32)))
+
+        outputs = [output for code, output in replies]
+        self.assertEqual(outputs.count("Lock acquired successfully\n"), 1)
+        self.assertEqual(outputs.count(lock.ErrNotAvailable + "\n"), 31)
+        self.assertEqual(len(lock.Lock().owners()), 1)
+
+    def test_external_change_is_seen(self):
+        chm_client.request(self._lock_argv("gullu.kale@pavilion.io"))
+
+        lck = lock.Lock()
+        lck.unlock("gullu.kale@pavilion.io")
+        lck.lock("exclusive", "x", "pillu.kale@pavilion.io")
+
+        code, output = chm_client.request(["--lock-owners"])
+        self.assertEqual(output, "pillu.kale@pavilion.io\n")
+
+    def test_wait_for_lock(self):
+        chm_client.request(self._lock_argv("gullu.kale@pavilion.io"))
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            waiting = pool.submit(chm_client.request, self._lock_argv("pillu.kale@pavilion.io") + ["--wait"], None)
+
+            for _ in range(500):
+                if lock.Lock().waiters():
+                    break
+                time.sleep(0.01)
+
+            # Other commands are still served while somebody waits
+            code, output = chm_client.request(["--lock-owners"])
+            self.assertEqual(output, "gullu.kale@pavilion.io\n")
+            self.assertEqual(waiting.done(), False)
+
+            chm_client.request(["--unlock", "--email", "gullu.kale@pavilion.io"])
+            self.assertEqual(waiting.result(5), (0, "Lock acquired successfully\n"))
+
+        code, output = chm_client.request(["--lock-owners"])
+        self.assertEqual(output, "pillu.kale@pavilion.io\n")
+
+    def test_wait_timeout(self):
+        chm_client.request(self._lock_argv("gullu.kale@pavilion.io"))
+        code, output = chm_client.request(self._lock_argv("pillu.kale@pavilion.io") + ["--wait", "--timeout", "0.1"])
+        self.assertEqual(output, lock.ErrTimeout + "\n")
+        self.assertEqual(lock.Lock().waiters(), [])
+
+    def test_bad_arguments(self):
+        code, output = chm_client.request(["--limit", "many"])
+        self.assertEqual(code, 2)
+        self.assertIn("invalid int value", output)
+
+
+class NoDaemonTest(unittest.TestCase):
+
+    def test_no_daemon(self):
+        old_path = chm_client.socket_file_path
+        chm_client.socket_file_path = tempfile.mkdtemp()
+
+        try:
+            self.assertEqual(chm_client.request(["--lock-owners"]), None)
+        finally:
+            shutil.rmtree(chm_client.socket_file_path)
+            chm_client.socket_file_path = old_path
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,176 @@
+import fcntl
+import json
+import os
+import pathlib
+from gspread.utils import a1_to_rowcol
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+sheet_file_path = str(pathlib.Path(__file__).parent.absolute())
+sheet_file_name = "/.chm_fake_sheet.json"
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_sheet_file_path():
+    return sheet_file_path + sheet_file_name
+
+
+def sheet_from_config(config):
+    # [Sync] sheet = /tmp/fake_sheet.json, the install directory otherwise
+    if 'Sync' in config and config['Sync'].get('sheet'):
+        return config['Sync'].get('sheet')
+
+    return _get_sheet_file_path()
+
+"""
+******************************
+******* Fake Worksheet *******
+******************************
+"""
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    # In-memory stand-in for a gspread worksheet. Every call is recorded in
+    # 'calls' so tests can count the API requests a code path makes.
+    def __init__(self, rows=None):
+        self.rows = [list(row) for row in (rows or [["Name", "IP", "Lock", "Owners", "Waiters"]])]
+        self.calls = []
+
+    def _cell_value(self, row, col):
+        if row > len(self.rows) or col > len(self.rows[row - 1]):
+            return ''
+
+        return self.rows[row - 1][col - 1]
+
+    def _set_cell_value(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+
+        values = self.rows[row - 1]
+        values.extend([''] * (col - len(values)))
+        values[col - 1] = value
+
+    def find(self, query, in_column=None):
+        self.calls.append("find")
+
+        for row, values in enumerate(self.rows, start=1):
+            for col, value in enumerate(values, start=1):
+                if value == query and (in_column is None or in_column == col):
+                    return FakeCell(row, col, value)
+
+        return None
+
+    def cell(self, row, col):
+        self.calls.append("cell")
+        return FakeCell(row, col, self._cell_value(row, col))
+
+    def row_values(self, row):
+        self.calls.append("row_values")
+        values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+        while values and values[-1] == '':
+            values.pop()
+
+        return values
+
+    def get_all_values(self):
+        self.calls.append("get_all_values")
+        width = max((len(values) for values in self.rows), default=0)
+        return [list(values) + [''] * (width - len(values)) for values in self.rows]
+
+    def append_row(self, values):
+        self.calls.append("append_row")
+        self.rows.append(list(values))
+
+    def insert_row(self, values, index=1):
+        self.calls.append("insert_row")
+        self.rows.insert(index - 1, list(values))
+
+    def delete_rows(self, index):
+        self.calls.append("delete_rows")
+        del self.rows[index - 1]
+
+    def batch_update(self, data):
+        self.calls.append("batch_update")
+
+        for a_range in data:
+            row, col = a1_to_rowcol(a_range["range"].split(":")[0])
+
+            for row_offset, values in enumerate(a_range["values"]):
+                for col_offset, value in enumerate(values):
+                    self._set_cell_value(row + row_offset, col + col_offset, value)
+
+
+class FileWorksheet(FakeWorksheet):
+    # A FakeWorksheet kept in a JSON file, so every process of a load test
+    # pushes to the same sheet and the run can read back what arrived. Each
+    # call rereads the file under a guard and writes it back if it changed.
+    def __init__(self, path=None):
+        super().__init__()
+        self._path = path or _get_sheet_file_path()
+        self._header = self.rows
+
+    def _call(self, method, write, *args):
+        guard_fd = os.open(self._path + ".guard", os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            fcntl.flock(guard_fd, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+
+            try:
+                with open(self._path) as sheet_file:
+                    self.rows = json.load(sheet_file)
+            except (FileNotFoundError, ValueError):
+                self.rows = [list(row) for row in self._header]
+
+            result = method(self, *args)
+
+            if write:
+                tmp_path = self._path + ".tmp"
+
+                with open(tmp_path, "w") as sheet_file:
+                    json.dump(self.rows, sheet_file)
+
+                os.replace(tmp_path, self._path)
+
+            return result
+        finally:
+            os.close(guard_fd)
+
+    def find(self, query, in_column=None):
+        return self._call(FakeWorksheet.find, False, query, in_column)
+
+    def cell(self, row, col):
+        return self._call(FakeWorksheet.cell, False, row, col)
+
+    def row_values(self, row):
+        return self._call(FakeWorksheet.row_values, False, row)
+
+    def get_all_values(self):
+        return self._call(FakeWorksheet.get_all_values, False)
+
+    def append_row(self, values):
+        return self._call(FakeWorksheet.append_row, True, values)
+
+    def insert_row(self, values, index=1):
+        return self._call(FakeWorksheet.insert_row, True, values, index)
+
+    def delete_rows(self, index):
+        return self._call(FakeWorksheet.delete_rows, True, index)
+
+    def batch_update(self, data):
+        return self._call(FakeWorksheet.batch_update, True, data)
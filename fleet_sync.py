@@ -0,0 +1,158 @@
+import argparse
+import configparser
+import json
+import os
+
+import chassis_manager
+import gsheet
+import lock
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _pad(values):
+    return list(values) + [''] * (gsheet.COL_CHASSIS_WAITERS - len(values))
+
+
+def _read_lock(chassis_dir):
+    config = configparser.ConfigParser()
+    config.read(chassis_dir + chassis_manager.config_file_name)
+
+    name = os.path.basename(os.path.normpath(chassis_dir))
+    ip = ''
+
+    if 'Chassis' in config:
+        name = config['Chassis'].get('name', name)
+        ip = config['Chassis'].get('ip', ip)
+
+    data = {"Type": "FREE", "Owners": [], "Waiters": []}
+
+    try:
+        with open(chassis_dir + lock.lock_file_name) as lock_file:
+            data = json.load(lock_file)
+    except FileNotFoundError:
+        pass
+
+    return name, ip, data
+
+
+def read_chassis(chassis_dir):
+    name, ip, data = _read_lock(chassis_dir)
+    return gsheet.build_row(name, ip, data["Type"], data["Owners"], data["Waiters"])
+
+
+"""
+******************************
+******* Fleet Sync ***********
+******************************
+"""
+
+
+def _locate_rows(live_values, chassis_rows, first_free_row):
+    by_name = {}
+    by_ip = {}
+
+    for row, values in enumerate(live_values, start=1):
+        if row < gsheet.DATA_START_ROW:
+            continue
+
+        values = _pad(values)
+        by_name.setdefault(values[gsheet.COL_CHASSIS_NAME - 1], row)
+        by_ip.setdefault(values[gsheet.COL_CHASSIS_IP - 1], row)
+
+    located = {}
+
+    for values in chassis_rows:
+        name = values[gsheet.COL_CHASSIS_NAME - 1]
+        ip = values[gsheet.COL_CHASSIS_IP - 1]
+        row = by_name.get(name, by_ip.get(ip, -1) if ip else -1)
+
+        if row == -1:
+            row = first_free_row
+            first_free_row += 1
+            current = _pad([])
+        else:
+            current = _pad(live_values[row - 1])
+
+        located[name] = {"Row": row, "Values": current}
+
+    return located
+
+
+def sync(chassis_dirs, sheet=None):
+    rows = {}
+
+    for chassis_dir in chassis_dirs:
+        values = read_chassis(chassis_dir)
+        rows[values[gsheet.COL_CHASSIS_NAME - 1]] = values
+
+    # The chassis push their own rows as well, only the live table tells what
+    # is on the sheet. One read finds every row, by name and then by ip like
+    # a chassis does, and one batch writes the cells that differ.
+    sheet = sheet if sheet is not None else gsheet._open_sheet()
+    live_values = sheet.get_all_values()
+    located = _locate_rows(live_values, rows.values(), max(len(live_values) + 1, gsheet.DATA_START_ROW))
+
+    ranges = []
+
+    for name, values in rows.items():
+        ranges.extend(gsheet._changed_ranges(located[name]["Row"], located[name]["Values"], values))
+
+    if ranges:
+        sheet.batch_update(ranges)
+
+    return len(rows), len(ranges)
+
+
+def sync_store(chassis_dirs, store):
+    # A local status database has no request quota, every chassis is written
+    # in one transaction.
+    rows = []
+
+    for chassis_dir in chassis_dirs:
+        name, ip, data = _read_lock(chassis_dir)
+        rows.append((name, ip, data["Type"], [a_owner["Email"] for a_owner in data["Owners"]],
+                     [a_waiter["Email"] for a_waiter in data["Waiters"]]))
+
+    store.update_many(rows)
+    return len(rows)
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="push the lock state of many chassis to the sheet")
+
+    parser.add_argument('chassis_dirs', metavar="CHASSIS_DIR", nargs='+',
+                        help="Chassis manager install directory holding chm_config.conf and .chm_lock.json")
+
+    parser.add_argument('--database', dest="DATABASE", required=False,
+                        help="Write to this SQLite status database instead of the sheet")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.DATABASE is not None:
+        import sqlite_backend
+
+        store = sqlite_backend.SQLiteStore(args.DATABASE)
+        chassis = sync_store(args.chassis_dirs, store)
+        store.close()
+        print(f"{chassis!s} chassis written to {args.DATABASE!s}")
+        exit(0)
+
+    chassis, updated = sync(args.chassis_dirs)
+    print(f"{chassis!s} chassis collected, {updated!s} ranges updated")
+    exit(0)
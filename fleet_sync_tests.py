@@ -0,0 +1,85 @@
+import unittest
+import fleet_sync
+import fake_gsheet
+import json
+import os
+import shutil
+import tempfile
+
+
+class FleetSyncTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._root = tempfile.mkdtemp()
+
+        self._sheet = fake_gsheet.FakeWorksheet()
+        self._sheet.rows.append(["pillu", "10.10.10.11", "FREE"])
+        self._dirs = [self._add_chassis("gullu", "10.10.10.10", "EXCLUSIVE", ["a@pavilion.io"]),
+                      self._add_chassis("pillu", "10.10.10.11", "SHARED", ["b@pavilion.io", "c@pavilion.io"]),
+                      self._add_chassis("tillu", "10.10.10.12", "FREE", [])]
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._root)
+
+    def _add_chassis(self, name, ip, lock_type, owners):
+        chassis_dir = os.path.join(self._root, name)
+        os.makedirs(chassis_dir, exist_ok=True)
+
+        with open(os.path.join(chassis_dir, "chm_config.conf"), "w") as config_file:
+            config_file.write(f"[Chassis]\nname = {name!s}\nip = {ip!s}\n")
+
+        self._set_lock(chassis_dir, lock_type, owners)
+        return chassis_dir
+
+    def _set_lock(self, chassis_dir, lock_type, owners):
+        with open(os.path.join(chassis_dir, ".chm_lock.json"), "w") as lock_file:
+            json.dump({"Type": lock_type, "Owners": [{"Name": "x", "Email": email} for email in owners],
+                       "Waiters": []}, lock_file)
+
+    def _row(self, index):
+        return fleet_sync._pad(self._sheet.rows[index])
+
+    def test_single_batch_update(self):
+        chassis, updated = fleet_sync.sync(self._dirs, self._sheet)
+        self.assertEqual(chassis, 3)
+        self.assertEqual(self._sheet.calls, ["get_all_values", "batch_update"])
+        self.assertEqual(self._row(1), ["pillu", "10.10.10.11", "SHARED", "b@pavilion.io, c@pavilion.io", ""])
+        self.assertEqual(self._row(2), ["gullu", "10.10.10.10", "EXCLUSIVE", "a@pavilion.io", ""])
+        self.assertEqual(self._row(3), ["tillu", "10.10.10.12", "FREE", "", ""])
+
+    def test_only_diff_is_pushed(self):
+        fleet_sync.sync(self._dirs, self._sheet)
+        self._sheet.calls.clear()
+
+        chassis, updated = fleet_sync.sync(self._dirs, self._sheet)
+        self.assertEqual(updated, 0)
+        self.assertEqual(self._sheet.calls, ["get_all_values"])
+
+        self._set_lock(self._dirs[0], "FREE", [])
+        self._sheet.calls.clear()
+        chassis, updated = fleet_sync.sync(self._dirs, self._sheet)
+        self.assertEqual(updated, 1)
+        self.assertEqual(self._sheet.calls, ["get_all_values", "batch_update"])
+        self.assertEqual(self._row(2), ["gullu", "10.10.10.10", "FREE", "", ""])
+
+    def test_row_written_by_chassis(self):
+        fleet_sync.sync(self._dirs, self._sheet)
+
+        # The chassis flusher pushed a newer state of its own, and then the
+        # lock went back to what the fleet sync pushed before.
+        self._sheet.rows[3][2] = "EXCLUSIVE"
+        self._sheet.calls.clear()
+
+        fleet_sync.sync(self._dirs, self._sheet)
+        self.assertEqual(self._sheet.calls, ["get_all_values", "batch_update"])
+        self.assertEqual(self._row(3), ["tillu", "10.10.10.12", "FREE", "", ""])
+
+    def test_renamed_chassis_found_by_ip(self):
+        self._sheet.rows.append(["old-gullu", "10.10.10.10", "FREE"])
+        fleet_sync.sync(self._dirs, self._sheet)
+
+        self.assertEqual(len(self._sheet.rows), 4)
+        self.assertEqual(self._row(2), ["gullu", "10.10.10.10", "EXCLUSIVE", "a@pavilion.io", ""])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -1,7 +1,17 @@
 import gspread
+import json
+import os
 import pathlib
+import status_backend
+import timing
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 
+# gspread < 6 raises CellNotFound for a missing value, newer versions return
+# None. API errors are not caught, a quota error must not look like a missing
+# row and append a duplicate one.
+_cell_not_found = getattr(gspread.exceptions, "CellNotFound", ())
+
 scope = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/spreadsheets",
@@ -13,6 +23,8 @@ scope = [
 sheet_name = "Chassis Info"
 auth_file_path = str(pathlib.Path(__file__).parent.absolute())
 auth_file_name = "/Quickstart-fc30c03af78b.json"
+row_cache_file_path = auth_file_path
+row_cache_file_name = "/.chm_gsheet_row.json"
 
 
 DATA_START_ROW = 2
@@ -20,61 +32,175 @@ COL_CHASSIS_NAME = 1
 COL_CHASSIS_IP = 2
 COL_CHASSIS_LOCK = 3
 COL_CHASSIS_OWNERS = 4
+COL_CHASSIS_WAITERS = 5
 
 
 def _get_config_file_path():
     return auth_file_path + auth_file_name
 
 
-class GSheet:
-    def __init__(self, name, ip):
-        creds = ServiceAccountCredentials.from_json_keyfile_name(_get_config_file_path(), scope)
-        client = gspread.authorize(creds)
-        self._sheet = client.open(sheet_name).sheet1
+def _get_row_cache_file_path():
+    return row_cache_file_path + row_cache_file_name
+
+
+def _row_cache_key(name, ip):
+    return f"{sheet_name!s}/{name!s}/{ip!s}"
+
+
+def _load_row_cache():
+    try:
+        with open(_get_row_cache_file_path()) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_row_cache(cache):
+    file_path = _get_row_cache_file_path()
+    tmp_path = f"{file_path!s}.{os.getpid()!s}.tmp"
+
+    try:
+        with open(tmp_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+
+        os.replace(tmp_path, file_path)
+    except OSError:
+        pass
+
+
+def _open_sheet():
+    creds = ServiceAccountCredentials.from_json_keyfile_name(_get_config_file_path(), scope)
+    client = gspread.authorize(creds)
+    return client.open(sheet_name).sheet1
+
+
+def build_row(name, ip, lock, owners=None, waiters=None):
+    owners_list = ''
+    waiters_list = ''
+
+    if owners is not None:
+        owners_list = ', '.join([owner['Email'] for owner in owners])
+
+    if waiters is not None:
+        waiters_list = ', '.join([waiter['Email'] for waiter in waiters])
+
+    return [name, ip, lock, owners_list, waiters_list]
+
+
+def _changed_ranges(row, old_values, new_values):
+    # Group the changed columns into contiguous runs, one range per run
+    ranges = []
+    run_start = None
+
+    for col in range(1, len(new_values) + 2):
+        changed = col <= len(new_values) and old_values[col - 1] != new_values[col - 1]
+
+        if changed and run_start is None:
+            run_start = col
+
+        if not changed and run_start is not None:
+            ranges.append({
+                "range": f"{rowcol_to_a1(row, run_start)!s}:{rowcol_to_a1(row, col - 1)!s}",
+                "values": [new_values[run_start - 1:col - 1]]
+            })
+            run_start = None
+
+    return ranges
+
+
+class GSheet(status_backend.StatusBackend):
+    def __init__(self, name, ip, sheet=None):
+        if sheet is None:
+            with timing.span("gsheet.auth"):
+                sheet = _open_sheet()
+
+        self._sheet = sheet
         self._chassis_name = name
         self._chassis_ip = ip
-        self._row = self._find_or_create_row()
+        self._values = None
+
+        with timing.span("gsheet.find"):
+            self._row = self._find_or_create_row()
 
     def _find_or_create_row(self):
+        cache = _load_row_cache()
+        key = _row_cache_key(self._chassis_name, self._chassis_ip)
+        cached = cache.get(key, -1)
+
+        # One read of the cached row both validates it and gives the current
+        # values for the first update. Rescan only if the row moved.
+        if cached != -1 and self._validate_row(cached):
+            return cached
+
         ret = self._find_row()
 
+        if ret == -1:
+            self._sheet.append_row([self._chassis_name, self._chassis_ip])
+            ret = self._find_row()
+
         if ret != -1:
-            return ret
+            cache[key] = ret
+            _save_row_cache(cache)
 
-        self._sheet.append_row([self._chassis_name, self._chassis_ip])
-        return self._find_row()
+        return ret
 
-    def _find_row(self):
+    def _validate_row(self, row):
         try:
-            return self._sheet.find(self._chassis_name, in_column=COL_CHASSIS_NAME).row
-        except gspread.exceptions.CellNotFound:
-            pass
+            values = self._sheet.row_values(row)
+        except Exception:
+            return False
+
+        values = values + [''] * (COL_CHASSIS_WAITERS - len(values))
+
+        if values[COL_CHASSIS_NAME - 1] != self._chassis_name and values[COL_CHASSIS_IP - 1] != self._chassis_ip:
+            return False
 
+        self._values = values
+        return True
+
+    def _find_cell(self, value, column):
         try:
-            return self._sheet.find(self._chassis_ip, in_column=COL_CHASSIS_IP).row
-        except gspread.exceptions.CellNotFound:
-            pass
+            cell = self._sheet.find(value, in_column=column)
+        except _cell_not_found:
+            return -1
 
-        return -1
+        if cell is None:
+            return -1
 
-    def update_info(self, lock, owners=None, waiters=None):
-        if self._row == -1:
-            return False, "chassis row not found"
+        return cell.row
+
+    def _find_row(self):
+        ret = self._find_cell(self._chassis_name, COL_CHASSIS_NAME)
 
-        self._sheet.delete_rows(self._row)
+        if ret != -1:
+            return ret
 
-        owners_list = ''
-        waiters_list = ''
+        return self._find_cell(self._chassis_ip, COL_CHASSIS_IP)
 
-        if owners is not None:
-            owners_list = ', '.join([owner['Email'] for owner in owners])
+    def _row_values(self):
+        if self._values is None:
+            values = self._sheet.row_values(self._row)
+            self._values = values + [''] * (COL_CHASSIS_WAITERS - len(values))
 
-        if waiters is not None:
-            waiters_list = ', '.join([waiter['Email'] for waiter in waiters])
+        return self._values
 
+    def update_info(self, lock, owners=None, waiters=None):
+        if self._row == -1:
+            return False, "chassis row not found"
+
+        values = build_row(self._chassis_name, self._chassis_ip, lock, owners, waiters)
+
+        # Rewrite only the changed cells in place. Deleting and re-inserting
+        # the row shifts every row below it under concurrent updaters.
         try:
-            self._sheet.insert_row([self._chassis_name, self._chassis_ip, lock, owners_list, waiters_list], self._row)
+            ranges = _changed_ranges(self._row, self._row_values(), values)
+
+            if ranges:
+                with timing.span("gsheet.update"):
+                    self._sheet.batch_update(ranges)
         except Exception as e:
+            self._values = None
             return False, str(e)
 
-        return True, None
\ No newline at end of file
+        self._values = values
+        return True, None
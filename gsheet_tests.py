@@ -0,0 +1,110 @@
+import unittest
+import gspread
+import gsheet
+import fake_gsheet
+import shutil
+import tempfile
+from unittest import mock
+
+
+class RowCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._old_path = gsheet.row_cache_file_path
+        gsheet.row_cache_file_path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(gsheet.row_cache_file_path)
+        gsheet.row_cache_file_path = self._old_path
+
+
+class GSheetRowTest(RowCacheTestCase):
+
+    def test_create_row(self):
+        sheet = fake_gsheet.FakeWorksheet()
+        gsh = gsheet.GSheet("gullu", "10.10.10.10", sheet)
+        self.assertEqual(gsh._row, 2)
+        self.assertEqual(sheet.rows[1], ["gullu", "10.10.10.10"])
+
+    def test_find_row_by_ip(self):
+        sheet = fake_gsheet.FakeWorksheet()
+        sheet.rows.append(["pillu", "10.10.10.11"])
+        sheet.rows.append(["old-name", "10.10.10.10"])
+        gsh = gsheet.GSheet("gullu", "10.10.10.10", sheet)
+        self.assertEqual(gsh._row, 3)
+
+
+    def test_api_error_does_not_append_row(self):
+        sheet = fake_gsheet.FakeWorksheet()
+        sheet.find = mock.Mock(side_effect=gspread.exceptions.GSpreadException("Quota exceeded"))
+
+        with self.assertRaises(gspread.exceptions.GSpreadException):
+            gsheet.GSheet("gullu", "10.10.10.10", sheet)
+
+        self.assertEqual(len(sheet.rows), 1)
+
+
+class GSheetRowCacheTest(RowCacheTestCase):
+
+    def test_cached_row(self):
+        sheet = fake_gsheet.FakeWorksheet()
+        sheet.rows.append(["pillu", "10.10.10.11"])
+        sheet.rows.append(["gullu", "10.10.10.10"])
+        self.assertEqual(gsheet.GSheet("gullu", "10.10.10.10", sheet)._row, 3)
+
+        sheet.calls.clear()
+        gsh = gsheet.GSheet("gullu", "10.10.10.10", sheet)
+        self.assertEqual(gsh._row, 3)
+        self.assertEqual(sheet.calls, ["row_values"])
+
+        # The validation read is reused as the base of the first update
+        gsh.update_info("FREE")
+        self.assertEqual(sheet.calls, ["row_values", "batch_update"])
+
+    def test_stale_cached_row(self):
+        sheet = fake_gsheet.FakeWorksheet()
+        sheet.rows.append(["pillu", "10.10.10.11"])
+        sheet.rows.append(["gullu", "10.10.10.10"])
+        gsheet.GSheet("gullu", "10.10.10.10", sheet)
+
+        del sheet.rows[1]
+        sheet.calls.clear()
+        gsh = gsheet.GSheet("gullu", "10.10.10.10", sheet)
+        self.assertEqual(gsh._row, 2)
+        self.assertEqual(sheet.calls, ["row_values", "find"])
+        self.assertEqual(gsheet._load_row_cache(), {gsheet._row_cache_key("gullu", "10.10.10.10"): 2})
+
+
+class GSheetUpdateTest(RowCacheTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._sheet = fake_gsheet.FakeWorksheet()
+        self._sheet.rows.append(["gullu", "10.10.10.10", "FREE"])
+        self._sheet.rows.append(["pillu", "10.10.10.11", "SHARED", "a@pavilion.io"])
+        self._gsh = gsheet.GSheet("pillu", "10.10.10.11", self._sheet)
+        self._sheet.calls.clear()
+
+    def test_update_in_place(self):
+        success, error = self._gsh.update_info("EXCLUSIVE", [{"Email": "b@pavilion.io"}], [{"Email": "c@pavilion.io"}])
+        self.assertEqual(success, True)
+        self.assertEqual(error, None)
+        self.assertEqual(self._sheet.calls, ["row_values", "batch_update"])
+        self.assertEqual(len(self._sheet.rows), 3)
+        self.assertEqual(self._sheet.rows[1], ["gullu", "10.10.10.10", "FREE"])
+        self.assertEqual(self._sheet.rows[2], ["pillu", "10.10.10.11", "EXCLUSIVE", "b@pavilion.io", "c@pavilion.io"])
+
+    def test_only_changed_cells(self):
+        self._gsh.update_info("SHARED", [{"Email": "a@pavilion.io"}], [{"Email": "c@pavilion.io"}])
+        self.assertEqual(self._sheet.calls, ["row_values", "batch_update"])
+        self.assertEqual(self._sheet.rows[2], ["pillu", "10.10.10.11", "SHARED", "a@pavilion.io", "c@pavilion.io"])
+
+        ranges = gsheet._changed_ranges(3, ["pillu", "10.10.10.11", "SHARED", "a@pavilion.io", "c@pavilion.io"],
+                                        ["pillu", "10.10.10.11", "FREE", "", "c@pavilion.io"])
+        self.assertEqual(ranges, [{"range": "C3:D3", "values": [["FREE", ""]]}])
+
+        self._sheet.calls.clear()
+        self._gsh.update_info("SHARED", [{"Email": "a@pavilion.io"}], [{"Email": "c@pavilion.io"}])
+        self.assertEqual(self._sheet.calls, [])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
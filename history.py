@@ -0,0 +1,358 @@
+import fcntl
+import json
+import os
+import time
+import timing
+
+from collections import deque
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+active_segment_name = "current.jsonl"
+segment_prefix = "segment-"
+segment_suffix = ".jsonl"
+index_suffix = ".idx"
+guard_file_name = ".guard"
+index_stride = 256
+
+segment_max_bytes = 1024 * 1024
+retention_bytes = 64 * 1024 * 1024
+retention_days = None
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _segment_name(seq):
+    return f"{segment_prefix!s}{seq:08d}{segment_suffix!s}"
+
+
+def _segment_seq(file_name):
+    if not file_name.startswith(segment_prefix) or not file_name.endswith(segment_suffix):
+        return -1
+
+    try:
+        return int(file_name[len(segment_prefix):-len(segment_suffix)])
+    except ValueError:
+        return -1
+
+
+def _index_path(segment):
+    return segment[:-len(segment_suffix)] + index_suffix
+
+
+def _read_segment(path, offset=0):
+    for position, record in _read_segment_at(path, offset):
+        yield record
+
+
+def _read_segment_at(path, offset=0):
+    try:
+        with open(path, "rb") as segment:
+            segment.seek(offset)
+            position = offset
+
+            for line in segment:
+                start = position
+                position += len(line)
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    yield start, json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid append
+                    continue
+    except FileNotFoundError:
+        return
+
+
+def _build_index(segment):
+    index = {"First": None, "Last": None, "Count": 0, "Emails": {}, "Actions": {}, "Resources": {}, "Sparse": []}
+
+    for position, record in _read_segment_at(segment):
+        if index["Count"] % index_stride == 0:
+            index["Sparse"].append([record["Time"], position])
+
+        if index["First"] is None:
+            index["First"] = record["Time"]
+
+        index["Last"] = record["Time"]
+        index["Count"] += 1
+        index["Emails"][record["Email"]] = index["Emails"].get(record["Email"], 0) + 1
+        index["Actions"][record["Action"]] = index["Actions"].get(record["Action"], 0) + 1
+
+        if record.get("Resource") is not None:
+            index["Resources"][record["Resource"]] = index["Resources"].get(record["Resource"], 0) + 1
+
+    return index
+
+
+def _under(path, resource):
+    # A resource filter also matches everything below the resource
+    return path is not None and (path == resource or path.startswith(resource + "/"))
+
+
+def _matches(record, email, action, since, until, resource=None):
+    if email is not None and record["Email"] != email:
+        return False
+
+    if resource is not None and not _under(record.get("Resource"), resource):
+        return False
+
+    if action is not None and record["Action"] != action:
+        return False
+
+    if since is not None and record["Time"] < since:
+        return False
+
+    if until is not None and record["Time"] > until:
+        return False
+
+    return True
+
+
+def filter_records(records, email=None, action=None, since=None, until=None, resource=None):
+    for record in records:
+        if _matches(record, email, action, since, until, resource):
+            yield record
+
+
+"""
+******************************
+******* History Log **********
+******************************
+"""
+
+
+class HistoryLog:
+    def __init__(self, path, segment_bytes=None, keep_bytes=None, keep_days=None):
+        self._path = path
+        self._segment_bytes = segment_bytes or segment_max_bytes
+        self._keep_bytes = keep_bytes if keep_bytes is not None else retention_bytes
+        self._keep_days = keep_days if keep_days is not None else retention_days
+
+    def _active_path(self):
+        return os.path.join(self._path, active_segment_name)
+
+    def _sealed_segments(self):
+        try:
+            names = os.listdir(self._path)
+        except FileNotFoundError:
+            return []
+
+        sealed = [(_segment_seq(name), name) for name in names if _segment_seq(name) != -1]
+        return [os.path.join(self._path, name) for seq, name in sorted(sealed)]
+
+    def segments(self):
+        return self._sealed_segments() + [self._active_path()]
+
+    def append(self, records):
+        if not records:
+            return
+
+        os.makedirs(self._path, exist_ok=True)
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+
+        with timing.span("history.append"):
+            fd = os.open(self._active_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+        if size >= self._segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        guard_fd = os.open(os.path.join(self._path, guard_file_name), os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            fcntl.flock(guard_fd, fcntl.LOCK_EX)
+
+            try:
+                if os.stat(self._active_path()).st_size < self._segment_bytes:
+                    # Somebody else rotated while we waited for the guard
+                    return
+            except FileNotFoundError:
+                return
+
+            sealed = self._sealed_segments()
+            seq = _segment_seq(os.path.basename(sealed[-1])) + 1 if sealed else 1
+            sealed_path = os.path.join(self._path, _segment_name(seq))
+            os.replace(self._active_path(), sealed_path)
+            self._write_index(sealed_path)
+            self._enforce_retention()
+        finally:
+            os.close(guard_fd)
+
+    def _enforce_retention(self):
+        sealed = self._sealed_segments()
+        sizes = {}
+
+        for segment in sealed:
+            try:
+                sizes[segment] = os.stat(segment)
+            except FileNotFoundError:
+                pass
+
+        total = sum(stat.st_size for stat in sizes.values())
+        oldest_allowed = time.time() - self._keep_days * 86400 if self._keep_days else None
+
+        for segment in sealed:
+            if segment not in sizes:
+                continue
+
+            too_big = self._keep_bytes and total > self._keep_bytes
+            too_old = oldest_allowed is not None and sizes[segment].st_mtime < oldest_allowed
+
+            if not too_big and not too_old:
+                break
+
+            for path in [segment, _index_path(segment)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            total -= sizes[segment].st_size
+
+    def _write_index(self, segment):
+        index = _build_index(segment)
+        tmp_path = _index_path(segment) + ".tmp"
+
+        try:
+            with open(tmp_path, "w") as index_file:
+                json.dump(index, index_file)
+
+            os.replace(tmp_path, _index_path(segment))
+        except OSError:
+            pass
+
+        return index
+
+    def _index(self, segment):
+        # Sealed segments never change, their index is built once at rotation
+        # or on the first query that needs it.
+        try:
+            with open(_index_path(segment)) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            pass
+
+        if not os.path.exists(segment):
+            return None
+
+        return self._write_index(segment)
+
+    def _segment_start(self, segment, email, action, since, until, resource=None):
+        if segment == self._active_path():
+            return 0
+
+        index = self._index(segment)
+
+        if index is None or not index["Count"]:
+            return -1
+
+        if since is not None and index["Last"] < since:
+            return -1
+
+        if until is not None and index["First"] > until:
+            return -1
+
+        if email is not None and email not in index["Emails"]:
+            return -1
+
+        if action is not None and action not in index["Actions"]:
+            return -1
+
+        # Indexes written before resource locks have no resources to go by
+        if (resource is not None and "Resources" in index
+                and not any(_under(path, resource) for path in index["Resources"])):
+            return -1
+
+        offset = 0
+
+        if since is not None:
+            for time_stamp, position in index["Sparse"]:
+                if time_stamp >= since:
+                    break
+                offset = position
+
+        return offset
+
+    def _query_segment(self, segment, email, action, since, until, resource=None):
+        offset = self._segment_start(segment, email, action, since, until, resource)
+
+        if offset == -1:
+            return
+
+        for position, record in _read_segment_at(segment, offset):
+            if until is not None and record["Time"] > until:
+                return
+
+            if _matches(record, email, action, since, until, resource):
+                yield record
+
+    def query(self, email=None, action=None, since=None, until=None, limit=None, tail=None, resource=None):
+        if tail is not None:
+            # Walk the segments newest first and keep only the last matches,
+            # memory is bounded by the tail size and not by the archive.
+            found = deque()
+
+            for segment in reversed(self.segments()):
+                if len(found) >= tail:
+                    break
+
+                matches = deque(self._query_segment(segment, email, action, since, until, resource), maxlen=tail - len(found))
+                found.extendleft(reversed(matches))
+
+            records = iter(found)
+        else:
+            records = (record for segment in self.segments()
+                       for record in self._query_segment(segment, email, action, since, until, resource))
+
+        for count, record in enumerate(records):
+            if limit is not None and count >= limit:
+                return
+
+            yield record
+
+    def records(self):
+        for segment in self.segments():
+            yield from _read_segment(segment)
+
+    def tail(self, count):
+        found = deque()
+
+        if count <= 0:
+            return []
+
+        for segment in reversed(self.segments()):
+            records = list(_read_segment(segment))
+            found.extendleft(reversed(records[-(count - len(found)):]))
+
+            if len(found) >= count:
+                break
+
+        return list(found)
+
+    def is_empty(self):
+        for segment in self.segments():
+            try:
+                if os.stat(segment).st_size:
+                    return False
+            except FileNotFoundError:
+                continue
+
+        return True
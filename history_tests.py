@@ -0,0 +1,134 @@
+import unittest
+import history
+import os
+import shutil
+import tempfile
+import time
+import types
+from unittest import mock
+
+
+def _event(index):
+    return {"Time": f"2024-01-01 00:00:{index:02d}", "Email": f"user{index!s}@pavilion.io", "Action": "Queried"}
+
+
+class HistoryLogTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._path)
+
+    def test_append_and_read(self):
+        log = history.HistoryLog(self._path)
+        self.assertEqual(log.is_empty(), True)
+        self.assertEqual(log.tail(10), [])
+
+        log.append([_event(i) for i in range(5)])
+        self.assertEqual(log.is_empty(), False)
+        self.assertEqual(list(log.records()), [_event(i) for i in range(5)])
+        self.assertEqual(log.tail(2), [_event(3), _event(4)])
+
+    def test_rotation(self):
+        log = history.HistoryLog(self._path, segment_bytes=200, keep_bytes=0)
+
+        for i in range(20):
+            log.append([_event(i)])
+
+        self.assertGreater(len(log.segments()), 2)
+        self.assertEqual(list(log.records()), [_event(i) for i in range(20)])
+        self.assertEqual(log.tail(7), [_event(i) for i in range(13, 20)])
+
+    def test_retention_bytes(self):
+        log = history.HistoryLog(self._path, segment_bytes=200, keep_bytes=400)
+
+        for i in range(40):
+            log.append([_event(i)])
+
+        sealed = log.segments()[:-1]
+        self.assertLessEqual(sum(os.stat(segment).st_size for segment in sealed), 400)
+        records = list(log.records())
+        self.assertEqual(records[-1], _event(39))
+        self.assertNotEqual(records[0], _event(0))
+
+    def test_retention_days(self):
+        log = history.HistoryLog(self._path, segment_bytes=200, keep_bytes=0, keep_days=1)
+
+        for i in range(10):
+            log.append([_event(i)])
+
+        old = time.time() - 3 * 86400
+        for segment in log.segments()[:-1]:
+            os.utime(segment, (old, old))
+
+        for i in range(10, 20):
+            log.append([_event(i)])
+
+        self.assertEqual(_event(0) in log.records(), False)
+        self.assertEqual(list(log.records())[-1], _event(19))
+
+
+class HistoryQueryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+        self._log = history.HistoryLog(self._path, segment_bytes=1000, keep_bytes=0)
+        self._events = []
+
+        for i in range(60):
+            event = {"Time": f"2024-01-{1 + i // 10:02d} 10:00:{i % 60:02d}",
+                     "Email": "alice@pavilion.io" if i < 30 else "bob@pavilion.io",
+                     "Action": "Exclusive lock" if i % 2 else "Unlock"}
+            self._events.append(event)
+            self._log.append([event])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._path)
+
+    def test_filters(self):
+        self.assertIsInstance(self._log.query(), types.GeneratorType)
+        self.assertEqual(list(self._log.query()), self._events)
+        self.assertEqual(list(self._log.query(email="bob@pavilion.io")), self._events[30:])
+        self.assertEqual(list(self._log.query(action="Unlock", email="alice@pavilion.io")), self._events[0:30:2])
+        self.assertEqual(list(self._log.query(since="2024-01-03", until="2024-01-04 23:59:59")), self._events[20:40])
+
+    def test_limit_and_tail(self):
+        self.assertEqual(list(self._log.query(limit=5)), self._events[:5])
+        self.assertEqual(list(self._log.query(tail=25)), self._events[35:])
+        self.assertEqual(list(self._log.query(email="alice@pavilion.io", tail=3)), self._events[27:30])
+        self.assertEqual(list(self._log.query(tail=0)), [])
+
+    def test_index_skips_segments(self):
+        segments = self._log.segments()
+        self.assertGreater(len(segments), 3)
+
+        with mock.patch("history._read_segment_at", wraps=history._read_segment_at) as reader:
+            list(self._log.query(email="bob@pavilion.io", since="2024-01-06"))
+
+        read = [call.args[0] for call in reader.call_args_list]
+        self.assertEqual(segments[0] in read, False)
+        self.assertEqual(segments[-1] in read, True)
+
+    def test_resource_filter(self):
+        event = {"Time": "2024-01-07 10:00:00", "Email": "carol@pavilion.io", "Action": "Exclusive lock",
+                 "Resource": "slot3/drive2"}
+        self._log.append([event])
+        segments = self._log.segments()
+
+        with mock.patch("history._read_segment_at", wraps=history._read_segment_at) as reader:
+            self.assertEqual(list(self._log.query(resource="slot3")), [event])
+            self.assertEqual(list(self._log.query(resource="slot3/drive2")), [event])
+            self.assertEqual(list(self._log.query(resource="slot3/drive20")), [])
+
+        read = [call.args[0] for call in reader.call_args_list]
+        self.assertEqual(segments[0] in read, False)
+
+    def test_missing_index_is_rebuilt(self):
+        for segment in self._log.segments()[:-1]:
+            os.remove(history._index_path(segment))
+
+        self.assertEqual(list(self._log.query(email="bob@pavilion.io")), self._events[30:])
+        self.assertEqual(os.path.exists(history._index_path(self._log.segments()[0])), True)
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,204 @@
+"""
+******************************
+******* Interval Tree ********
+******************************
+"""
+
+
+class _Node:
+    __slots__ = ("start", "end", "key", "value", "max_end", "height", "left", "right")
+
+    def __init__(self, start, end, key, value):
+        self.start = start
+        self.end = end
+        self.key = key
+        self.value = value
+        self.max_end = end
+        self.height = 1
+        self.left = None
+        self.right = None
+
+    def order(self):
+        return self.start, self.key
+
+
+def _height(node):
+    return node.height if node is not None else 0
+
+
+def _update(node):
+    node.height = 1 + max(_height(node.left), _height(node.right))
+    node.max_end = node.end
+
+    for child in (node.left, node.right):
+        if child is not None and child.max_end > node.max_end:
+            node.max_end = child.max_end
+
+    return node
+
+
+def _rotate_right(node):
+    top = node.left
+    node.left = top.right
+    top.right = _update(node)
+    return _update(top)
+
+
+def _rotate_left(node):
+    top = node.right
+    node.right = top.left
+    top.left = _update(node)
+    return _update(top)
+
+
+def _balance(node):
+    _update(node)
+    skew = _height(node.left) - _height(node.right)
+
+    if skew > 1:
+        if _height(node.left.left) < _height(node.left.right):
+            node.left = _rotate_left(node.left)
+        return _rotate_right(node)
+
+    if skew < -1:
+        if _height(node.right.right) < _height(node.right.left):
+            node.right = _rotate_right(node.right)
+        return _rotate_left(node)
+
+    return node
+
+
+def _insert(node, new):
+    if node is None:
+        return new
+
+    if new.order() < node.order():
+        node.left = _insert(node.left, new)
+    else:
+        node.right = _insert(node.right, new)
+
+    return _balance(node)
+
+
+def _pop_min(node):
+    # The smallest node and what is left of the subtree without it
+    if node.left is None:
+        return node, node.right
+
+    smallest, node.left = _pop_min(node.left)
+    return smallest, _balance(node)
+
+
+def _remove(node, order, removed):
+    if node is None:
+        return None
+
+    if order < node.order():
+        node.left = _remove(node.left, order, removed)
+    elif order > node.order():
+        node.right = _remove(node.right, order, removed)
+    else:
+        removed.append(node)
+
+        if node.left is None or node.right is None:
+            return node.left or node.right
+
+        successor, node.right = _pop_min(node.right)
+        successor.left = node.left
+        successor.right = node.right
+        node = successor
+
+    return _balance(node)
+
+
+def _overlapping(node, start, end):
+    # Every subtree ending at or before start is skipped whole, and nothing
+    # right of a node starting at or after end can overlap either.
+    if node is None or node.max_end <= start:
+        return
+
+    yield from _overlapping(node.left, start, end)
+
+    if node.start >= end:
+        return
+
+    if node.end > start:
+        yield node.start, node.end, node.value
+
+    yield from _overlapping(node.right, start, end)
+
+
+def _starting_before(node, time):
+    if node is None:
+        return
+
+    yield from _starting_before(node.left, time)
+
+    if node.start > time:
+        return
+
+    yield node.start, node.end, node.value
+    yield from _starting_before(node.right, time)
+
+
+class IntervalTree:
+    # Half open intervals [start, end) in an AVL tree ordered by their start,
+    # every node also knows the latest end below it. Overlap queries cost
+    # O(log n + matches), inserts and removals O(log n).
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return _starting_before(self._root, float("inf"))
+
+    def insert(self, start, end, key, value):
+        # The key tells intervals with the same start apart
+        self._root = _insert(self._root, _Node(start, end, key, value))
+        self._size += 1
+
+    def remove(self, start, key):
+        removed = []
+        self._root = _remove(self._root, (start, key), removed)
+
+        if not removed:
+            return None
+
+        self._size -= 1
+        return removed[0].value
+
+    def overlapping(self, start, end):
+        return _overlapping(self._root, start, end)
+
+    def starting_before(self, time):
+        return _starting_before(self._root, time)
+
+    def first(self):
+        node = self._root
+
+        if node is None:
+            return None
+
+        while node.left is not None:
+            node = node.left
+
+        return node.start, node.end, node.value
+
+    def next_free(self, after, duration, conflicts=None):
+        # The earliest window of this length at or after after that overlaps
+        # no conflicting interval. Every step jumps past the conflicts of the
+        # current candidate, so the intervals in between are never walked
+        # one by one unless they chain into each other.
+        start = after
+
+        while True:
+            blocking = [end for s, end, value in self.overlapping(start, start + duration)
+                        if conflicts is None or conflicts(value)]
+
+            if not blocking:
+                return start
+
+            start = max(blocking)
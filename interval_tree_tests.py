@@ -0,0 +1,59 @@
+import unittest
+import interval_tree
+import random
+
+
+def _height(node):
+    if node is None:
+        return 0
+
+    left = _height(node.left)
+    right = _height(node.right)
+    assert abs(left - right) <= 1
+    assert node.max_end == max([node.end] + [child.max_end for child in (node.left, node.right) if child])
+    return 1 + max(left, right)
+
+
+class IntervalTreeTest(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rnd = random.Random(7)
+        tree = interval_tree.IntervalTree()
+        intervals = {}
+
+        for key in range(2000):
+            start = rnd.randrange(100000)
+            intervals[key] = (start, start + rnd.randrange(1, 500))
+            tree.insert(intervals[key][0], intervals[key][1], key, key)
+
+        for key in rnd.sample(sorted(intervals), 700):
+            self.assertEqual(tree.remove(intervals[key][0], key), key)
+            del intervals[key]
+
+        self.assertEqual(tree.remove(0, -1), None)
+        self.assertEqual(len(tree), 1300)
+        self.assertLessEqual(_height(tree._root), 16)
+
+        for _ in range(200):
+            start = rnd.randrange(100000)
+            end = start + rnd.randrange(1, 2000)
+            expected = sorted(key for key, (s, e) in intervals.items() if s < end and e > start)
+            self.assertEqual(sorted(value for s, e, value in tree.overlapping(start, end)), expected)
+
+        self.assertEqual([s for s, e, value in tree], sorted(s for s, e in intervals.values()))
+        self.assertEqual(tree.first()[0], min(s for s, e in intervals.values()))
+
+    def test_next_free(self):
+        tree = interval_tree.IntervalTree()
+
+        for key, (start, end, kind) in enumerate([(10, 20, "x"), (20, 30, "s"), (25, 40, "s"), (50, 60, "x")]):
+            tree.insert(start, end, key, kind)
+
+        self.assertEqual(tree.next_free(0, 10), 0)
+        self.assertEqual(tree.next_free(0, 11), 60)
+        self.assertEqual(tree.next_free(5, 10), 40)
+        self.assertEqual(tree.next_free(0, 15, lambda kind: kind == "x"), 20)
+        self.assertEqual(list(tree.starting_before(20)), [(10, 20, "x"), (20, 30, "s")])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
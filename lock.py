@@ -1,12 +1,18 @@
+import fcntl
 import json
-import smtplib
-import ssl
+import os
 import pathlib
+import history
+import interval_tree
+import timing
+import uuid
 
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum, auto
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 """
 ******************************
@@ -15,23 +21,33 @@ from datetime import datetime
 """
 lock_file_path = str(pathlib.Path(__file__).parent.absolute())
 lock_file_name = "/.chm_lock.json"
+guard_file_name = "/.chm_lock.guard"
+history_dir_name = "/.chm_history"
 max_history = 50
 
+# A waiter gains one priority level for every aging_interval seconds it has
+# been queued, so a low priority waiter is not starved forever.
+aging_interval = 600
+
+# A reservation whose window opens while the lock is held is queued ahead
+# of every waiter without one.
+reservation_priority = 1000
+
 ErrNotAvailable = "Lock not available"
 ErrOnlySharedAllowed = "Only Shared lock allowed"
 ErrInternal = "Internal error"
 ErrAlreadyOwner = "User already owns the lock"
 ErrNotAnOwner = "User is not an owner"
+ErrTimeout = "Timed out waiting for the lock"
+ErrCancelled = "Stopped waiting for the lock"
+ErrNoLease = "Lock has no lease to renew"
+ErrReserved = "Chassis is reserved at that time"
+ErrNoReservation = "No such reservation"
+ErrInvalidWindow = "Reservation has to end in the future and after it starts"
+ErrQueued = "Lock not available, queued for it, you are emailed once it is yours"
 
-"""
-******************************
-******* SMTP configurations **
-******************************
-"""
-port = 465
-smtp_server = "smtp.gmail.com"
-sender_email = "x.y@pavilion.io"
-password = "xyz"
+# The error constant names are the denial reasons in the metrics
+_error_names = {value: name for name, value in list(globals().items()) if name.startswith("Err")}
 
 """
 ******************************
@@ -57,6 +73,102 @@ class InvalidLock(Exception):
     pass
 
 
+"""
+******************************
+******* Records **************
+******************************
+"""
+
+
+class _Record:
+    # Owners and waiters are kept as slotted records instead of one dict
+    # each. They still read like the dicts stored in the lock file, and keys
+    # this version does not know are carried along untouched.
+    __slots__ = ("_extra",)
+    _keys = ()
+
+    def __init__(self, data=None):
+        self._extra = None
+
+        for key in self._keys:
+            setattr(self, key, None)
+
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        for key, value in data.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._keys:
+            setattr(self, key, value)
+            return
+
+        if self._extra is None:
+            self._extra = {}
+
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            value = getattr(self, key)
+        else:
+            value = (self._extra or {}).get(key)
+
+        return default if value is None else value
+
+    def to_dict(self):
+        data = {key: getattr(self, key) for key in self._keys if getattr(self, key) is not None}
+        data.update(self._extra or {})
+        return data
+
+    def __eq__(self, other):
+        if isinstance(other, _Record):
+            other = other.to_dict()
+
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"{type(self).__name__!s}({self.to_dict()!r})"
+
+
+class Owner(_Record):
+    __slots__ = _keys = ("Name", "Email", "Since", "Ttl", "Expires")
+
+
+class Waiter(_Record):
+    __slots__ = _keys = ("Email", "Notify", "Name", "Type", "Priority", "Time", "Wait", "Host", "Pid", "Ttl",
+                         "Until", "Queue")
+
+
+class Reservation(_Record):
+    __slots__ = _keys = ("Id", "Name", "Email", "Type", "From", "To")
+
+
+def _index_records(records, record_type):
+    # Keyed by email, in the order they are stored. A duplicate email in an
+    # old lock file keeps its first place.
+    index = OrderedDict()
+
+    for a_record in records:
+        if a_record['Email'] not in index:
+            index[a_record['Email']] = record_type(a_record)
+
+    return index
+
+
 """
 ******************************
 ******* Utility Functions ****
@@ -112,18 +224,238 @@ def _get_lock_file_path():
     return lock_file_path + lock_file_name
 
 
-def _send_email(receiver_email, message):
+def _get_history_dir_path():
+    return lock_file_path + history_dir_name
+
+
+def _get_guard_file_path():
+    return lock_file_path + guard_file_name
+
+
+def _acquire_writer_guard():
+    # The lock file itself is replaced by rename on every write, so writers
+    # serialize on a separate guard file that is never replaced. Readers do
+    # not take the guard, a rename always leaves them a complete file.
+    guard_fd = os.open(_get_guard_file_path(), os.O_RDWR | os.O_CREAT, 0o666)
+
+    try:
+        with timing.span("lock.guard"):
+            fcntl.flock(guard_fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(guard_fd)
+        raise
+
+    return guard_fd
+
+
+def _release_writer_guard(guard_fd):
+    try:
+        fcntl.flock(guard_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(guard_fd)
+
+
+def _file_stamp(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _lock_file_stamp():
     try:
-        context = ssl.create_default_context()
+        return _file_stamp(os.stat(_get_lock_file_path()))
+    except FileNotFoundError:
+        return None
+
+
+def _write_lock_file(data):
+    with timing.span("lock.write"):
+        return _replace_lock_file(data)
 
-        with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-            server.login(sender_email, password)
-            server.sendmail(sender_email, receiver_email, message)
-            return True
 
-    except Exception as e:
+def _replace_lock_file(data):
+    # Write to a temp file in the same directory and rename it over the lock
+    # file, so a crash never leaves a half written lock behind. tempfile is
+    # imported here, read only commands never write.
+    import tempfile
+
+    file_path = _get_lock_file_path()
+    fd, tmp_path = tempfile.mkstemp(prefix=".chm_lock.", suffix=".tmp", dir=os.path.dirname(file_path))
+
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(data, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+            stamp = _file_stamp(os.fstat(tmp_file.fileno()))
+
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    try:
+        dir_fd = os.open(os.path.dirname(file_path), os.O_RDONLY)
+    except OSError:
+        return stamp
+
+    try:
+        os.fsync(dir_fd)
+    except OSError:
         pass
-    return False
+    finally:
+        os.close(dir_fd)
+
+    return stamp
+
+
+class FileLockStore:
+    # One chassis per install, its lock in .chm_lock.json next to the scripts.
+    # The paths are looked up on every call, tests point them elsewhere.
+    def acquire(self):
+        return _acquire_writer_guard()
+
+    def release(self, guard):
+        _release_writer_guard(guard)
+
+    def stamp(self):
+        return _lock_file_stamp()
+
+    def load(self):
+        if not _lock_file_exist():
+            return None, None
+
+        with timing.span("lock.load"), open(_get_lock_file_path()) as lock_file:
+            return json.load(lock_file), _file_stamp(os.fstat(lock_file.fileno()))
+
+    def write(self, data):
+        return _write_lock_file(data)
+
+    def history_dir(self):
+        return _get_history_dir_path()
+
+    def watch_path(self):
+        return _get_lock_file_path()
+
+
+def _resource_path(resource):
+    # slot3, slot3/drive2, ... below the chassis, which is the empty path
+    parts = resource.strip().strip("/").split("/")
+
+    if any(part.strip() in ["", ".", ".."] for part in parts):
+        raise InvalidLock(f"Invalid resource '{resource!s}'")
+
+    return "/".join(part.strip() for part in parts)
+
+
+def _ancestors(path):
+    # The chassis first, then every resource down to the parent of path
+    parts = path.split("/")
+    return ["/".join(parts[:i]) for i in range(len(parts))]
+
+
+def _index_resources(data):
+    # Resource locks by path, and for every path the number of shared and
+    # exclusive resource locks somewhere below it. The counts stand in for
+    # the intention locks (IS/IX), a conflict check walks only the ancestors
+    # of the requested resource instead of every lock on the chassis.
+    resources = OrderedDict()
+    below = {}
+
+    for path, entry in data.items():
+        resources[path] = {"Type": entry["Type"], "Owners": _index_records(entry.get("Owners", []), Owner)}
+        _count_below(below, path, _lock_name_to_type(entry["Type"]), 1)
+
+    return resources, below
+
+
+def _count_below(below, path, lock_type, delta):
+    for ancestor in _ancestors(path):
+        below.setdefault(ancestor, [0, 0])[0 if lock_type == LockType.SHARED else 1] += delta
+
+
+def _timestamp(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+def _index_reservations(records):
+    # Keyed by id, and on the calendar by their window
+    reservations = OrderedDict()
+    calendar = interval_tree.IntervalTree()
+
+    for a_record in records:
+        reservation = reservations[a_record['Id']] = Reservation(a_record)
+        calendar.insert(_timestamp(reservation['From']), _timestamp(reservation['To']), reservation['Id'],
+                        reservation)
+
+    return reservations, calendar
+
+
+def _conflicts_with(lock_type, email=None):
+    # Shared reservations of different people may overlap, anything else
+    # may not.
+    def conflicts(reservation):
+        return (reservation['Email'] == email or lock_type == LockType.EXCLUSIVE
+                or reservation['Type'] == _lock_type_to_name(LockType.EXCLUSIVE))
+
+    return conflicts
+
+
+def _window(reservation):
+    return {"Reservation": reservation['Id'], "From": reservation['From'], "To": reservation['To']}
+
+
+def _print_owners(owners, indent=""):
+    now = datetime.now()
+
+    for a_email, a_owner in owners.items():
+        if _lease_expired(a_owner, now):
+            print(f"{indent!s}{a_email!s} (lease expired at {a_owner['Expires'][:19]!s})")
+        elif a_owner.get('Expires'):
+            print(f"{indent!s}{a_email!s} (lease until {a_owner['Expires'][:19]!s})")
+        else:
+            print(f"{indent!s}{a_email!s}")
+
+
+def _process_alive(host, pid):
+    if host != os.uname().nodename or pid is None:
+        # Can not tell for a waiter on another host, keep it
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _lease_expiry(ttl, now=None):
+    return str((now or datetime.now()) + timedelta(seconds=ttl))
+
+
+def _lease_expired(owner, now):
+    return owner.get('Expires') is not None and datetime.fromisoformat(owner['Expires']) <= now
+
+
+def _queued(waiter):
+    # A waiter that blocks until it gets the lock, one that queued for it
+    # and left, or an open reservation is handed the lock. The others only
+    # asked to be told the chassis is free.
+    return bool(waiter.get('Type') and (waiter.get('Wait') or waiter.get('Queue') or waiter.get('Until')))
+
+
+def _waiter_rank(waiter, position, now):
+    priority = waiter.get('Priority', 0)
+
+    if aging_interval and waiter.get('Time'):
+        waited = (now - datetime.fromisoformat(waiter['Time'])).total_seconds()
+        priority += max(0.0, waited) / aging_interval
+
+    return -priority, position
 
 
 """
@@ -134,19 +466,63 @@ def _send_email(receiver_email, message):
 
 
 class Lock:
-    def __init__(self, data=None):
-        self._lock_data = data
+    def __init__(self, data=None, history_log=None, metrics=None, store=None):
+        self._lock_data = None
+        self._owners = OrderedDict()
+        self._waiters = OrderedDict()
+        self._txn_depth = 0
+        self._txn_dirty = False
+        self._txn_guard = None
+        self._stamp = None
+        self._store = store or FileLockStore()
+        self._history_log = history_log or history.HistoryLog(self._store.history_dir())
+        self._pending_history = []
+        self._legacy_history = []
+        self._granted = []
+        self._metrics = metrics
+        self._resources = OrderedDict()
+        self._below = {}
+        self._reservations = OrderedDict()
+        self._calendar = interval_tree.IntervalTree()
 
         if data is None:
             self.load_lock()
+        else:
+            self._set_state(data)
 
     def _fresh_lock(self):
-        self._lock_data = {
+        self._set_state({
             "Type": "FREE",
             "Owners": [],
-            "Waiters": [],
-            "History": []
-        }
+            "Waiters": []
+        })
+
+    def _set_state(self, data):
+        # The dict handed to Lock(data) stays the caller's
+        data = dict(data)
+        self._owners = _index_records(data.pop("Owners", []), Owner)
+        self._waiters = _index_records(data.pop("Waiters", []), Waiter)
+        self._legacy_history = data.pop("History", [])
+        self._resources, self._below = _index_resources(data.pop("Resources", {}))
+        self._reservations, self._calendar = _index_reservations(data.pop("Reservations", []))
+        self._lock_data = data
+
+    def _state(self):
+        # The on disk layout stays the same, owners and waiters as lists in
+        # the order they came in.
+        data = dict(self._lock_data)
+        data["Owners"] = [a_owner.to_dict() for a_owner in self._owners.values()]
+        data["Waiters"] = [a_waiter.to_dict() for a_waiter in self._waiters.values()]
+
+        if self._resources:
+            data["Resources"] = {path: {"Type": entry["Type"],
+                                        "Owners": [a_owner.to_dict() for a_owner in entry["Owners"].values()]}
+                                 for path, entry in self._resources.items()}
+
+        if self._reservations:
+            data["Reservations"] = [a_reservation.to_dict() for a_reservation in self._reservations.values()]
+
+        return data
 
     def type(self):
         return _lock_name_to_type(self._lock_data["Type"])
@@ -154,122 +530,566 @@ class Lock:
     def lock_name(self):
         return self._lock_data["Type"]
 
-    def owners(self):
-        return self._lock_data["Owners"]
+    # owners() and waiters() return new lists. Adding or removing entries
+    # there does not change the lock, use add_lock_owner, remove_lock_owner,
+    # add_to_waiting_queue and remove_waiter. The records in them are the
+    # lock's own and are written by the next save_lock().
+    def owners(self, resource=None):
+        if resource is None:
+            return list(self._owners.values())
+
+        entry = self._resources.get(_resource_path(resource))
+        return list(entry["Owners"].values()) if entry is not None else []
+
+    def resources(self):
+        # Every locked resource with its lock type and owners
+        return {path: (_lock_name_to_type(entry["Type"]), list(entry["Owners"].values()))
+                for path, entry in self._resources.items()}
+
+    def _all_owners(self):
+        yield from self._owners.values()
+
+        for entry in self._resources.values():
+            yield from entry["Owners"].values()
 
     def waiters(self):
-        return self._lock_data["Waiters"]
+        return list(self._waiters.values())
 
     def history(self):
-        return self._lock_data["History"]
+        events = self._legacy_history + self._history_log.tail(max_history) + self._pending_history
+        return events[-max_history:]
+
+    def history_log(self):
+        return self._history_log
 
     def change_lock_type(self, lock_type):
         self._lock_data["Type"] = _lock_type_to_name(lock_type)
         self.save_lock()
 
-    def add_lock_owner(self, owner_name, owner_email):
-        owners = self.owners()
-        owners.append({
-            "Name": owner_name,
-            "Email": owner_email
-        })
+    def add_lock_owner(self, owner_name, owner_email, ttl=None):
+        if owner_email in self._owners:
+            self._owners[owner_email]['Name'] = owner_name
+        else:
+            self._owners[owner_email] = Owner({
+                "Name": owner_name,
+                "Email": owner_email,
+                "Since": str(datetime.now())
+            })
+
+        # A lease is released by the reaper unless it is renewed in time
+        if ttl:
+            self._owners[owner_email].update({
+                "Ttl": ttl,
+                "Expires": _lease_expiry(ttl)
+            })
+
         self.save_lock()
 
-    def print_owners(self):
-        owners = self.owners()
+    def print_owners(self, resource=None):
+        if resource is not None:
+            path = _resource_path(resource)
+            entry = self._resources.get(path)
+
+            if entry is None:
+                print(f"{path!s} is free")
+                return
+
+            print(f"{path!s} ({entry['Type'].lower()!s})")
+            _print_owners(entry["Owners"], "  ")
+            return
 
-        if not owners:
+        if not self._owners and not self._resources:
             print("Lock is free")
             return
 
-        for a_owner in owners:
-            print(f"{a_owner['Email']!s}")
+        _print_owners(self._owners)
+
+        for path, entry in self._resources.items():
+            print(f"{path!s} ({entry['Type'].lower()!s})")
+            _print_owners(entry["Owners"], "  ")
 
     def remove_lock_owner(self, owner_email):
-        owners = self.owners()
+        self._owners.pop(owner_email, None)
+        self.save_lock()
 
-        for a_owner in owners:
-            if a_owner['Email'] == owner_email:
-                owners.remove(a_owner)
+    def is_lock_owner(self, email):
+        return email in self._owners
+
+    def is_waiting(self, email):
+        return email in self._waiters
+
+    def add_to_waiting_queue(self, email, notify, lock_name=None, wait=False, name=None, priority=0, ttl=None,
+                             queue=False):
+        with self.transaction():
+            waiter = Waiter({
+                "Email": email,
+                "Notify": notify
+            })
+
+            # A waiter that names its lock type is granted the lock as soon as
+            # it is its turn, the others are only told the chassis is free.
+            if lock_name is not None:
+                waiter.update({
+                    "Name": name or email,
+                    "Type": _lock_type_to_name(_lock_name_to_type(lock_name)),
+                    "Priority": priority or 0,
+                    "Time": str(datetime.now()),
+                    "Ttl": ttl
+                })
+
+            # A blocking waiter is dropped again if its process goes away
+            # without cleaning up.
+            if wait:
+                waiter.update({
+                    "Wait": True,
+                    "Host": os.uname().nodename,
+                    "Pid": os.getpid()
+                })
+
+            if queue:
+                waiter["Queue"] = True
+
+            if email in self._waiters:
+                # Asking again updates the request but keeps the place in the
+                # queue and the time it has waited so far.
+                queued = self._waiters[email]
+                waiter['Time'] = queued.get('Time', waiter.get('Time'))
+                queued.update(waiter.to_dict())
+            else:
+                self._waiters[email] = waiter
+
+            self.save_lock()
+
+    def remove_waiter(self, email):
+        with self.transaction():
+            if self._drop_waiter(email):
+                # The head of the queue may have left, the next ones could be
+                # able to take the lock now.
+                self._schedule()
+
+    def _drop_waiter(self, email):
+        if self._waiters.pop(email, None) is None:
+            return False
 
         self.save_lock()
+        return True
 
-    def is_lock_owner(self, email):
-        owners = self.owners()
+    def _prune_dead_waiters(self):
+        dead = [a_email for a_email, a_waiter in self._waiters.items()
+                if a_waiter.get('Wait') and not _process_alive(a_waiter.get('Host'), a_waiter.get('Pid'))]
 
-        for a_owner in owners:
-            if a_owner['Email'] == email:
-                return True
+        for a_email in dead:
+            del self._waiters[a_email]
 
-        return False
+        if dead:
+            self.save_lock()
 
-    def add_to_waiting_queue(self, email, notify):
-        waiters = self.waiters()
-        waiters.append({
-            "Email": email,
-            "Notify": notify
-        })
-        self.save_lock()
+    def queue(self):
+        # Waiters in the order they are granted the lock, highest effective
+        # priority first and queue order among equals.
+        now = datetime.now()
+        queued = [(position, a_waiter) for position, a_waiter in enumerate(self._waiters.values()) if _queued(a_waiter)]
+        queued.sort(key=lambda item: _waiter_rank(item[1], item[0], now))
+        return [a_waiter for position, a_waiter in queued]
+
+    def _next_batch(self):
+        queue = self.queue()
+
+        if not queue:
+            return []
+
+        # Consecutive shared waiters are all served in the same step
+        batch = [queue[0]]
+
+        if queue[0]['Type'] == _lock_type_to_name(LockType.SHARED):
+            for a_waiter in queue[1:]:
+                if a_waiter['Type'] != _lock_type_to_name(LockType.SHARED):
+                    break
+
+                batch.append(a_waiter)
 
-    def add_history(self, email, action):
-        history = self.history()
+        return batch
 
-        if len(history) == max_history:
-            history.pop(0)
+    def _is_next_waiter(self, email):
+        self._prune_dead_waiters()
+        batch = self._next_batch()
 
-        history.append({
+        return not batch or any(a_waiter['Email'] == email for a_waiter in batch)
+
+    def _schedule(self):
+        self._prune_dead_waiters()
+
+        for a_waiter in self._next_batch():
+            lock_type = _lock_name_to_type(a_waiter['Type'])
+            current_lck_type = self.type()
+            ttl = a_waiter.get('Ttl')
+
+            if a_waiter.get('Until'):
+                # Queued by a reservation, the lease ends with its window
+                ttl = _timestamp(a_waiter['Until']) - datetime.now().timestamp()
+
+                if ttl <= 0:
+                    self._drop_waiter(a_waiter['Email'])
+                    continue
+
+            if current_lck_type == LockType.EXCLUSIVE:
+                break
+
+            if current_lck_type == LockType.SHARED and lock_type != LockType.SHARED:
+                break
+
+            # Still held on a slot or a drive, the chassis waits for them
+            if self._blocked_below("", lock_type):
+                break
+
+            # A reservation of somebody else is about to be turned into a lock
+            if self._capped_ttl(lock_type, a_waiter['Email'], ttl) == 0:
+                break
+
+            self._grant(lock_type, a_waiter.get('Name', a_waiter['Email']), a_waiter['Email'], ttl)
+            self._granted.append(a_waiter)
+
+    def granted(self):
+        # Waiters that were handed the lock by the last unlock
+        return self._granted
+
+    def add_history(self, email, action, resource=None, details=None):
+        record = {
             "Time": str(datetime.now()),
             "Email": email,
             "Action": action
-        })
-        self.save_lock()
+        }
 
-    def print_history(self):
-        history = self.history()
+        if resource is not None:
+            record["Resource"] = resource
 
-        if not history:
-            print("No history available")
+        if details:
+            record.update(details)
+
+        self._pending_history.append(record)
+
+        if not self._txn_depth:
+            self._flush_history()
+
+    def _flush_history(self):
+        # History used to live inside the lock file, move it to the log the
+        # first time this lock is written by a newer version.
+        if self._legacy_history:
+            if self._history_log.is_empty():
+                self._history_log.append(self._legacy_history)
+            self._legacy_history = []
+
+        pending, self._pending_history = self._pending_history, []
+        self._history_log.append(pending)
+
+    def _count(self, name, labels=None):
+        if self._metrics is not None:
+            self._metrics.inc(name, labels)
+
+    def _released(self, owner, lock_type, counter, now=None):
+        if self._metrics is None:
+            return
+
+        labels = {"type": _lock_type_to_name(lock_type).lower()}
+        self._metrics.inc(counter, labels)
+
+        # Owners written by an older version do not know since when
+        since = owner.get('Since')
+
+        if since is not None:
+            held = ((now or datetime.now()) - datetime.fromisoformat(since)).total_seconds()
+            self._metrics.observe("chm_lock_held_seconds", max(held, 0.0), labels)
+
+    def _flush_metrics(self):
+        if self._metrics is None:
             return
 
-        for event in history:
-            print(f"{event['Time']!s} \t {event['Email']!s} --> {event['Action']!s}")
+        self._metrics.set("chm_lock_queue_depth", len(self._waiters))
+        self._metrics.set("chm_lock_owners", len(self._owners))
+
+        for lock_type in LockType:
+            self._metrics.set("chm_lock_state", int(lock_type == self.type()),
+                              {"type": _lock_type_to_name(lock_type).lower()})
+
+        self._metrics.commit()
+
+    def query_history(self, email=None, action=None, since=None, until=None, limit=None, tail=None, resource=None):
+        if resource is not None:
+            resource = _resource_path(resource)
+
+        if self._legacy_history and self._history_log.is_empty():
+            events = list(history.filter_records(self._legacy_history, email, action, since, until, resource))
+
+            if tail is not None:
+                events = events[-tail:] if tail else []
+
+            return iter(events[:limit])
+
+        return self._history_log.query(email, action, since, until, limit, tail, resource)
+
+    def print_history(self, email=None, action=None, since=None, until=None, limit=None, tail=None, resource=None):
+        if limit is None and tail is None:
+            tail = max_history
+
+        printed = False
+
+        for event in self.query_history(email, action, since, until, limit, tail, resource):
+            if event.get('Resource'):
+                print(f"{event['Time']!s} \t {event['Email']!s} --> {event['Action']!s} [{event['Resource']!s}]")
+            else:
+                print(f"{event['Time']!s} \t {event['Email']!s} --> {event['Action']!s}")
+            printed = True
+
+        if not printed:
+            print("No history available")
+
+    @contextmanager
+    def transaction(self):
+        if self._txn_depth == 0:
+            self._txn_guard = self._store.acquire()
+
+            # Another process may have changed the lock since we loaded it,
+            # the whole read-modify-write has to happen under the guard.
+            self.refresh()
+
+        self._txn_depth += 1
+
+        try:
+            yield self
+        except BaseException:
+            self._txn_depth -= 1
+            if self._txn_depth == 0:
+                self._end_transaction(False)
+            raise
+
+        self._txn_depth -= 1
+
+        if self._txn_depth == 0:
+            self._end_transaction(True)
+
+    def _end_transaction(self, commit):
+        try:
+            if commit and (self._txn_dirty or self._legacy_history):
+                self._stamp = self._store.write(self._state())
+
+            # The lock state is the source of truth, history is appended only
+            # after it is durable.
+            if commit:
+                self._flush_history()
+                self._flush_metrics()
+        finally:
+            self._txn_dirty = False
+            self._pending_history = []
+            guard, self._txn_guard = self._txn_guard, None
+            self._store.release(guard)
 
     def save_lock(self):
-        with open(_get_lock_file_path(), "w") as lock_file:
-            json.dump(self._lock_data, lock_file)
+        if self._txn_depth:
+            self._txn_dirty = True
+            return
+
+        guard = self._store.acquire()
+
+        try:
+            self._stamp = self._store.write(self._state())
+
+            if self._legacy_history:
+                self._flush_history()
+        finally:
+            self._store.release(guard)
 
     def load_lock(self):
-        if not _lock_file_exist():
+        data, self._stamp = self._store.load()
+
+        if data is None:
             self._fresh_lock()
-            return
+        else:
+            self._set_state(data)
 
-        with open(_get_lock_file_path()) as lock_file:
-            self._lock_data = json.load(lock_file)
+    def refresh(self):
+        # Reload only when the lock was written since we last read or wrote
+        # it, a long lived Lock then costs one stat per operation.
+        if self._store.stamp() != self._stamp:
+            self.load_lock()
 
-    def notify_waiters(self, msg):
-        notified = 0
-        waiters = self.waiters()
+    def watch_path(self):
+        # The file that changes on every write, for waiters to watch
+        return self._store.watch_path()
 
-        for a_waiter in waiters:
-            #if _send_email(a_waiter['Email'], msg):
-            #    notified += 1
-            waiters.remove(a_waiter)
+    def notify_granted(self, msg, notifier=None):
+        # Blocking waiters are already watching the lock file
+        recipients = [a_waiter['Email'] for a_waiter in self._granted
+                      if a_waiter.get('Notify') and not a_waiter.get('Wait')]
 
-        self.save_lock()
-        return notified
+        if notifier is None or not recipients:
+            return 0
+
+        return notifier.post(recipients, msg)
+
+    def notify_waiters(self, msg, notifier=None):
+        with self.transaction():
+            # Queued waiters stay, they are granted the lock in turn
+            leaving = [a_waiter for a_waiter in self._waiters.values() if not _queued(a_waiter)]
+
+            for a_waiter in leaving:
+                del self._waiters[a_waiter['Email']]
+
+            if leaving:
+                self.save_lock()
+
+        # Emails are queued after the lock is released and sent in the
+        # background, a slow mail server must not hold up anybody.
+        recipients = [a_waiter['Email'] for a_waiter in leaving if a_waiter.get('Notify')]
+
+        if notifier is None or not recipients:
+            return 0
+
+        return notifier.post(recipients, msg)
+
+    def lock(self, lock_name, owner_name, owner_email, quiet=False, ttl=None, resource=None):
+        with self.transaction():
+            if resource is None:
+                success, error = self._lock(lock_name, owner_name, owner_email, quiet, ttl)
+            else:
+                success, error = self._lock_resource(_resource_path(resource), lock_name, owner_name, owner_email,
+                                                     quiet, ttl)
+
+            # A blocked waiter retries quietly on every wake up, only the
+            # request itself counts as a denial.
+            if not success and not quiet:
+                self._count("chm_lock_denials_total", {"reason": _error_names.get(error, "ErrInternal")})
+
+            return success, error
+
+    def unlock(self, email, resource=None):
+        self._granted = []
+
+        with self.transaction():
+            if resource is None:
+                return self._unlock(email)
+
+            return self._unlock_resource(_resource_path(resource), email)
+
+    def _queried(self, owner_email, quiet, resource=None):
+        if not quiet:
+            self.add_history(owner_email, "Queried", resource)
+
+    def renew(self, email, ttl=None, resource=None):
+        with self.transaction():
+            owners = self._owners
+            lock_type = self.type()
+
+            if resource is not None:
+                entry = self._resources.get(_resource_path(resource))
+                owners = entry["Owners"] if entry is not None else {}
+                lock_type = _lock_name_to_type(entry["Type"]) if entry is not None else None
+
+            if email not in owners:
+                return False, ErrNotAnOwner
+
+            owner = owners[email]
+            ttl = ttl or owner.get('Ttl')
+
+            if not ttl:
+                return False, ErrNoLease
+
+            ttl = self._capped_ttl(lock_type, email, ttl)
+
+            if ttl <= 0:
+                return False, ErrReserved
+
+            # A heartbeat, only the lock file is written and no history
+            owner.update({
+                "Ttl": ttl,
+                "Expires": _lease_expiry(ttl)
+            })
+            self.save_lock()
+
+            return True, None
+
+    def has_expired(self, now=None):
+        now = now or datetime.now()
+        return any(_lease_expired(a_owner, now) for a_owner in self._all_owners())
+
+    def next_expiry(self, now=None):
+        # Seconds until the first lease runs out, None without leases
+        now = now or datetime.now()
+        expiries = [datetime.fromisoformat(a_owner['Expires']) for a_owner in self._all_owners()
+                    if a_owner.get('Expires')]
+
+        # The next reservation has to be turned into a lock in time as well
+        first = self._calendar.first()
+
+        if first is not None:
+            expiries.append(datetime.fromtimestamp(first[0]))
 
-    def lock(self, lock_name, owner_name, owner_email):
+        if not expiries:
+            return None
+
+        return max(0.0, (min(expiries) - now).total_seconds())
+
+    def reap_expired(self, now=None):
+        now = now or datetime.now()
+        self._granted = []
+
+        # Checked once without the guard, a live lease costs no write
+        if not self.has_expired(now) and not self._reservation_due(now):
+            return []
+
+        with self.transaction():
+            expired = [a_email for a_email, a_owner in self._owners.items() if _lease_expired(a_owner, now)]
+
+            for a_email in expired:
+                self._released(self._owners[a_email], self.type(), "chm_lock_expired_total", now)
+                self.remove_lock_owner(a_email)
+                self.add_history(a_email, "Expired")
+
+            if expired and not self._owners:
+                self.change_lock_type(LockType.FREE)
+
+            for path, entry in list(self._resources.items()):
+                for a_email in [a_email for a_email, a_owner in entry["Owners"].items() if _lease_expired(a_owner, now)]:
+                    self._release_resource(path, a_email, "chm_lock_expired_total", now)
+                    self.add_history(a_email, "Expired", path)
+                    expired.append(a_email)
+
+            # Leases end before the reservations that follow them start
+            activated = self._activate_reservations(now)
+
+            if expired or activated:
+                self._schedule()
+
+        return expired
+
+    def _grant(self, lock_type, owner_name, owner_email, ttl=None):
+        if self.type() == LockType.FREE:
+            self.change_lock_type(lock_type)
+
+        self.add_lock_owner(owner_name, owner_email, self._capped_ttl(lock_type, owner_email, ttl))
+        self._drop_waiter(owner_email)
+        self._count("chm_lock_acquires_total", {"type": _lock_type_to_name(self.type()).lower()})
+        self.add_history(owner_email, _lock_type_to_action(lock_type))
+
+    def _lock(self, lock_name, owner_name, owner_email, quiet=False, ttl=None):
         lock_type = _lock_name_to_type(lock_name)
         current_lck_type = self.type()
 
+        # A reservation of somebody else is open but not turned into a lock yet
+        if self._capped_ttl(lock_type, owner_email, ttl) == 0 and not self.is_lock_owner(owner_email):
+            self._queried(owner_email, quiet)
+            return False, ErrReserved
+
         if current_lck_type == LockType.FREE:
-            self.change_lock_type(lock_type)
-            self.add_lock_owner(owner_name, owner_email)
-            self.add_history(owner_email, _lock_type_to_action(lock_type))
+            # Whoever is queued is served first, in queue order
+            if not self._is_next_waiter(owner_email) or self._blocked_below("", lock_type):
+                self._queried(owner_email, quiet)
+                return False, ErrNotAvailable
+
+            self._grant(lock_type, owner_name, owner_email, ttl)
             return True, None
 
         if current_lck_type == LockType.EXCLUSIVE:
-            self.add_history(owner_email, "Queried")
+            self._queried(owner_email, quiet)
 
             if self.is_lock_owner(owner_email):
                 return False, ErrAlreadyOwner
@@ -278,21 +1098,23 @@ class Lock:
 
         if current_lck_type == LockType.SHARED and lock_type == LockType.SHARED:
             if self.is_lock_owner(owner_email):
-                self.add_history(owner_email, "Queried")
+                self._queried(owner_email, quiet)
                 return False, ErrAlreadyOwner
 
-            self.add_lock_owner(owner_name, owner_email)
-            self.add_history(owner_email, _lock_type_to_action(lock_type))
+            if not self._is_next_waiter(owner_email) or self._blocked_below("", lock_type):
+                self._queried(owner_email, quiet)
+                return False, ErrNotAvailable
 
+            self._grant(lock_type, owner_name, owner_email, ttl)
             return True, None
 
         if current_lck_type == LockType.SHARED and lock_type != LockType.SHARED:
-            self.add_history(owner_email, "Queried")
+            self._queried(owner_email, quiet)
             return False, ErrOnlySharedAllowed
 
         return False, ErrInternal
 
-    def unlock(self, email):
+    def _unlock(self, email):
         if not self.is_lock_owner(email):
             return False, ErrNotAnOwner
 
@@ -302,10 +1124,258 @@ class Lock:
         if current_lck_type == LockType.FREE:
             return True, None
 
+        self._released(self._owners[email], current_lck_type, "chm_lock_releases_total")
         self.remove_lock_owner(email)
 
-        if current_lck_type == LockType.SHARED and len(self.owners()):
-            return True, None
+        if current_lck_type == LockType.EXCLUSIVE or not self._owners:
+            self.change_lock_type(LockType.FREE)
 
-        self.change_lock_type(LockType.FREE)
+        # Hand the lock over in the same transaction, nobody can sneak in
+        # between the release and the grant.
+        self._schedule()
         return True, None
+
+    def _blocked_below(self, path, lock_type):
+        # An exclusive lock needs everything below it free, a shared one
+        # only needs no exclusive lock below it.
+        shared, exclusive = self._below.get(path, (0, 0))
+        return exclusive > 0 or (lock_type == LockType.EXCLUSIVE and shared > 0)
+
+    def _resource_conflict(self, path, lock_type):
+        # The chassis and every resource above path, then everything below it
+        for ancestor in _ancestors(path):
+            if ancestor == "":
+                held = self.type()
+            elif ancestor in self._resources:
+                held = _lock_name_to_type(self._resources[ancestor]["Type"])
+            else:
+                continue
+
+            if held == LockType.EXCLUSIVE or (held == LockType.SHARED and lock_type == LockType.EXCLUSIVE):
+                return True
+
+        return self._blocked_below(path, lock_type)
+
+    def _queue_conflict(self, lock_type):
+        # Whoever waits for the whole chassis is not starved by resource locks
+        batch = self._next_batch()
+
+        if not batch:
+            return False
+
+        return batch[0]['Type'] == _lock_type_to_name(LockType.EXCLUSIVE) or lock_type == LockType.EXCLUSIVE
+
+    def _lock_resource(self, path, lock_name, owner_name, owner_email, quiet=False, ttl=None):
+        lock_type = _lock_name_to_type(lock_name)
+        entry = self._resources.get(path)
+
+        if entry is not None:
+            current_lck_type = _lock_name_to_type(entry["Type"])
+
+            if owner_email in entry["Owners"]:
+                self._queried(owner_email, quiet, path)
+                return False, ErrAlreadyOwner
+
+            if current_lck_type == LockType.EXCLUSIVE:
+                self._queried(owner_email, quiet, path)
+                return False, ErrNotAvailable
+
+            if lock_type != LockType.SHARED:
+                self._queried(owner_email, quiet, path)
+                return False, ErrOnlySharedAllowed
+
+        # A chassis reservation of somebody else covers its resources too
+        ttl = self._capped_ttl(lock_type, owner_email, ttl)
+
+        if ttl == 0:
+            self._queried(owner_email, quiet, path)
+            return False, ErrReserved
+
+        self._prune_dead_waiters()
+
+        if self._resource_conflict(path, lock_type) or self._queue_conflict(lock_type):
+            self._queried(owner_email, quiet, path)
+            return False, ErrNotAvailable
+
+        if entry is None:
+            entry = self._resources[path] = {"Type": _lock_type_to_name(lock_type), "Owners": OrderedDict()}
+            _count_below(self._below, path, lock_type, 1)
+
+        entry["Owners"][owner_email] = Owner({
+            "Name": owner_name,
+            "Email": owner_email,
+            "Since": str(datetime.now())
+        })
+
+        if ttl:
+            entry["Owners"][owner_email].update({
+                "Ttl": ttl,
+                "Expires": _lease_expiry(ttl)
+            })
+
+        self.save_lock()
+        self._count("chm_lock_acquires_total", {"type": _lock_type_to_name(lock_type).lower()})
+        self.add_history(owner_email, _lock_type_to_action(lock_type), path)
+        return True, None
+
+    def _release_resource(self, path, email, counter, now=None):
+        entry = self._resources[path]
+        lock_type = _lock_name_to_type(entry["Type"])
+
+        self._released(entry["Owners"][email], lock_type, counter, now)
+        del entry["Owners"][email]
+
+        if not entry["Owners"]:
+            del self._resources[path]
+            _count_below(self._below, path, lock_type, -1)
+
+        self.save_lock()
+
+    def _unlock_resource(self, path, email):
+        entry = self._resources.get(path)
+
+        if entry is None or email not in entry["Owners"]:
+            return False, ErrNotAnOwner
+
+        self.add_history(email, _lock_type_to_action(LockType.FREE), path)
+        self._release_resource(path, email, "chm_lock_releases_total")
+
+        # The last lock below the chassis may unblock its queue
+        self._schedule()
+        return True, None
+
+    def reservations(self):
+        # In the order their windows start
+        return [a_reservation for start, end, a_reservation in self._calendar]
+
+    def print_reservations(self):
+        if not self._reservations:
+            print("No reservations")
+            return
+
+        for a_reservation in self.reservations():
+            print(f"{a_reservation['Id']!s} {a_reservation['From'][:16]!s} - {a_reservation['To'][:16]!s} "
+                  f"{a_reservation['Type']!s} {a_reservation['Email']!s}")
+
+    def reserve(self, lock_name, owner_name, owner_email, start, end):
+        lock_type = _lock_name_to_type(lock_name)
+
+        if end <= start or end <= datetime.now():
+            return False, ErrInvalidWindow, None
+
+        with self.transaction():
+            conflicts = _conflicts_with(lock_type, owner_email)
+
+            if any(conflicts(a_reservation) for s, e, a_reservation in
+                   self._calendar.overlapping(start.timestamp(), end.timestamp())):
+                return False, ErrReserved, None
+
+            reservation = Reservation({
+                "Id": uuid.uuid4().hex[:8],
+                "Name": owner_name,
+                "Email": owner_email,
+                "Type": _lock_type_to_name(lock_type),
+                "From": str(start),
+                "To": str(end)
+            })
+
+            self._reservations[reservation['Id']] = reservation
+            self._calendar.insert(start.timestamp(), end.timestamp(), reservation['Id'], reservation)
+            self.save_lock()
+            self.add_history(owner_email, "Reserved", details=_window(reservation))
+
+            return True, None, reservation['Id']
+
+    def cancel_reservation(self, email, reservation_id):
+        with self.transaction():
+            reservation = self._reservations.get(reservation_id)
+
+            if reservation is None or reservation['Email'] != email:
+                return False, ErrNoReservation
+
+            self._drop_reservation(reservation)
+            self.save_lock()
+            self.add_history(email, "Cancelled reservation", details=_window(reservation))
+
+            return True, None
+
+    def _drop_reservation(self, reservation):
+        del self._reservations[reservation['Id']]
+        self._calendar.remove(_timestamp(reservation['From']), reservation['Id'])
+
+    def next_free(self, lock_name, duration, after=None):
+        # The start of the first window of duration seconds nobody has
+        # reserved, None while the lock is held without a lease.
+        lock_type = _lock_name_to_type(lock_name)
+        start = max(after or datetime.now(), datetime.now())
+        current_lck_type = self.type()
+
+        if current_lck_type == LockType.EXCLUSIVE or (current_lck_type == LockType.SHARED
+                                                      and lock_type == LockType.EXCLUSIVE):
+            expiries = [a_owner.get('Expires') for a_owner in self._owners.values()]
+
+            if None in expiries:
+                return None
+
+            start = max([start] + [datetime.fromisoformat(expires) for expires in expiries])
+
+        free = self._calendar.next_free(start.timestamp(), duration, _conflicts_with(lock_type))
+        return datetime.fromtimestamp(free)
+
+    def _capped_ttl(self, lock_type, email, ttl):
+        # A lock ends before the next reservation of somebody else it would
+        # run into, so the reserved time is not lost waiting for it.
+        now = datetime.now().timestamp()
+        conflicts = _conflicts_with(lock_type)
+
+        for start, end, a_reservation in self._calendar.overlapping(now, float("inf")):
+            if a_reservation['Email'] != email and conflicts(a_reservation):
+                cap = max(0, int(start - now))
+                return cap if ttl is None else min(ttl, cap)
+
+        return ttl
+
+    def _reservation_due(self, now):
+        first = self._calendar.first()
+        return first is not None and first[0] <= now.timestamp()
+
+    def _activate_reservations(self, now):
+        activated = []
+
+        for start, end, a_reservation in list(self._calendar.starting_before(now.timestamp())):
+            self._drop_reservation(a_reservation)
+            self.save_lock()
+            email = a_reservation['Email']
+            lock_type = _lock_name_to_type(a_reservation['Type'])
+            ttl = int(end - now.timestamp())
+
+            if ttl <= 0:
+                self.add_history(email, "Missed reservation", details=_window(a_reservation))
+                continue
+
+            activated.append(a_reservation)
+            current_lck_type = self.type()
+
+            # An owner only keeps going if it already holds the reserved type,
+            # a shared owner with an exclusive reservation waits like anybody.
+            if (self.is_lock_owner(email) and current_lck_type == lock_type) or (
+                    not self._blocked_below("", lock_type) and (
+                        current_lck_type == LockType.FREE
+                        or (current_lck_type == LockType.SHARED and lock_type == LockType.SHARED))):
+                if self.is_lock_owner(email):
+                    self.add_lock_owner(a_reservation['Name'], email, ttl)
+                else:
+                    self._grant(lock_type, a_reservation['Name'], email, ttl)
+                    self._granted.append(Waiter({"Email": email, "Notify": True}))
+
+                # The lease ends with the window
+                self._owners[email]['Expires'] = a_reservation['To']
+                self.save_lock()
+            else:
+                # Still held, it is handed over first thing when released
+                self.add_to_waiting_queue(email, True, a_reservation['Type'], name=a_reservation['Name'],
+                                          priority=reservation_priority)
+                self._waiters[email]['Until'] = a_reservation['To']
+                self.save_lock()
+
+        return activated
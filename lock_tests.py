@@ -1,10 +1,28 @@
 import unittest
 import lock
 import os
+import json
+import multiprocessing
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
 
-class LockCreation(unittest.TestCase):
+class _LockTestCase(unittest.TestCase):
+    # The lock file and its history live in a directory of their own, never
+    # next to the installed scripts.
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._old_path = lock.lock_file_path
+        lock.lock_file_path = self._dir
+
+    def tearDown(self) -> None:
+        lock.lock_file_path = self._old_path
+        shutil.rmtree(self._dir)
 
+
+class LockCreation(_LockTestCase):
     def test_fresh_lock(self):
         lck = lock.Lock()
         self.assertEqual(lck.type(), lock.LockType.FREE)
@@ -13,13 +31,7 @@ class LockCreation(unittest.TestCase):
         self.assertEqual(lck.history(), [])
 
 
-class LockPersistenceTest(unittest.TestCase):
-    def setUp(self) -> None:
-        lock.lock_file_path = os.getcwd()
-
-    def tearDown(self) -> None:
-        os.remove(lock._get_lock_file_path())
-
+class LockPersistenceTest(_LockTestCase):
     def test_type_persistence(self):
         lck = lock.Lock()
         lck.change_lock_type(lock.LockType.EXCLUSIVE)
@@ -63,8 +75,25 @@ class LockPersistenceTest(unittest.TestCase):
         self.assertEqual(action["Action"], test_action)
 
 
-class MaxHistoryTest(unittest.TestCase):
+    def test_legacy_history_migration(self):
+        with open(lock._get_lock_file_path(), "w") as lock_file:
+            json.dump({"Type": "FREE", "Owners": [], "Waiters": [],
+                       "History": [{"Time": "2020-01-01 00:00:00", "Email": "old@pavilion.io", "Action": "Unlock"}]},
+                      lock_file)
+
+        lck = lock.Lock()
+        self.assertEqual(len(lck.history()), 1)
+
+        lck.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE), "ramu", "ramu.kaka@pavilion.io")
+
+        with open(lock._get_lock_file_path()) as lock_file:
+            self.assertNotIn("History", json.load(lock_file))
+
+        lck = lock.Lock()
+        self.assertEqual([event["Email"] for event in lck.history()], ["old@pavilion.io", "ramu.kaka@pavilion.io"])
+
 
+class MaxHistoryTest(_LockTestCase):
     def test_max_history(self):
         lck = lock.Lock()
         test_email = "ramu.kaka@pavilion.io"
@@ -80,8 +109,7 @@ class MaxHistoryTest(unittest.TestCase):
         self.assertEqual(first_history["Email"], f"{test_email}{offset!s}")
 
 
-class LockTest(unittest.TestCase):
-
+class LockTest(_LockTestCase):
     def test_exclusive_lock(self):
         lck = lock.Lock()
         test_name = "ramu"
@@ -141,6 +169,473 @@ class LockTest(unittest.TestCase):
         self.assertEqual(lck.is_lock_owner(test_email), False)
 
 
+class LockTransactionTest(_LockTestCase):
+    def test_single_write_per_operation(self):
+        lck = lock.Lock()
+        test_name = "ramu"
+        test_email = "ramu.kaka@pavilion.io"
+
+        with mock.patch("lock._write_lock_file", wraps=lock._write_lock_file) as writer:
+            lck.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE), test_name, test_email)
+            self.assertEqual(writer.call_count, 1)
+
+            # A denied request only appends to the history log
+            lck.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE), "gullu", "gullu.kale@pavilion.io")
+            self.assertEqual(writer.call_count, 1)
+
+            lck.add_to_waiting_queue("gullu.kale@pavilion.io", True)
+            self.assertEqual(writer.call_count, 2)
+
+            lck.unlock(test_email)
+            self.assertEqual(writer.call_count, 3)
+
+        lck.load_lock()
+        self.assertEqual(lck.type(), lock.LockType.FREE)
+        self.assertEqual(len(lck.history()), 3)
+
+    def test_nested_transaction(self):
+        lck = lock.Lock()
+
+        with mock.patch("lock._write_lock_file", wraps=lock._write_lock_file) as writer:
+            with lck.transaction():
+                lck.change_lock_type(lock.LockType.SHARED)
+
+                with lck.transaction():
+                    lck.add_lock_owner("ramu", "ramu.kaka@pavilion.io")
+
+                self.assertEqual(writer.call_count, 0)
+
+            self.assertEqual(writer.call_count, 1)
+
+    def test_failed_write_keeps_old_file(self):
+        lck = lock.Lock()
+        lck.lock(lock._lock_type_to_name(lock.LockType.EXCLUSIVE), "ramu", "ramu.kaka@pavilion.io")
+
+        with mock.patch("json.dump", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                lck.unlock("ramu.kaka@pavilion.io")
+
+        with open(lock._get_lock_file_path()) as lock_file:
+            data = json.load(lock_file)
+
+        self.assertEqual(data["Type"], "EXCLUSIVE")
+        self.assertEqual([f for f in os.listdir(self._dir) if f.endswith(".tmp")], [])
+
+
+class OwnerWaiterIndexTest(_LockTestCase):
+    def test_owners_keep_their_order_on_disk(self):
+        lck = lock.Lock()
+        emails = [f"user{i!s}@pavilion.io" for i in range(50)]
+
+        for a_email in emails:
+            lck.lock("shared", "x", a_email)
+
+        for a_email in emails[10:20]:
+            lck.unlock(a_email)
+
+        self.assertFalse(lck.is_lock_owner(emails[15]))
+        self.assertTrue(lck.is_lock_owner(emails[20]))
+
+        with open(lock._get_lock_file_path()) as lock_file:
+            stored = json.load(lock_file)
+
+        self.assertEqual([a_owner["Email"] for a_owner in stored["Owners"]], emails[:10] + emails[20:])
+        self.assertEqual(lock.Lock().owners(), lck.owners())
+
+    def test_waiter_queues_once(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "x", "owner@pavilion.io")
+        lck.add_to_waiting_queue("first@pavilion.io", True, "shared", name="first", wait=True)
+        lck.add_to_waiting_queue("second@pavilion.io", True, "exclusive", name="second", wait=True)
+        lck.add_to_waiting_queue("first@pavilion.io", True, "exclusive", name="first", priority=2, wait=True)
+
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.waiters()], ["first@pavilion.io", "second@pavilion.io"])
+        self.assertEqual(lck.waiters()[0]["Type"], "EXCLUSIVE")
+        self.assertEqual(lck.waiters()[0]["Priority"], 2)
+        self.assertTrue(lck.is_waiting("first@pavilion.io"))
+
+    def test_data_is_not_taken_apart(self):
+        data = {"Type": "SHARED", "Owners": [{"Name": "x", "Email": "a@pavilion.io"}], "Waiters": []}
+        lck = lock.Lock(data)
+
+        self.assertEqual(sorted(data), ["Owners", "Type", "Waiters"])
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["a@pavilion.io"])
+
+    def test_unknown_fields_survive(self):
+        with open(lock._get_lock_file_path(), "w") as lock_file:
+            json.dump({"Type": "SHARED", "Owners": [{"Name": "x", "Email": "a@pavilion.io", "Team": "qa"}],
+                       "Waiters": [], "Comment": "kept"}, lock_file)
+
+        lck = lock.Lock()
+        lck.lock("shared", "y", "b@pavilion.io")
+
+        with open(lock._get_lock_file_path()) as lock_file:
+            stored = json.load(lock_file)
+
+        self.assertEqual(stored["Comment"], "kept")
+        self.assertEqual(stored["Owners"][0], {"Name": "x", "Email": "a@pavilion.io", "Team": "qa"})
+
+
+class LeaseTest(_LockTestCase):
+    def test_renew(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "x", "owner@pavilion.io", ttl=60)
+        expires = lck.owners()[0]["Expires"]
+
+        self.assertEqual(lck.renew("owner@pavilion.io", 3600), (True, None))
+        self.assertGreater(lck.owners()[0]["Expires"], expires)
+        self.assertEqual(lck.owners()[0]["Ttl"], 3600)
+        self.assertEqual(lck.renew("other@pavilion.io"), (False, lock.ErrNotAnOwner))
+
+        lck.lock("shared", "y", "plain@pavilion.io")
+        lck.unlock("owner@pavilion.io")
+        lck.lock("shared", "y", "plain@pavilion.io")
+        self.assertEqual(lck.renew("plain@pavilion.io"), (False, lock.ErrNoLease))
+
+    def test_reap_hands_over(self):
+        lck = lock.Lock()
+        lck.lock("shared", "x", "leased@pavilion.io", ttl=60)
+        lck.lock("shared", "x", "forever@pavilion.io")
+        lck.add_to_waiting_queue("waiter@pavilion.io", True, "exclusive", name="waiter", ttl=120, wait=True)
+
+        self.assertEqual(lck.reap_expired(), [])
+        self.assertLessEqual(lck.next_expiry(), 60)
+
+        later = datetime.now() + timedelta(seconds=61)
+        self.assertEqual(lck.reap_expired(later), ["leased@pavilion.io"])
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["forever@pavilion.io"])
+
+        lck.unlock("forever@pavilion.io")
+        self.assertEqual(lck.lock_name(), "EXCLUSIVE")
+        self.assertEqual(lck.owners()[0]["Email"], "waiter@pavilion.io")
+        self.assertEqual(lck.owners()[0]["Ttl"], 120)
+
+        later = datetime.now() + timedelta(seconds=121)
+        self.assertEqual(lck.reap_expired(later), ["waiter@pavilion.io"])
+        self.assertEqual(lck.lock_name(), "FREE")
+
+        actions = [(a_entry["Email"], a_entry["Action"]) for a_entry in lock.Lock().history()]
+        self.assertIn(("leased@pavilion.io", "Expired"), actions)
+        self.assertIn(("waiter@pavilion.io", "Expired"), actions)
+
+
+class WaitQueueTest(_LockTestCase):
+    def test_fifo_order(self):
+        lck = lock.Lock()
+        lck.add_to_waiting_queue("first@pavilion.io", True, "exclusive", wait=True)
+        lck.add_to_waiting_queue("second@pavilion.io", True, "exclusive", wait=True)
+        lck.add_to_waiting_queue("notify@pavilion.io", True)
+
+        success, error = lck.lock("exclusive", "x", "other@pavilion.io")
+        self.assertEqual((success, error), (False, lock.ErrNotAvailable))
+
+        success, error = lck.lock("exclusive", "x", "second@pavilion.io")
+        self.assertEqual((success, error), (False, lock.ErrNotAvailable))
+
+        success, error = lck.lock("exclusive", "x", "first@pavilion.io")
+        self.assertEqual((success, error), (True, None))
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.waiters()], ["second@pavilion.io", "notify@pavilion.io"])
+
+        # Releasing hands the lock to the next waiter, the plain one is only notified
+        lck.unlock("first@pavilion.io")
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.granted()], ["second@pavilion.io"])
+        self.assertEqual(lck.lock_name(), "EXCLUSIVE")
+        self.assertTrue(lck.is_lock_owner("second@pavilion.io"))
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.waiters()], ["notify@pavilion.io"])
+
+        lck.unlock("second@pavilion.io")
+        lck.notify_waiters("free")
+        self.assertEqual(lck.lock_name(), "FREE")
+        self.assertEqual(lck.waiters(), [])
+
+    def test_shared_waiters_granted_together(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "x", "owner@pavilion.io")
+        lck.add_to_waiting_queue("s1@pavilion.io", True, "shared", name="s1", wait=True)
+        lck.add_to_waiting_queue("s2@pavilion.io", True, "shared", name="s2", wait=True)
+        lck.add_to_waiting_queue("x1@pavilion.io", True, "exclusive", name="x1", wait=True)
+        lck.add_to_waiting_queue("s3@pavilion.io", True, "shared", name="s3", wait=True)
+
+        lck.unlock("owner@pavilion.io")
+        self.assertEqual(lck.lock_name(), "SHARED")
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["s1@pavilion.io", "s2@pavilion.io"])
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.waiters()], ["x1@pavilion.io", "s3@pavilion.io"])
+
+        # A shared request may not overtake the exclusive waiter
+        success, error = lck.lock("shared", "s3", "s3@pavilion.io")
+        self.assertEqual((success, error), (False, lock.ErrNotAvailable))
+
+        lck.unlock("s1@pavilion.io")
+        self.assertEqual(lck.granted(), [])
+
+        lck.unlock("s2@pavilion.io")
+        self.assertEqual(lck.lock_name(), "EXCLUSIVE")
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["x1@pavilion.io"])
+
+        lck = lock.Lock()
+        self.assertEqual(lck.history()[-1]["Email"], "x1@pavilion.io")
+        self.assertEqual(lck.history()[-1]["Action"], "Exclusive lock")
+
+    def test_cancelled_head_lets_shared_in(self):
+        lck = lock.Lock()
+        lck.lock("shared", "x", "owner@pavilion.io")
+        lck.add_to_waiting_queue("x1@pavilion.io", True, "exclusive", name="x1", wait=True)
+        lck.add_to_waiting_queue("s1@pavilion.io", True, "shared", name="s1", wait=True)
+
+        lck.remove_waiter("x1@pavilion.io")
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["owner@pavilion.io", "s1@pavilion.io"])
+        self.assertEqual(lck.waiters(), [])
+
+    def test_priority_and_aging(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "x", "owner@pavilion.io")
+        lck.add_to_waiting_queue("low@pavilion.io", True, "exclusive", name="low", wait=True)
+        lck.add_to_waiting_queue("high@pavilion.io", True, "exclusive", name="high", priority=1, wait=True)
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.queue()], ["high@pavilion.io", "low@pavilion.io"])
+
+        # Waiting long enough outranks a higher priority newcomer
+        lck.waiters()[0]["Time"] = str(datetime.now() - timedelta(seconds=2 * lock.aging_interval))
+        lck.save_lock()
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.queue()], ["low@pavilion.io", "high@pavilion.io"])
+
+        lck.unlock("owner@pavilion.io")
+        self.assertTrue(lck.is_lock_owner("low@pavilion.io"))
+
+    def test_dead_waiter_is_dropped(self):
+        proc = multiprocessing.get_context("fork").Process(target=os.getpid)
+        proc.start()
+        proc.join()
+
+        lck = lock.Lock()
+        lck.add_to_waiting_queue("gone@pavilion.io", True, "exclusive", wait=True)
+        lck.waiters()[0]["Pid"] = proc.pid
+        lck.save_lock()
+
+        success, error = lck.lock("exclusive", "x", "other@pavilion.io")
+        self.assertEqual((success, error), (True, None))
+        self.assertEqual(lck.waiters(), [])
+
+
+class ResourceLockTest(_LockTestCase):
+    def test_disjoint_resources(self):
+        lck = lock.Lock()
+        self.assertEqual(lck.lock("exclusive", "a", "a@pavilion.io", resource="slot3"), (True, None))
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io", resource="slot4/drive1"), (True, None))
+        self.assertEqual(lck.lock("shared", "c", "c@pavilion.io", resource="slot4/drive2"), (True, None))
+        self.assertEqual(lck.lock("shared", "d", "d@pavilion.io", resource="slot4/drive2"), (True, None))
+        self.assertEqual(lck.type(), lock.LockType.FREE)
+
+        reloaded = lock.Lock()
+        self.assertEqual([a_owner["Email"] for a_owner in reloaded.owners("slot4/drive2")],
+                         ["c@pavilion.io", "d@pavilion.io"])
+        self.assertEqual(reloaded.resources()["slot3"][0], lock.LockType.EXCLUSIVE)
+
+    def test_parent_and_child_conflicts(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "a", "a@pavilion.io", resource="slot3/drive2")
+
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io", resource="slot3"), (False, lock.ErrNotAvailable))
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io", resource="slot3/drive2/lun0"),
+                         (False, lock.ErrNotAvailable))
+        self.assertEqual(lck.lock("exclusive", "a", "a@pavilion.io", resource="slot3/drive2"),
+                         (False, lock.ErrAlreadyOwner))
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io"), (False, lock.ErrNotAvailable))
+
+        lck.unlock("a@pavilion.io", "slot3/drive2")
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io", resource="slot3"), (True, None))
+        self.assertEqual(lck.lock("shared", "c", "c@pavilion.io", resource="slot3/drive2"), (True, None))
+        self.assertEqual(lck.lock("exclusive", "d", "d@pavilion.io", resource="slot3/drive1"),
+                         (False, lock.ErrNotAvailable))
+        self.assertEqual(lck.lock("shared", "e", "e@pavilion.io"), (True, None))
+        self.assertEqual(lck.lock("exclusive", "d", "d@pavilion.io", resource="slot5"),
+                         (False, lock.ErrNotAvailable))
+
+    def test_chassis_waiter_served_after_resources(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "a", "a@pavilion.io", resource="slot3")
+        lck.add_to_waiting_queue("w@pavilion.io", True, "exclusive", name="w", wait=True)
+
+        # The queued chassis lock is not starved by new resource locks
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io", resource="slot4"), (False, lock.ErrNotAvailable))
+
+        self.assertEqual(lck.unlock("a@pavilion.io", "slot3"), (True, None))
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.granted()], ["w@pavilion.io"])
+        self.assertEqual(lck.lock_name(), "EXCLUSIVE")
+        self.assertEqual(lck.resources(), {})
+
+    def test_history_and_owners_per_resource(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "a", "a@pavilion.io", resource="slot3/drive2")
+        lck.lock("exclusive", "b", "b@pavilion.io", resource="slot4")
+        lck.unlock("a@pavilion.io", "slot3/drive2")
+        self.assertEqual(lck.unlock("a@pavilion.io", "slot3/drive2"), (False, lock.ErrNotAnOwner))
+
+        events = [(a_event["Email"], a_event["Action"]) for a_event in lck.query_history(resource="slot3")]
+        self.assertEqual(events, [("a@pavilion.io", "Exclusive lock"), ("a@pavilion.io", "Unlock")])
+        self.assertEqual(len(list(lck.query_history(resource="slot4/"))), 1)
+
+        with mock.patch("builtins.print") as printed:
+            lck.print_owners()
+
+        self.assertEqual([a_call.args[0] for a_call in printed.call_args_list], ["slot4 (exclusive)", "  b@pavilion.io"])
+
+        for resource in ["", "slot3//drive2", "../slot3"]:
+            with self.assertRaises(lock.InvalidLock):
+                lck.lock("exclusive", "a", "a@pavilion.io", resource=resource)
+
+    def test_resource_lease_expires(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "a", "a@pavilion.io", ttl=60, resource="slot3")
+        self.assertEqual(lck.renew("a@pavilion.io", 120, "slot3"), (True, None))
+        self.assertEqual(lck.renew("a@pavilion.io", 120), (False, lock.ErrNotAnOwner))
+        self.assertLessEqual(lck.next_expiry(), 120)
+
+        later = datetime.now() + timedelta(seconds=121)
+        self.assertEqual(lck.reap_expired(later), ["a@pavilion.io"])
+        self.assertEqual(lck.resources(), {})
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io"), (True, None))
+        self.assertIn(("a@pavilion.io", "Expired", "slot3"),
+                      [(a_event["Email"], a_event["Action"], a_event.get("Resource")) for a_event in lck.history()])
+
+
+class ReservationTest(_LockTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._now = datetime.now()
+
+    def _at(self, hours):
+        return self._now + timedelta(hours=hours)
+
+    def test_conflicts_and_next_free(self):
+        lck = lock.Lock()
+        self.assertEqual(lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))[:2], (True, None))
+        self.assertEqual(lck.reserve("shared", "b", "b@pavilion.io", self._at(1.5), self._at(3))[:2],
+                         (False, lock.ErrReserved))
+        self.assertEqual(lck.reserve("shared", "b", "b@pavilion.io", self._at(2), self._at(3))[:2], (True, None))
+        self.assertEqual(lck.reserve("shared", "c", "c@pavilion.io", self._at(2.5), self._at(4))[:2], (True, None))
+        self.assertEqual(lck.reserve("shared", "c", "c@pavilion.io", self._at(3), self._at(2))[:2],
+                         (False, lock.ErrInvalidWindow))
+
+        reloaded = lock.Lock()
+        self.assertEqual([a_reservation["Email"] for a_reservation in reloaded.reservations()],
+                         ["a@pavilion.io", "b@pavilion.io", "c@pavilion.io"])
+        self.assertEqual(reloaded.next_free("shared", 3600, self._at(1.5)), self._at(2))
+        self.assertEqual(reloaded.next_free("exclusive", 1800, self._at(1.5)), self._at(4))
+
+        reservation_id = reloaded.reservations()[0]["Id"]
+        self.assertEqual(reloaded.cancel_reservation("b@pavilion.io", reservation_id), (False, lock.ErrNoReservation))
+        self.assertEqual(reloaded.cancel_reservation("a@pavilion.io", reservation_id), (True, None))
+        self.assertEqual(reloaded.next_free("exclusive", 1800, self._at(0.5)), self._at(0.5))
+
+    def test_lock_ends_before_reservation(self):
+        lck = lock.Lock()
+        lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))
+
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io"), (True, None))
+        self.assertLessEqual(lck.owners()[0]["Ttl"], 3600)
+        self.assertEqual(lck.renew("b@pavilion.io", 7200), (True, None))
+        self.assertLessEqual(lck.owners()[0]["Ttl"], 3600)
+        self.assertLessEqual(lck.next_expiry(), 3600)
+
+    def test_resource_lock_ends_before_reservation(self):
+        lck = lock.Lock()
+        lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))
+
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io", resource="slot3"), (True, None))
+        self.assertLessEqual(lck.owners("slot3")[0]["Ttl"], 3600)
+        self.assertEqual(lck.renew("b@pavilion.io", 7200, resource="slot3"), (True, None))
+        self.assertLessEqual(lck.owners("slot3")[0]["Ttl"], 3600)
+
+        # The resource is free again when the reservation opens
+        self.assertEqual(lck.reap_expired(self._at(1)), ["b@pavilion.io"])
+        self.assertEqual(lck.resources(), {})
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["a@pavilion.io"])
+        self.assertEqual(lck.queue(), [])
+
+    def test_resource_lock_refused_during_reservation(self):
+        lck = lock.Lock()
+        lck.reserve("shared", "a", "a@pavilion.io", self._at(0.0001), self._at(2))
+
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io", resource="slot3"), (False, lock.ErrReserved))
+        self.assertEqual(lck.lock("shared", "b", "b@pavilion.io", resource="slot3"), (True, None))
+
+    def test_reservation_becomes_lock(self):
+        lck = lock.Lock()
+        _, _, reservation_id = lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))
+        lck.lock("exclusive", "b", "b@pavilion.io")
+
+        # The capped lease runs out as the reservation opens
+        self.assertEqual(lck.reap_expired(self._at(1)), ["b@pavilion.io"])
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["a@pavilion.io"])
+        self.assertEqual(lck.owners()[0]["Expires"], str(self._at(2)))
+        self.assertEqual(lck.reservations(), [])
+        self.assertEqual([a_waiter["Email"] for a_waiter in lck.granted()], ["a@pavilion.io"])
+
+        self.assertEqual(lck.reap_expired(self._at(2)), ["a@pavilion.io"])
+        self.assertEqual(lck.type(), lock.LockType.FREE)
+        self.assertIn(("a@pavilion.io", "Reserved", reservation_id),
+                      [(a_event["Email"], a_event["Action"], a_event.get("Reservation")) for a_event in lck.history()])
+
+    def test_reservation_queued_behind_owner(self):
+        lck = lock.Lock()
+        lck.lock("exclusive", "b", "b@pavilion.io")
+        lck.add_to_waiting_queue("w@pavilion.io", True, "exclusive", name="w", wait=True)
+        lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))
+
+        lck.reap_expired(self._at(1))
+        self.assertEqual(lck.queue()[0]["Email"], "a@pavilion.io")
+
+        lck.unlock("b@pavilion.io")
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["a@pavilion.io"])
+        self.assertLessEqual(lck.owners()[0]["Ttl"], 7200)
+
+    def test_shared_owner_with_exclusive_reservation_waits(self):
+        lck = lock.Lock()
+        lck.lock("shared", "a", "a@pavilion.io")
+        lck.lock("shared", "b", "b@pavilion.io")
+        lck.reserve("exclusive", "a", "a@pavilion.io", self._at(1), self._at(2))
+
+        lck.reap_expired(self._at(1))
+        self.assertEqual(lck.type(), lock.LockType.SHARED)
+        self.assertEqual(lck.queue()[0]["Email"], "a@pavilion.io")
+        self.assertEqual(lck.queue()[0]["Type"], "EXCLUSIVE")
+
+        lck.unlock("a@pavilion.io")
+        lck.unlock("b@pavilion.io")
+        self.assertEqual(lck.type(), lock.LockType.EXCLUSIVE)
+        self.assertEqual([a_owner["Email"] for a_owner in lck.owners()], ["a@pavilion.io"])
+
+
+def _race_for_lock(lock_dir, index, barrier, results):
+    lock.lock_file_path = lock_dir
+    barrier.wait()
+    success, error = lock.Lock().lock("exclusive", f"user{index!s}", f"user{index!s}@pavilion.io")
+    results.put(success)
+
+
+class LockContentionTest(_LockTestCase):
+    def test_single_exclusive_winner(self):
+        callers = 16
+        ctx = multiprocessing.get_context("fork")
+        barrier = ctx.Barrier(callers)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_race_for_lock, args=(self._dir, i, barrier, results)) for i in range(callers)]
+
+        for proc in procs:
+            proc.start()
+
+        wins = [results.get() for _ in procs]
+
+        for proc in procs:
+            proc.join()
+
+        self.assertEqual(wins.count(True), 1)
+
+        lck = lock.Lock()
+        self.assertEqual(lck.type(), lock.LockType.EXCLUSIVE)
+        self.assertEqual(len(lck.owners()), 1)
+        self.assertEqual(len(lck.history()), callers)
+
 
 if __name__ == '__main__':
     runner = unittest.main()
@@ -0,0 +1,158 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Only used where inotify is not available
+poll_interval = 1.0
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+"""
+******************************
+******* Watchers *************
+******************************
+"""
+
+
+class CancelEvent:
+    # A pipe backed event, so a blocked wait can select on it next to the
+    # inotify descriptor.
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._set = False
+
+    def fileno(self):
+        return self._read_fd
+
+    def set(self):
+        if not self._set:
+            self._set = True
+            os.write(self._write_fd, b"x")
+
+    def is_set(self):
+        return self._set
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class InotifyWatcher:
+    def __init__(self, libc, file_path):
+        self._file_name = os.path.basename(file_path).encode()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # The lock file is replaced by rename, watch its directory instead of
+        # the inode that goes away on the next write.
+        wd = libc.inotify_add_watch(self._fd, os.path.dirname(file_path).encode(),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE)
+
+        if wd < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def fileno(self):
+        return self._fd
+
+    def _drain(self):
+        changed = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+
+                if name == self._file_name:
+                    changed = True
+
+    def wait(self, timeout=None, cancel=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fds = [self._fd] + ([cancel.fileno()] if cancel is not None else [])
+
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select(fds, [], [], remaining)
+
+            if cancel is not None and cancel.is_set():
+                return False
+
+            if not ready:
+                return False
+
+            if self._drain():
+                return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    def __init__(self, file_path):
+        self._file_path = file_path
+
+    def wait(self, timeout=None, cancel=None):
+        delay = poll_interval if timeout is None else min(timeout, poll_interval)
+
+        if cancel is not None:
+            select.select([cancel.fileno()], [], [], delay)
+        else:
+            time.sleep(delay)
+
+        return cancel is None or not cancel.is_set()
+
+    def close(self):
+        pass
+
+
+def watch(file_path):
+    libc = _load_libc()
+
+    if libc is not None:
+        try:
+            return InotifyWatcher(libc, file_path)
+        except OSError:
+            pass
+
+    return PollingWatcher(file_path)
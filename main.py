@@ -1,8 +1,112 @@
 import argparse
-import chassis_manager
+import chm_client
+import sys
+import timing
 
+from datetime import datetime, timedelta
 
-def lock(args):
+
+def _new_chassis_manager(name=None, ip=None):
+    # Imported here so a command served by the daemon never loads the
+    # chassis manager, the lock or the sheet client modules.
+    with timing.span("chm.import"):
+        import chassis_manager
+
+    with timing.span("chm.init"):
+        return chassis_manager.ChassisManager(name, ip)
+
+
+def missing_chassis(args):
+    # A manager host with a central lock store has no chassis of its own,
+    # every command on a lock has to name one.
+    if args.CHASSIS is not None:
+        return False
+
+    if not (args.LOCK or args.UNLOCK or args.RENEW or args.RESERVE or args.CANCEL_RESERVATION is not None
+            or args.RESERVATIONS or args.NEXT_FREE is not None or args.LOCK_HISTORY or args.LOCK_OWNERS):
+        return False
+
+    with timing.span("chm.import"):
+        import chassis_manager
+
+    return chassis_manager.central_database() is not None
+
+
+def _user_error(e):
+    # A bad resource or chassis name, the lock module is loaded by then
+    import lock
+    return isinstance(e, lock.InvalidLock)
+
+
+def _parse_duration(text):
+    # 90, 90s, 15m, 4h, 2d or a mix like 1h30m, in seconds
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = text.strip().lower()
+
+    if text.isdigit():
+        return int(text)
+
+    seconds = 0
+    number = ''
+
+    for char in text:
+        if char.isdigit():
+            number += char
+        elif char in units and number:
+            seconds += int(number) * units[char]
+            number = ''
+        else:
+            raise ValueError(f"Invalid duration '{text!s}'")
+
+    if number or not seconds:
+        raise ValueError(f"Invalid duration '{text!s}'")
+
+    return seconds
+
+
+def _parse_time(text):
+    # The lock keeps local times, a time with an offset is converted to one
+    if text is None:
+        return None
+
+    value = datetime.fromisoformat(text)
+
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+
+    return value
+
+
+def _until_bound(text):
+    # The bound takes in all of the last unit given, --until 2024-05-01 is
+    # the whole day and --until "2024-05-01 10:30" the whole minute.
+    bound = _parse_time(text)
+    text = text.strip()
+
+    if len(text) == len("YYYY-MM-DD"):
+        return bound + timedelta(days=1, microseconds=-1)
+
+    if len(text) == len("YYYY-MM-DD HH:MM"):
+        return bound + timedelta(minutes=1, microseconds=-1)
+
+    if len(text) == len("YYYY-MM-DD HH:MM:SS"):
+        return bound + timedelta(seconds=1, microseconds=-1)
+
+    return bound
+
+
+def _lease(args):
+    if args.TTL is None:
+        return True, None
+
+    try:
+        return True, _parse_duration(args.TTL)
+    except ValueError:
+        print("Please specify the lease as e.g. 30m, 4h or 1d")
+        return False, None
+
+
+def lock(args, chm=None, cancel=None):
     lock = args.LOCK
 
     if lock is None or lock is False:
@@ -28,8 +132,21 @@ def lock(args):
     if args.NOTIFY is not None:
         notify = args.NOTIFY
 
-    chm = chassis_manager.ChassisManager()
-    success, error = chm.lock(lock_type, email, name, notify)
+    if (args.WAIT or args.QUEUE) and args.RESOURCE is not None:
+        print("Only the whole chassis can be waited or queued for, not a resource")
+        return True
+
+    valid, ttl = _lease(args)
+
+    if not valid:
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+
+    if args.WAIT:
+        success, error = chm.lock_wait(lock_type, email, name, args.TIMEOUT, cancel, args.PRIORITY, ttl)
+    else:
+        success, error = chm.lock(lock_type, email, name, notify, ttl, args.RESOURCE, args.QUEUE, args.PRIORITY)
 
     if not success:
         print(error)
@@ -39,31 +156,76 @@ def lock(args):
     return True
 
 
-def lock_history(args):
+def lock_history(args, chm=None):
     history = args.LOCK_HISTORY
 
     if history is None or history is False:
         return False
 
-    chm = chassis_manager.ChassisManager()
-    chm.print_lock_history()
+    since = args.SINCE
+    until = args.UNTIL
+
+    try:
+        if since is not None:
+            since = str(_parse_time(since))
+
+        if until is not None:
+            until = str(_until_bound(until))
+    except ValueError:
+        print("Please specify the time as YYYY-MM-DD[ HH:MM[:SS]]")
+        return True
+
+    if (args.LIMIT is not None and args.LIMIT < 0) or (args.TAIL is not None and args.TAIL < 0):
+        print("Please specify --limit and --tail as a number of entries, 0 or more")
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    chm.print_lock_history(args.EMAIL, args.ACTION, since, until, args.LIMIT, args.TAIL, args.RESOURCE)
 
     return True
 
 
-def lock_owners(args):
+def lock_owners(args, chm=None):
     owners = args.LOCK_OWNERS
 
     if owners is None or owners is False:
         return False
 
-    chm = chassis_manager.ChassisManager()
-    chm.print_lock_owners()
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    chm.print_lock_owners(args.RESOURCE)
+
+    return True
+
+
+def renew(args, chm=None):
+    renew = args.RENEW
+
+    if renew is None or renew is False:
+        return False
+
+    email = args.EMAIL
+
+    if email is None:
+        print("Please specify your pavilion email address")
+        return True
+
+    valid, ttl = _lease(args)
+
+    if not valid:
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    success, error = chm.renew(email, ttl, args.RESOURCE)
 
+    if not success:
+        print(error)
+        return True
+
+    print("Lease renewed successfully")
     return True
 
 
-def unlock(args):
+def unlock(args, chm=None):
     unlock = args.UNLOCK
 
     if unlock is None or unlock is False:
@@ -75,13 +237,18 @@ def unlock(args):
         print("Please specify your pavilion email address")
         return True
 
-    chm = chassis_manager.ChassisManager()
-    success, error, notified = chm.unlock(email)
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    success, error, notified = chm.unlock(email, args.RESOURCE)
 
     if not success:
         print(error)
         return True
 
+    handed_over = chm.handed_over()
+
+    if handed_over:
+        print(f"Lock handed over to {', '.join(handed_over)!s}")
+
     if notified > 0:
         print(f"{notified!s} waiters notified")
 
@@ -89,6 +256,110 @@ def unlock(args):
     return True
 
 
+def reserve(args, chm=None):
+    reserve = args.RESERVE
+
+    if reserve is None or reserve is False:
+        return False
+
+    if args.LOCK_TYPE is None or args.NAME is None or args.EMAIL is None or args.FROM is None or args.TO is None:
+        print("Please specify the lock type, your name, your pavilion email address and the --from and --to times")
+        return True
+
+    try:
+        start = _parse_time(args.FROM)
+        end = _parse_time(args.TO)
+    except ValueError:
+        print("Please specify the time as YYYY-MM-DD[ HH:MM[:SS]]")
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    success, error, reservation_id = chm.reserve(args.LOCK_TYPE, args.EMAIL, args.NAME, start, end)
+
+    if not success:
+        print(error)
+        return True
+
+    print(f"Reserved {reservation_id!s} from {start!s} to {end!s}")
+    return True
+
+
+def cancel_reservation(args, chm=None):
+    reservation_id = args.CANCEL_RESERVATION
+
+    if reservation_id is None:
+        return False
+
+    if args.EMAIL is None:
+        print("Please specify your pavilion email address")
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    success, error = chm.cancel_reservation(args.EMAIL, reservation_id)
+
+    if not success:
+        print(error)
+        return True
+
+    print("Reservation cancelled successfully")
+    return True
+
+
+def reservations(args, chm=None):
+    reservations = args.RESERVATIONS
+
+    if reservations is None or reservations is False:
+        return False
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    chm.print_reservations()
+
+    return True
+
+
+def next_free(args, chm=None):
+    duration = args.NEXT_FREE
+
+    if duration is None:
+        return False
+
+    if args.LOCK_TYPE is None:
+        print("Please specify the lock type")
+        return True
+
+    try:
+        duration = _parse_duration(duration)
+        after = _parse_time(args.FROM)
+    except ValueError:
+        print("Please specify the duration as e.g. 30m, 4h or 1d and the time as YYYY-MM-DD[ HH:MM[:SS]]")
+        return True
+
+    chm = chm or _new_chassis_manager(args.CHASSIS)
+    start = chm.next_free(args.LOCK_TYPE, duration, after)
+
+    if start is None:
+        print("The chassis is locked without a lease, it is free once it is unlocked")
+        return True
+
+    print(f"Free from {start!s}")
+    return True
+
+
+def list_chassis(args):
+    list_chassis = args.LIST_CHASSIS
+
+    if list_chassis is None or list_chassis is False:
+        return False
+
+    import chassis_manager
+    success, error = chassis_manager.print_chassis_list()
+
+    if not success:
+        print(error)
+
+    return True
+
+
 def git_init(args):
     git_repo = args.REPO_PATH
 
@@ -96,6 +367,7 @@ def git_init(args):
         print("Please specify the directory path")
         return False
 
+    import chassis_manager
     success, error = chassis_manager.init_git_repo(git_repo)
     if not success:
         print(error)
@@ -105,7 +377,7 @@ def git_init(args):
     return True
 
 
-def init(args):
+def init(args, chm=None):
     init = args.INIT
 
     if init is None or init is False:
@@ -123,13 +395,85 @@ def init(args):
 
         return False
 
-    chm = chassis_manager.ChassisManager(name, ip)
-    chm.ch_init(name, ip)
+    import status_backend
+
+    chm = chm or _new_chassis_manager(name, ip)
+
+    try:
+        chm.ch_init(name, ip)
+    except status_backend.UnknownBackend as e:
+        print(e)
+        return False
+
     print("Chassis initialized successfully")
     return True
 
 
-def parse_user_args():
+def _dispatch(args, chm=None, cancel=None):
+    if lock(args, chm, cancel):
+        return "lock"
+
+    if lock_history(args, chm):
+        return "lock-history"
+
+    if lock_owners(args, chm):
+        return "lock-owners"
+
+    if renew(args, chm):
+        return "renew"
+
+    if unlock(args, chm):
+        return "unlock"
+
+    if reserve(args, chm):
+        return "reserve"
+
+    if cancel_reservation(args, chm):
+        return "cancel-reservation"
+
+    if reservations(args, chm):
+        return "reservations"
+
+    if next_free(args, chm):
+        return "next-free"
+
+    if init(args, chm):
+        return "init"
+
+    if list_chassis(args):
+        return "list-chassis"
+
+    if git_init(args):
+        return "git-init"
+
+    return None
+
+
+def run(args, chm=None, cancel=None):
+    timing.start()
+
+    if missing_chassis(args):
+        print("Please specify --chassis")
+        command = None
+    else:
+        try:
+            command = _dispatch(args, chm, cancel)
+        except Exception as e:
+            if not _user_error(e):
+                raise
+
+            print(e)
+            command = None
+
+    record = timing.finish(command)
+
+    if args.PROFILE and record is not None:
+        timing.print_report(record)
+
+    return 0 if command is not None else 1
+
+
+def parse_user_args(argv=None):
     parser = argparse.ArgumentParser(description="chassis ownership manager")
 
     parser.add_argument('--lock', action='store_true', dest="LOCK", required=False,
@@ -144,9 +488,67 @@ def parse_user_args():
     parser.add_argument('--notify', action='store_true', dest="NOTIFY", required=False,
                         help="You will be notified over email when the chassis is free")
 
+    parser.add_argument('--wait', action='store_true', dest="WAIT", required=False,
+                        help="Wait in the queue until the lock is granted")
+
+    parser.add_argument('--timeout', dest="TIMEOUT", type=float, required=False,
+                        help="Give up waiting for the lock after this many seconds")
+
+    parser.add_argument('--queue', action='store_true', dest="QUEUE", required=False,
+                        help="Queue for the lock without waiting, it is handed to you on release and you are emailed")
+
+    parser.add_argument('--priority', dest="PRIORITY", type=int, default=0, required=False,
+                        help="Queue priority while waiting or queued, higher is served first")
+
+    parser.add_argument('--ttl', dest="TTL", required=False,
+                        help="Lease the lock for this long, e.g. 30m, 4h or 1d. It is released unless renewed")
+
+    parser.add_argument('--resource', dest="RESOURCE", required=False,
+                        help="Lock, unlock or report a part of the chassis instead of all of it, e.g. slot3 or "
+                             "slot3/drive2")
+
+    parser.add_argument('--renew', action='store_true', dest="RENEW", required=False,
+                        help="Renew your lease on the lock, for --ttl or the original lease time")
+
+    parser.add_argument('--reserve', action='store_true', dest="RESERVE", required=False,
+                        help="Reserve the chassis from --from to --to, the lock is taken when the reservation starts "
+                             "and released when it ends")
+
+    parser.add_argument('--from', dest="FROM", required=False,
+                        help="Start of the reservation, or the earliest start for --next-free "
+                             "(YYYY-MM-DD[ HH:MM[:SS]])")
+
+    parser.add_argument('--to', dest="TO", required=False,
+                        help="End of the reservation (YYYY-MM-DD[ HH:MM[:SS]])")
+
+    parser.add_argument('--cancel-reservation', dest="CANCEL_RESERVATION", required=False,
+                        help="Cancel your reservation with this id")
+
+    parser.add_argument('--reservations', action='store_true', dest="RESERVATIONS", required=False,
+                        help="print the upcoming reservations")
+
+    parser.add_argument('--next-free', dest="NEXT_FREE", required=False,
+                        help="print when the chassis is free for this long for --lock-type, e.g. 2h")
+
     parser.add_argument('--lock-history', action='store_true', dest="LOCK_HISTORY", required=False,
                         help="print the lock history")
 
+    parser.add_argument('--action', dest="ACTION", required=False,
+                        help="Only show history entries with this action, e.g. 'Exclusive lock'")
+
+    parser.add_argument('--since', dest="SINCE", required=False,
+                        help="Only show history entries at or after this time (YYYY-MM-DD[ HH:MM[:SS]])")
+
+    parser.add_argument('--until', dest="UNTIL", required=False,
+                        help="Only show history entries up to this time (YYYY-MM-DD[ HH:MM[:SS]]), a date alone "
+                             "takes in the whole day")
+
+    parser.add_argument('--limit', dest="LIMIT", type=int, required=False,
+                        help="Show at most this many of the oldest matching history entries")
+
+    parser.add_argument('--tail', dest="TAIL", type=int, required=False,
+                        help="Show this many of the newest matching history entries")
+
     parser.add_argument('--lock-owners', action='store_true', dest="LOCK_OWNERS", required=False,
                         help="print the lock owners")
 
@@ -168,7 +570,19 @@ def parse_user_args():
     parser.add_argument('--chip', dest="CHIP", required=False,
                         help="Chassis ip")
 
-    return parser.parse_args()
+    parser.add_argument('--chassis', dest="CHASSIS", required=False,
+                        help="Chassis to work on, on a manager host with a central lock store")
+
+    parser.add_argument('--list-chassis', action='store_true', dest="LIST_CHASSIS", required=False,
+                        help="Print the lock state of every chassis in the central lock store")
+
+    parser.add_argument('--profile', action='store_true', dest="PROFILE", required=False,
+                        help="Print how long every phase of the command took")
+
+    parser.add_argument('--no-daemon', action='store_true', dest="NO_DAEMON", required=False,
+                        help="Do not hand the command to a running chassis manager daemon")
+
+    return parser.parse_args(argv)
 
 
 """
@@ -180,22 +594,19 @@ def parse_user_args():
 if __name__ == "__main__":
     args = parse_user_args()
 
-    if lock(args):
-        exit(0)
-
-    if lock_history(args):
-        exit(0)
+    # git-init works on the caller's paths, everything else can be served by
+    # a running daemon which already has the lock and the sheet loaded.
+    if not args.NO_DAEMON and args.REPO_PATH is None:
+        timeout = chm_client.reply_timeout
 
-    if lock_owners(args):
-        exit(0)
+        if args.WAIT:
+            timeout = None if args.TIMEOUT is None else args.TIMEOUT + chm_client.reply_timeout
 
-    if unlock(args):
-        exit(0)
+        reply = chm_client.request(sys.argv[1:], timeout)
 
-    if init(args):
-        exit(0)
-
-    if git_init(args):
-        exit(0)
+        if reply is not None:
+            code, output = reply
+            print(output, end='')
+            exit(code)
 
-    exit(1)
+    exit(run(args))
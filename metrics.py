@@ -0,0 +1,226 @@
+import argparse
+import fcntl
+import json
+import os
+import pathlib
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+metrics_file_path = str(pathlib.Path(__file__).parent.absolute())
+metrics_file_name = "/.chm_metrics.json"
+metrics_guard_name = "/.chm_metrics.guard"
+
+held_buckets = [60, 300, 900, 3600, 4 * 3600, 8 * 3600, 24 * 3600, 3 * 24 * 3600, 7 * 24 * 3600]
+sync_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Every family the chassis manager exports: type, help text and buckets
+families = {
+    "chm_lock_acquires_total": ("counter", "Locks granted, by lock type", None),
+    "chm_lock_denials_total": ("counter", "Lock requests turned down, by reason", None),
+    "chm_lock_releases_total": ("counter", "Locks released by their owner, by lock type", None),
+    "chm_lock_expired_total": ("counter", "Leases that ran out and were released, by lock type", None),
+    "chm_lock_held_seconds": ("histogram", "How long a lock was held before it was released, by lock type",
+                              held_buckets),
+    "chm_lock_queue_depth": ("gauge", "Users waiting in the lock queue", None),
+    "chm_lock_owners": ("gauge", "Current owners of the lock", None),
+    "chm_lock_state": ("gauge", "1 for the current lock type, 0 for the others", None),
+    "chm_sheet_sync_seconds": ("histogram", "Time to push one lock state change to the sheet", sync_buckets),
+    "chm_sheet_sync_failures_total": ("counter", "Lock state changes the sheet push gave up on", None),
+}
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_metrics_file_path():
+    return metrics_file_path + metrics_file_name
+
+
+def _get_metrics_guard_path():
+    return metrics_file_path + metrics_guard_name
+
+
+def _series_key(name, labels):
+    return json.dumps([name, labels or {}], sort_keys=True)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+
+    text = ",".join(f"{key!s}=\"{_escape(labels[key])!s}\"" for key in sorted(labels))
+    return f"{name!s}{{{text!s}}}"
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def _load_state():
+    try:
+        with open(_get_metrics_file_path()) as metrics_file:
+            state = json.load(metrics_file)
+    except (FileNotFoundError, ValueError):
+        state = {}
+
+    for section in ["Counters", "Gauges", "Histograms"]:
+        state.setdefault(section, {})
+
+    return state
+
+
+def _replace_file(path, text):
+    # Written next to the target and renamed over it, node_exporter and the
+    # next command never see half a file.
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(text)
+
+    os.replace(tmp_path, path)
+
+
+def render(state):
+    lines = []
+
+    for name, (metric_type, help_text, buckets) in families.items():
+        section = "Histograms" if metric_type == "histogram" else metric_type.capitalize() + "s"
+        series = [(json.loads(key), state[section][key]) for key in sorted(state[section])
+                  if json.loads(key)[0] == name]
+
+        if not series:
+            continue
+
+        lines.append(f"# HELP {name!s} {help_text!s}")
+        lines.append(f"# TYPE {name!s} {metric_type!s}")
+
+        for (_, labels), value in series:
+            if metric_type != "histogram":
+                lines.append(f"{_series(name, labels)!s} {_number(value)!s}")
+                continue
+
+            for bound, count in zip(buckets + ["+Inf"], value["Buckets"]):
+                lines.append(f"{_series(name + '_bucket', dict(labels, le=_number(bound)))!s} {count!s}")
+
+            lines.append(f"{_series(name + '_sum', labels)!s} {_number(value['Sum'])!s}")
+            lines.append(f"{_series(name + '_count', labels)!s} {value['Count']!s}")
+
+    return "\n".join(lines) + "\n"
+
+
+"""
+******************************
+******* Metrics **************
+******************************
+"""
+
+
+class Metrics:
+    def __init__(self, textfile, labels=None):
+        self._textfile = textfile
+        # Added to every series, e.g. the chassis on a central manager host
+        self._labels = labels or {}
+        self._counters = {}
+        self._gauges = {}
+        self._observations = {}
+
+    def _key(self, name, labels):
+        return _series_key(name, dict(self._labels, **(labels or {})))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        self._observations.setdefault(self._key(name, labels), []).append(value)
+
+    def commit(self):
+        # Every command runs in its own process, the totals live in a state
+        # file that is merged under a guard and rendered for node_exporter.
+        if not (self._counters or self._gauges or self._observations):
+            return
+
+        guard_fd = os.open(_get_metrics_guard_path(), os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            fcntl.flock(guard_fd, fcntl.LOCK_EX)
+            state = _load_state()
+
+            for key, value in self._counters.items():
+                state["Counters"][key] = state["Counters"].get(key, 0) + value
+
+            state["Gauges"].update(self._gauges)
+
+            for key, values in self._observations.items():
+                buckets = families[json.loads(key)[0]][2]
+                histogram = state["Histograms"].setdefault(key, {"Buckets": [0] * (len(buckets) + 1),
+                                                                 "Sum": 0, "Count": 0})
+
+                for value in values:
+                    # Stored cumulative, the way they are exported
+                    for position, bound in enumerate(buckets + [float("inf")]):
+                        if value <= bound:
+                            histogram["Buckets"][position] += 1
+
+                    histogram["Sum"] += value
+                    histogram["Count"] += 1
+
+            _replace_file(_get_metrics_file_path(), json.dumps(state))
+            _replace_file(self._textfile, render(state))
+        finally:
+            self._counters = {}
+            self._gauges = {}
+            self._observations = {}
+
+            fcntl.flock(guard_fd, fcntl.LOCK_UN)
+            os.close(guard_fd)
+
+
+def from_config(config, labels=None):
+    # [Metrics] textfile = /var/lib/node_exporter/textfile_collector/chm.prom
+    if 'Metrics' not in config or not config['Metrics'].get('textfile'):
+        return None
+
+    return Metrics(config['Metrics'].get('textfile'), labels)
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager metrics")
+
+    parser.add_argument('--print', action='store_true', dest="PRINT", required=False,
+                        help="Print the metrics in the Prometheus text format")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.PRINT:
+        print(render(_load_state()), end='')
+        exit(0)
+
+    exit(1)
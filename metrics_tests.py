@@ -0,0 +1,127 @@
+import unittest
+import chassis_manager
+import lock
+import metrics
+import os
+import sheet_sync
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+
+def _read_prom(path):
+    samples = {}
+
+    with open(path) as prom_file:
+        for line in prom_file:
+            if line.startswith("#") or not line.strip():
+                continue
+
+            series, value = line.rsplit(" ", 1)
+            samples[series] = float(value)
+
+    return samples
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._old_paths = lock.lock_file_path, metrics.metrics_file_path
+        lock.lock_file_path = metrics.metrics_file_path = self._dir
+        self._textfile = os.path.join(self._dir, "chm.prom")
+
+    def tearDown(self) -> None:
+        lock.lock_file_path, metrics.metrics_file_path = self._old_paths
+        shutil.rmtree(self._dir)
+
+    def _lock(self):
+        return lock.Lock(metrics=metrics.Metrics(self._textfile))
+
+    def test_lock_operations_are_counted(self):
+        lck = self._lock()
+        self.assertEqual(lck.lock("exclusive", "a", "a@pavilion.io"), (True, None))
+        self.assertEqual(lck.lock("exclusive", "b", "b@pavilion.io"), (False, lock.ErrNotAvailable))
+        self.assertEqual(lck.lock("exclusive", "a", "a@pavilion.io"), (False, lock.ErrAlreadyOwner))
+        lck.add_to_waiting_queue("b@pavilion.io", True, "shared", name="b", wait=True)
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_lock_acquires_total{type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_denials_total{reason="ErrNotAvailable"}'], 1)
+        self.assertEqual(samples['chm_lock_denials_total{reason="ErrAlreadyOwner"}'], 1)
+        self.assertEqual(samples['chm_lock_queue_depth'], 1)
+        self.assertEqual(samples['chm_lock_state{type="exclusive"}'], 1)
+
+        # The unlock hands the lock to the queued waiter
+        self.assertEqual(lck.unlock("a@pavilion.io"), (True, None))
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_lock_releases_total{type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_acquires_total{type="shared"}'], 1)
+        self.assertEqual(samples['chm_lock_held_seconds_count{type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_held_seconds_bucket{le="60",type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_state{type="shared"}'], 1)
+        self.assertEqual(samples['chm_lock_owners'], 1)
+
+    def test_counters_add_up_across_processes(self):
+        for i in range(3):
+            # Every command runs with a fresh Lock and Metrics
+            self.assertEqual(self._lock().lock("shared", "a", f"user{i!s}@pavilion.io"), (True, None))
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_lock_acquires_total{type="shared"}'], 3)
+        self.assertEqual(samples['chm_lock_owners'], 3)
+
+    def test_expired_lease_is_counted(self):
+        lck = self._lock()
+        lck.lock("exclusive", "a", "a@pavilion.io", ttl=60)
+
+        self.assertEqual(lck.reap_expired(datetime.now() + timedelta(hours=2)), ["a@pavilion.io"])
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_lock_expired_total{type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_held_seconds_bucket{le="3600",type="exclusive"}'], 0)
+        self.assertEqual(samples['chm_lock_held_seconds_bucket{le="14400",type="exclusive"}'], 1)
+        self.assertEqual(samples['chm_lock_state{type="free"}'], 1)
+
+    def test_histogram_rendering(self):
+        recorder = metrics.Metrics(self._textfile)
+
+        for value in [0.05, 0.3, 2, 100]:
+            recorder.observe("chm_sheet_sync_seconds", value)
+        recorder.commit()
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_sheet_sync_seconds_bucket{le="0.1"}'], 1)
+        self.assertEqual(samples['chm_sheet_sync_seconds_bucket{le="2.5"}'], 3)
+        self.assertEqual(samples['chm_sheet_sync_seconds_bucket{le="+Inf"}'], 4)
+        self.assertEqual(samples['chm_sheet_sync_seconds_count'], 4)
+        self.assertAlmostEqual(samples['chm_sheet_sync_seconds_sum'], 102.35)
+
+    def test_sheet_sync_is_timed(self):
+        old_paths = chassis_manager.config_file_path, sheet_sync.spool_file_path
+        chassis_manager.config_file_path = sheet_sync.spool_file_path = self._dir
+
+        with open(chassis_manager._get_config_file_path(), "w") as config_file:
+            config_file.write(f"[Metrics]\ntextfile = {self._textfile!s}\n")
+
+        class Sheet:
+            def update_info(self, lock_name, owners=None, waiters=None):
+                return lock_name != "SHARED", "quota exceeded"
+
+        try:
+            sheet_sync.enqueue("gullu", "10.10.10.10", "EXCLUSIVE", [{"Email": "a@pavilion.io"}], [])
+            sheet_sync.enqueue("pillu", "10.10.10.11", "SHARED", [{"Email": "b@pavilion.io"}], [])
+            self.assertEqual(sheet_sync.flush(lambda name, ip: Sheet(), attempts=1, delay=0), (1, 1))
+        finally:
+            chassis_manager.config_file_path, sheet_sync.spool_file_path = old_paths
+
+        samples = _read_prom(self._textfile)
+        self.assertEqual(samples['chm_sheet_sync_seconds_count'], 1)
+        self.assertEqual(samples['chm_sheet_sync_failures_total'], 1)
+
+    def test_not_configured(self):
+        self.assertIsNone(metrics.from_config({}))
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,393 @@
+import argparse
+import fcntl
+import json
+import os
+import pathlib
+import sys
+import timing
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+queue_file_path = str(pathlib.Path(__file__).parent.absolute())
+queue_file_name = "/.chm_notify_queue.jsonl"
+inflight_file_name = "/.chm_notify_inflight.jsonl"
+queue_guard_name = "/.chm_notify_queue.guard"
+drain_guard_name = "/.chm_notify_drain.guard"
+
+max_workers = 4
+max_attempts = 5
+smtp_timeout = 10
+
+"""
+******************************
+******* SMTP configurations **
+******************************
+"""
+port = 465
+smtp_server = "smtp.gmail.com"
+sender_email = "x.y@pavilion.io"
+password = "xyz"
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_queue_file_path():
+    return queue_file_path + queue_file_name
+
+
+def _get_inflight_file_path():
+    return queue_file_path + inflight_file_name
+
+
+def _get_queue_guard_path():
+    return queue_file_path + queue_guard_name
+
+
+def _get_drain_guard_path():
+    return queue_file_path + drain_guard_name
+
+
+def _open_guard(path, flags=fcntl.LOCK_EX):
+    guard_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    try:
+        fcntl.flock(guard_fd, flags)
+    except BaseException:
+        os.close(guard_fd)
+        raise
+
+    return guard_fd
+
+
+def _close_guard(guard_fd):
+    try:
+        fcntl.flock(guard_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(guard_fd)
+
+
+def _read_messages(path):
+    messages = []
+
+    try:
+        with open(path) as queue:
+            for line in queue:
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return messages
+
+
+def _append_messages(path, messages):
+    if not messages:
+        return
+
+    data = "".join(json.dumps(message) + "\n" for message in messages)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    try:
+        os.write(fd, data.encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_messages(path, messages):
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as tmp_file:
+        for message in messages:
+            tmp_file.write(json.dumps(message) + "\n")
+
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _close(conn):
+    import smtplib
+
+    if conn is None:
+        return
+
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        conn.close()
+
+
+def pending():
+    return _read_messages(_get_inflight_file_path()) + _read_messages(_get_queue_file_path())
+
+
+def _take_queue():
+    # Same hand off as the sheet spool, an inflight file left behind by a
+    # notifier that died mid send is merged, not lost.
+    guard_fd = _open_guard(_get_queue_guard_path())
+
+    try:
+        messages = pending()
+
+        if messages:
+            _write_messages(_get_inflight_file_path(), messages)
+
+        _remove(_get_queue_file_path())
+        return messages
+    finally:
+        _close_guard(guard_fd)
+
+
+def enqueue(messages):
+    guard_fd = _open_guard(_get_queue_guard_path())
+
+    try:
+        _append_messages(_get_queue_file_path(), messages)
+    finally:
+        _close_guard(guard_fd)
+
+
+def start_drain():
+    # Same as the sheet flusher, a detached process sends the queue so no
+    # command waits for the mail server.
+    import subprocess
+
+    try:
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--retry"],
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             cwd=queue_file_path, close_fds=True, start_new_session=True)
+        return True
+    except Exception:
+        return False
+
+
+def _finish_queue(failed, drained):
+    guard_fd = _open_guard(_get_queue_guard_path())
+
+    try:
+        _append_messages(_get_queue_file_path(), failed)
+
+        if drained:
+            _remove(_get_inflight_file_path())
+    finally:
+        _close_guard(guard_fd)
+
+
+"""
+******************************
+******* Notifier *************
+******************************
+"""
+
+
+class Notifier:
+    def __init__(self, server=None, server_port=None, sender=None, sender_password=None, use_ssl=True, workers=None):
+        self._server = server or smtp_server
+        self._port = server_port or port
+        self._sender = sender or sender_email
+        self._password = sender_password if sender_password is not None else password
+        self._use_ssl = use_ssl
+        self._workers = workers or max_workers
+        self._drain = start_drain
+
+    def set_drain(self, drain):
+        self._drain = drain
+
+    def _connect(self):
+        # smtplib and ssl are only loaded when there is something to send
+        import smtplib
+        import ssl
+
+        if self._use_ssl:
+            conn = smtplib.SMTP_SSL(self._server, self._port, timeout=smtp_timeout,
+                                    context=ssl.create_default_context())
+        else:
+            conn = smtplib.SMTP(self._server, self._port, timeout=smtp_timeout)
+
+        try:
+            if self._password:
+                conn.login(self._sender, self._password)
+        except BaseException:
+            _close(conn)
+            raise
+
+        return conn
+
+    def _send_batch(self, batch):
+        # One connection and one login for the whole batch. A connection the
+        # server dropped midway is opened again once.
+        import smtplib
+
+        failed = []
+        conn = None
+        reconnected = False
+
+        for position, message in enumerate(batch):
+            while True:
+                try:
+                    if conn is None:
+                        conn = self._connect()
+
+                    conn.sendmail(self._sender, message["Email"], message["Message"])
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused):
+                    failed.append(message)
+                    break
+                except (smtplib.SMTPException, OSError):
+                    _close(conn)
+                    conn = None
+
+                    if reconnected:
+                        # The server is not there, keep the rest for a retry
+                        return failed + batch[position:]
+
+                    reconnected = True
+
+        _close(conn)
+        return failed
+
+    def send(self, messages):
+        if not messages:
+            return []
+
+        workers = min(self._workers, len(messages))
+        batches = [messages[i::workers] for i in range(workers)]
+
+        if workers == 1:
+            return self._send_batch(batches[0])
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return [message for failed in pool.map(self._send_batch, batches) for message in failed]
+
+    def post(self, recipients, msg):
+        # Queue the emails and return at once, the number of recipients is
+        # what this call asked for, not what the drain ends up sending.
+        if not recipients:
+            return 0
+
+        with timing.span("smtp.enqueue"):
+            enqueue([{"Email": email, "Message": msg, "Attempts": 0} for email in recipients])
+
+        self._drain()
+        return len(recipients)
+
+    def deliver(self, messages=None):
+        try:
+            drain_fd = _open_guard(_get_drain_guard_path(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another notifier is retrying the queue, only send our own
+            drain_fd = None
+
+        try:
+            messages = (_take_queue() if drain_fd is not None else []) + (messages or [])
+
+            with timing.span("smtp.send"):
+                failed = self.send(messages)
+
+            for a_message in failed:
+                a_message["Attempts"] += 1
+
+            _finish_queue([a_message for a_message in failed if a_message["Attempts"] < max_attempts],
+                          drain_fd is not None)
+            return len(messages) - len(failed)
+        finally:
+            if drain_fd is not None:
+                _close_guard(drain_fd)
+
+
+def from_config(config):
+    # Without an [SMTP] section nobody is emailed
+    if 'SMTP' not in config:
+        return None
+
+    section = config['SMTP']
+
+    return Notifier(section.get('server', fallback=None),
+                    section.getint('port', fallback=None),
+                    section.get('sender', fallback=None),
+                    section.get('password', fallback=None),
+                    section.getboolean('ssl', fallback=True),
+                    section.getint('workers', fallback=None))
+
+
+def run_drain(config):
+    # The background drain records its timing like the sheet flusher, the
+    # command that queued the emails never sees the SMTP time.
+    notifier = from_config(config)
+
+    if notifier is None:
+        return None
+
+    timing.start()
+    timing.configure(config)
+    delivered = notifier.deliver()
+    timing.finish("notify")
+    return delivered
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager notifier")
+
+    parser.add_argument('--retry', action='store_true', dest="RETRY", required=False,
+                        help="Send the emails waiting in the retry queue")
+
+    parser.add_argument('--pending', action='store_true', dest="PENDING", required=False,
+                        help="Print the emails waiting in the retry queue")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.RETRY:
+        import chassis_manager
+        import configparser
+
+        config = configparser.ConfigParser()
+        config.read(chassis_manager._get_config_file_path())
+
+        if run_drain(config) is None:
+            print("SMTP is not configured")
+            exit(1)
+
+        exit(1 if pending() else 0)
+
+    if args.PENDING:
+        for a_message in pending():
+            print(f"{a_message['Email']!s} attempts: {a_message['Attempts']!s}")
+        exit(0)
+
+    exit(1)
@@ -0,0 +1,190 @@
+import unittest
+import configparser
+import json
+import lock
+import notifier
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import timing
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough of SMTP for smtplib, every session is recorded on the server
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.mutex:
+            server.connections += 1
+
+        self._reply("220 localhost stand-in")
+        recipient = None
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode().strip()
+            verb = command.split(" ")[0].upper()
+
+            if verb in ["EHLO", "HELO"]:
+                self._reply("250-localhost")
+                self._reply("250 AUTH PLAIN")
+            elif verb == "AUTH":
+                with server.mutex:
+                    server.logins += 1
+                self._reply("235 Authenticated")
+            elif verb == "MAIL":
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                recipient = command.split(":", 1)[1].strip().strip("<>")
+
+                if recipient in server.refused:
+                    self._reply("550 No such user")
+                else:
+                    self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 Go ahead")
+
+                while self.rfile.readline().rstrip(b"\r\n") != b".":
+                    pass
+
+                with server.mutex:
+                    server.delivered.append(recipient)
+                self._reply("250 Queued")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.mutex = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.delivered = []
+        self.refused = set()
+
+
+def _messages(recipients, msg):
+    return [{"Email": email, "Message": msg, "Attempts": 0} for email in recipients]
+
+
+class NotifierTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._old_path = notifier.queue_file_path
+        self._queue_dir = tempfile.mkdtemp()
+        notifier.queue_file_path = self._queue_dir
+
+        self._server = _SMTPServer()
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def tearDown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+        notifier.queue_file_path = self._old_path
+        shutil.rmtree(self._queue_dir)
+
+    def _notifier(self, port=None, workers=2):
+        return notifier.Notifier("127.0.0.1", port or self._server.server_address[1], "chm@pavilion.io", "secret",
+                                 use_ssl=False, workers=workers)
+
+    def test_one_connection_per_worker(self):
+        recipients = [f"user{i!s}@pavilion.io" for i in range(10)]
+
+        delivered = self._notifier().deliver(_messages(recipients, "Subject: free\n\nfree"))
+        self.assertEqual(delivered, 10)
+        self.assertEqual(sorted(self._server.delivered), sorted(recipients))
+        self.assertEqual(self._server.connections, 2)
+        self.assertEqual(self._server.logins, 2)
+        self.assertEqual(notifier.pending(), [])
+
+    def test_unreachable_server_is_retried(self):
+        with socketserver.TCPServer(("127.0.0.1", 0), socketserver.BaseRequestHandler) as closed:
+            dead_port = closed.server_address[1]
+
+        delivered = self._notifier(dead_port).deliver(_messages(["a@pavilion.io", "b@pavilion.io"],
+                                                                "Subject: free\n\nfree"))
+        self.assertEqual(delivered, 0)
+        self.assertEqual(sorted(a_message["Email"] for a_message in notifier.pending()),
+                         ["a@pavilion.io", "b@pavilion.io"])
+
+        # The next notification drains the queue as well
+        delivered = self._notifier().deliver(_messages(["c@pavilion.io"], "Subject: free\n\nfree"))
+        self.assertEqual(delivered, 3)
+        self.assertEqual(sorted(self._server.delivered), ["a@pavilion.io", "b@pavilion.io", "c@pavilion.io"])
+        self.assertEqual(notifier.pending(), [])
+
+    def test_refused_recipient_is_dropped_after_max_attempts(self):
+        self._server.refused.add("gone@pavilion.io")
+        notifier_ = self._notifier(workers=1)
+
+        self.assertEqual(notifier_.deliver(_messages(["gone@pavilion.io", "ok@pavilion.io"], "Subject: free\n\nfree")),
+                         1)
+        self.assertEqual([a_message["Attempts"] for a_message in notifier.pending()], [1])
+
+        for attempt in range(notifier.max_attempts - 1):
+            notifier_.deliver()
+
+        self.assertEqual(notifier.pending(), [])
+        self.assertEqual(self._server.delivered, ["ok@pavilion.io"])
+
+    def test_notify_waiters_reaches_everybody(self):
+        old_path = lock.lock_file_path
+        lock.lock_file_path = self._queue_dir
+
+        try:
+            lck = lock.Lock()
+            for i in range(3):
+                lck.add_to_waiting_queue(f"user{i!s}@pavilion.io", True)
+
+            notifier_ = self._notifier()
+            drains = []
+            notifier_.set_drain(lambda: drains.append(True))
+
+            # Queued for the drain, nothing is sent while the lock is released
+            self.assertEqual(lck.notify_waiters("Subject: free\n\nfree", notifier_), 3)
+            self.assertEqual(lck.waiters(), [])
+            self.assertEqual((self._server.delivered, len(drains)), ([], 1))
+
+            self.assertEqual(notifier_.deliver(), 3)
+            self.assertEqual(sorted(self._server.delivered), [f"user{i!s}@pavilion.io" for i in range(3)])
+        finally:
+            lock.lock_file_path = old_path
+
+    def test_drain_records_its_timing(self):
+        old_log = timing.log_file
+        log_path = os.path.join(self._queue_dir, "timing.jsonl")
+        config = configparser.ConfigParser()
+        config.read_dict({"SMTP": {"server": "127.0.0.1", "port": str(self._server.server_address[1]), "ssl": "no"},
+                          "Timing": {"log": log_path}})
+        notifier.enqueue(_messages(["a@pavilion.io"], "Subject: free\n\nfree"))
+
+        try:
+            self.assertEqual(notifier.run_drain(config), 1)
+        finally:
+            timing.set_log_file(old_log)
+
+        with open(log_path) as log:
+            records = [json.loads(line) for line in log]
+
+        self.assertEqual([a_record["Command"] for a_record in records], ["notify"])
+        self.assertIn("smtp.send", [a_span["Name"] for a_span in records[0]["Spans"]])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,357 @@
+import argparse
+import fcntl
+import json
+import os
+import pathlib
+import sys
+import time
+import timing
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+spool_file_path = str(pathlib.Path(__file__).parent.absolute())
+spool_file_name = "/.chm_sync_spool.jsonl"
+inflight_file_name = "/.chm_sync_inflight.jsonl"
+spool_guard_name = "/.chm_sync_spool.guard"
+flusher_guard_name = "/.chm_sync_flusher.guard"
+
+max_attempts = 5
+retry_delay = 1.0
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_spool_file_path():
+    return spool_file_path + spool_file_name
+
+
+def _get_inflight_file_path():
+    return spool_file_path + inflight_file_name
+
+
+def _get_spool_guard_path():
+    return spool_file_path + spool_guard_name
+
+
+def _get_flusher_guard_path():
+    return spool_file_path + flusher_guard_name
+
+
+def _open_guard(path, flags=fcntl.LOCK_EX):
+    guard_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    try:
+        fcntl.flock(guard_fd, flags)
+    except BaseException:
+        os.close(guard_fd)
+        raise
+
+    return guard_fd
+
+
+def _close_guard(guard_fd):
+    try:
+        fcntl.flock(guard_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(guard_fd)
+
+
+def _read_records(path):
+    records = []
+
+    try:
+        with open(path) as spool:
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash, the next state change
+                    # spools a complete record for the chassis anyway.
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return records
+
+
+def _append_records(path, records):
+    if not records:
+        return
+
+    data = "".join(json.dumps(record) + "\n" for record in records)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+
+    try:
+        os.write(fd, data.encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_records(path, records):
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as tmp_file:
+        for record in records:
+            tmp_file.write(json.dumps(record) + "\n")
+
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def coalesce(records):
+    latest = {}
+
+    for record in records:
+        key = record["Name"]
+        if key not in latest or record["Seq"] >= latest[key]["Seq"]:
+            latest[key] = record
+
+    return sorted(latest.values(), key=lambda record: record["Seq"])
+
+
+def _chassis_config():
+    import chassis_manager
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read(chassis_manager._get_config_file_path())
+    return config
+
+
+def _default_sheet_factory(name, ip):
+    import status_backend
+    return status_backend.open_backend(name, ip, _chassis_config())
+
+
+"""
+******************************
+******* Spool ****************
+******************************
+"""
+
+
+def enqueue(name, ip, lock_name, owners, waiters):
+    record = {
+        "Seq": time.time_ns(),
+        "Name": name,
+        "Ip": ip,
+        "Lock": lock_name,
+        "Owners": [owner['Email'] for owner in owners],
+        "Waiters": [waiter['Email'] for waiter in waiters]
+    }
+
+    guard_fd = _open_guard(_get_spool_guard_path())
+
+    try:
+        _append_records(_get_spool_file_path(), [record])
+    finally:
+        _close_guard(guard_fd)
+
+    return record
+
+
+def pending():
+    return coalesce(_read_records(_get_inflight_file_path()) + _read_records(_get_spool_file_path()))
+
+
+def _take_pending():
+    # Move everything spooled so far into the inflight file. An inflight file
+    # left behind by a flusher that died mid push is merged, not lost.
+    guard_fd = _open_guard(_get_spool_guard_path())
+
+    try:
+        records = pending()
+
+        if records:
+            _write_records(_get_inflight_file_path(), records)
+
+        try:
+            os.remove(_get_spool_file_path())
+        except FileNotFoundError:
+            pass
+
+        return records
+    finally:
+        _close_guard(guard_fd)
+
+
+def _finish_pending(failed):
+    guard_fd = _open_guard(_get_spool_guard_path())
+
+    try:
+        # Failed records go back with their original sequence number, so a
+        # newer state spooled meanwhile still wins the next coalesce.
+        _append_records(_get_spool_file_path(), failed)
+
+        try:
+            os.remove(_get_inflight_file_path())
+        except FileNotFoundError:
+            pass
+    finally:
+        _close_guard(guard_fd)
+
+
+"""
+******************************
+******* Flusher **************
+******************************
+"""
+
+
+def _sync_metrics():
+    import metrics
+    return metrics.from_config(_chassis_config())
+
+
+def _push(record, sheets, sheet_factory):
+    key = (record["Name"], record["Ip"])
+    owners = [{"Email": email} for email in record["Owners"]]
+    waiters = [{"Email": email} for email in record["Waiters"]]
+
+    try:
+        with timing.span("sheet.push"):
+            if key not in sheets:
+                sheets[key] = sheet_factory(record["Name"], record["Ip"])
+
+            success, error = sheets[key].update_info(record["Lock"], owners, waiters)
+    except Exception as e:
+        success, error = False, str(e)
+
+    if not success:
+        sheets.pop(key, None)
+
+    return success, error
+
+
+def flush(sheet_factory=None, attempts=None, delay=None):
+    sheet_factory = sheet_factory or _default_sheet_factory
+    attempts = attempts or max_attempts
+    delay = retry_delay if delay is None else delay
+
+    records = _take_pending()
+    sheets = {}
+    pushed = 0
+    failed = []
+    sync_metrics = _sync_metrics() if records else None
+
+    for record in records:
+        wait = delay
+        start = time.perf_counter()
+
+        for attempt in range(attempts):
+            success, error = _push(record, sheets, sheet_factory)
+            if success:
+                pushed += 1
+                break
+
+            if attempt + 1 < attempts:
+                time.sleep(wait)
+                wait *= 2
+        else:
+            failed.append(record)
+
+        if sync_metrics is not None:
+            if success:
+                sync_metrics.observe("chm_sheet_sync_seconds", time.perf_counter() - start)
+            else:
+                sync_metrics.inc("chm_sheet_sync_failures_total")
+
+    _finish_pending(failed)
+
+    if sync_metrics is not None:
+        sync_metrics.commit()
+
+    return pushed, len(failed)
+
+
+def run_flusher(sheet_factory=None, attempts=None, delay=None):
+    pushed = 0
+
+    while True:
+        try:
+            guard_fd = _open_guard(_get_flusher_guard_path(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another flusher is already draining the spool
+            return pushed, 0
+
+        failed = 0
+
+        try:
+            while pending():
+                done, failed = flush(sheet_factory, attempts, delay)
+                pushed += done
+
+                if failed:
+                    break
+        finally:
+            _close_guard(guard_fd)
+
+        # A record spooled after the last check but before the guard was
+        # released would otherwise wait for the next state change.
+        if failed or not pending():
+            return pushed, failed
+
+
+def start_flusher():
+    import subprocess
+
+    try:
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--flush"],
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             cwd=spool_file_path, close_fds=True, start_new_session=True)
+        return True
+    except Exception:
+        return False
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager sheet sync")
+
+    parser.add_argument('--flush', action='store_true', dest="FLUSH", required=False,
+                        help="Push the spooled lock state changes to the sheet")
+
+    parser.add_argument('--pending', action='store_true', dest="PENDING", required=False,
+                        help="Print the lock state changes waiting to be pushed")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+
+    if args.FLUSH:
+        timing.start()
+        timing.configure(_chassis_config())
+        pushed, failed = run_flusher()
+        timing.finish("flush")
+        exit(1 if failed else 0)
+
+    if args.PENDING:
+        for a_record in pending():
+            print(f"{a_record['Name']!s} [{a_record['Ip']!s}] {a_record['Lock']!s} "
+                  f"owners: {', '.join(a_record['Owners'])!s} waiters: {', '.join(a_record['Waiters'])!s}")
+        exit(0)
+
+    exit(1)
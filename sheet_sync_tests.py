@@ -0,0 +1,85 @@
+import unittest
+import sheet_sync
+import shutil
+import tempfile
+
+
+class FakeSheet:
+    def __init__(self, updates, failures):
+        self._updates = updates
+        self._failures = failures
+
+    def update_info(self, lock, owners=None, waiters=None):
+        if self._failures[0]:
+            self._failures[0] -= 1
+            return False, "quota exceeded"
+
+        self._updates.append((lock, [owner['Email'] for owner in owners], [waiter['Email'] for waiter in waiters]))
+        return True, None
+
+
+class SheetSyncTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._old_path = sheet_sync.spool_file_path
+        sheet_sync.spool_file_path = tempfile.mkdtemp()
+        self._updates = {}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(sheet_sync.spool_file_path)
+        sheet_sync.spool_file_path = self._old_path
+
+    def _factory(self, failures=0):
+        failures = [failures]
+
+        def factory(name, ip):
+            return FakeSheet(self._updates.setdefault(name, []), failures)
+        return factory
+
+    def test_latest_state_wins(self):
+        sheet_sync.enqueue("gullu", "10.10.10.10", "EXCLUSIVE", [{"Email": "a@pavilion.io"}], [])
+        sheet_sync.enqueue("pillu", "10.10.10.11", "SHARED", [{"Email": "b@pavilion.io"}], [])
+        sheet_sync.enqueue("gullu", "10.10.10.10", "FREE", [], [])
+        self.assertEqual(len(sheet_sync.pending()), 2)
+
+        pushed, failed = sheet_sync.run_flusher(self._factory(), delay=0)
+        self.assertEqual((pushed, failed), (2, 0))
+        self.assertEqual(self._updates["gullu"], [("FREE", [], [])])
+        self.assertEqual(self._updates["pillu"], [("SHARED", ["b@pavilion.io"], [])])
+        self.assertEqual(sheet_sync.pending(), [])
+
+    def test_retry(self):
+        sheet_sync.enqueue("gullu", "10.10.10.10", "EXCLUSIVE", [{"Email": "a@pavilion.io"}], [{"Email": "b@pavilion.io"}])
+
+        pushed, failed = sheet_sync.run_flusher(self._factory(failures=1), attempts=3, delay=0)
+        self.assertEqual((pushed, failed), (1, 0))
+        self.assertEqual(self._updates["gullu"], [("EXCLUSIVE", ["a@pavilion.io"], ["b@pavilion.io"])])
+
+    def test_failed_push_is_kept(self):
+        sheet_sync.enqueue("gullu", "10.10.10.10", "EXCLUSIVE", [{"Email": "a@pavilion.io"}], [])
+
+        def broken(name, ip):
+            raise ConnectionError("sheets unreachable")
+
+        pushed, failed = sheet_sync.run_flusher(broken, attempts=2, delay=0)
+        self.assertEqual((pushed, failed), (0, 1))
+        self.assertEqual(len(sheet_sync.pending()), 1)
+
+        sheet_sync.enqueue("gullu", "10.10.10.10", "FREE", [], [])
+        pushed, failed = sheet_sync.run_flusher(self._factory(), delay=0)
+        self.assertEqual((pushed, failed), (1, 0))
+        self.assertEqual(self._updates["gullu"], [("FREE", [], [])])
+
+    def test_inflight_recovery(self):
+        record = sheet_sync.enqueue("gullu", "10.10.10.10", "EXCLUSIVE", [{"Email": "a@pavilion.io"}], [])
+        sheet_sync._take_pending()
+
+        # The flusher died before pushing, the record lives in the inflight file
+        self.assertEqual(sheet_sync.pending(), [record])
+
+        pushed, failed = sheet_sync.run_flusher(self._factory(), delay=0)
+        self.assertEqual((pushed, failed), (1, 0))
+        self.assertEqual(sheet_sync.pending(), [])
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
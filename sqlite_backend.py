@@ -0,0 +1,237 @@
+import argparse
+import pathlib
+import sqlite3
+
+from datetime import datetime
+
+import status_backend
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+database_file_path = str(pathlib.Path(__file__).parent.absolute())
+database_file_name = "/.chm_status.db"
+
+busy_timeout = 10
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS chassis ("
+    "name TEXT PRIMARY KEY, ip TEXT NOT NULL DEFAULT '', lock TEXT NOT NULL DEFAULT 'FREE', "
+    "updated TEXT)",
+    "CREATE INDEX IF NOT EXISTS chassis_ip ON chassis (ip)",
+    "CREATE INDEX IF NOT EXISTS chassis_lock ON chassis (lock)",
+    "CREATE TABLE IF NOT EXISTS owners ("
+    "chassis TEXT NOT NULL REFERENCES chassis (name) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "email TEXT NOT NULL, PRIMARY KEY (chassis, email))",
+    "CREATE INDEX IF NOT EXISTS owners_email ON owners (email)",
+    "CREATE TABLE IF NOT EXISTS waiters ("
+    "chassis TEXT NOT NULL REFERENCES chassis (name) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "position INTEGER NOT NULL, email TEXT NOT NULL, PRIMARY KEY (chassis, position))",
+    "CREATE INDEX IF NOT EXISTS waiters_email ON waiters (email)",
+]
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _get_database_file_path():
+    return database_file_path + database_file_name
+
+
+def database_from_config(config):
+    # [Sync] database = /srv/chm/status.db, the install directory otherwise
+    if 'Sync' in config and config['Sync'].get('database'):
+        return config['Sync'].get('database')
+
+    return _get_database_file_path()
+
+
+def _emails(records):
+    return [a_record['Email'] for a_record in records or []]
+
+
+"""
+******************************
+******* SQLite Store *********
+******************************
+"""
+
+
+class SQLiteStore:
+    # The consolidated chassis table of a lab, one row per chassis with its
+    # owners and waiters in their own indexed tables.
+    def __init__(self, path=None):
+        self._path = path or _get_database_file_path()
+        self._conn = sqlite3.connect(self._path, timeout=busy_timeout, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+
+        # WAL lets the fleet queries read while a chassis writes. Commits
+        # only wait for the log, a power cut may lose the last update but
+        # never corrupts the table, and the next update rewrites the row.
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA foreign_keys = ON")
+
+        for statement in schema:
+            self._conn.execute(statement)
+
+    def close(self):
+        self._conn.close()
+
+    def _locate(self, name, ip):
+        # Same as the sheet, a chassis is found by its name and then by its ip
+        row = self._conn.execute("SELECT name FROM chassis WHERE name = ?", (name,)).fetchone()
+
+        if row is None and ip:
+            row = self._conn.execute("SELECT name FROM chassis WHERE ip = ?", (ip,)).fetchone()
+
+        return None if row is None else row["name"]
+
+    def _write(self, name, ip, lock, owners, waiters):
+        current = self._locate(name, ip)
+        now = str(datetime.now())
+
+        if current is None:
+            self._conn.execute("INSERT INTO chassis (name, ip, lock, updated) VALUES (?, ?, ?, ?)",
+                               (name, ip or '', lock, now))
+        else:
+            # A renamed chassis keeps its row, the owners follow the rename
+            self._conn.execute("UPDATE chassis SET name = ?, ip = ?, lock = ?, updated = ? WHERE name = ?",
+                               (name, ip or '', lock, now, current))
+
+        self._conn.execute("DELETE FROM owners WHERE chassis = ?", (name,))
+        self._conn.executemany("INSERT OR IGNORE INTO owners (chassis, email) VALUES (?, ?)",
+                               [(name, email) for email in owners])
+
+        self._conn.execute("DELETE FROM waiters WHERE chassis = ?", (name,))
+        self._conn.executemany("INSERT INTO waiters (chassis, position, email) VALUES (?, ?, ?)",
+                               [(name, position, email) for position, email in enumerate(waiters)])
+
+    def update_many(self, rows):
+        # rows are (name, ip, lock, owner emails, waiter emails), written in
+        # one transaction
+        self._conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            for name, ip, lock, owners, waiters in rows:
+                self._write(name, ip, lock, owners, waiters)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        self._conn.execute("COMMIT")
+
+    def update(self, name, ip, lock, owners=None, waiters=None):
+        self.update_many([(name, ip, lock, owners or [], waiters or [])])
+
+    def _chassis(self, where, params):
+        # Three queries whatever the number of chassis, not three per chassis
+        chassis = {}
+
+        for row in self._conn.execute(f"SELECT name, ip, lock, updated FROM chassis {where!s} ORDER BY name",
+                                      params):
+            chassis[row["name"]] = {
+                "Name": row["name"],
+                "Ip": row["ip"],
+                "Lock": row["lock"],
+                "Updated": row["updated"],
+                "Owners": [],
+                "Waiters": []
+            }
+
+        for row in self._conn.execute(f"SELECT chassis, email FROM owners WHERE chassis IN "
+                                      f"(SELECT name FROM chassis {where!s}) ORDER BY rowid", params):
+            chassis[row["chassis"]]["Owners"].append(row["email"])
+
+        for row in self._conn.execute(f"SELECT chassis, email FROM waiters WHERE chassis IN "
+                                      f"(SELECT name FROM chassis {where!s}) ORDER BY position", params):
+            chassis[row["chassis"]]["Waiters"].append(row["email"])
+
+        return list(chassis.values())
+
+    def chassis(self, name):
+        found = self._chassis("WHERE name = ?", (name,))
+        return found[0] if found else None
+
+    def all_chassis(self):
+        return self._chassis("", ())
+
+    def with_lock(self, lock):
+        return self._chassis("WHERE lock = ?", (lock.upper(),))
+
+    def owned_by(self, email):
+        return self._chassis("WHERE name IN (SELECT chassis FROM owners WHERE email = ?)", (email,))
+
+    def waited_on_by(self, email):
+        return self._chassis("WHERE name IN (SELECT chassis FROM waiters WHERE email = ?)", (email,))
+
+
+class SQLiteBackend(status_backend.StatusBackend):
+    def __init__(self, name, ip, path=None, store=None):
+        self._store = store or SQLiteStore(path)
+        self._chassis_name = name
+        self._chassis_ip = ip
+
+    def update_info(self, lock, owners=None, waiters=None):
+        try:
+            self._store.update(self._chassis_name, self._chassis_ip, lock, _emails(owners), _emails(waiters))
+        except sqlite3.Error as e:
+            return False, str(e)
+
+        return True, None
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="query the consolidated chassis table")
+
+    parser.add_argument('--database', dest="DATABASE", required=False,
+                        help="Status database, the one in the install directory by default")
+
+    parser.add_argument('--owned-by', dest="OWNED_BY", required=False,
+                        help="Chassis locked by this email")
+
+    parser.add_argument('--waited-on-by', dest="WAITED_ON_BY", required=False,
+                        help="Chassis this email is queued for")
+
+    parser.add_argument('--lock-state', dest="LOCK_STATE", required=False,
+                        help="Chassis in this lock state, FREE, SHARED or EXCLUSIVE")
+
+    parser.add_argument('--chassis', dest="CHASSIS", required=False,
+                        help="Only this chassis")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+    store = SQLiteStore(args.DATABASE)
+
+    if args.OWNED_BY is not None:
+        found = store.owned_by(args.OWNED_BY)
+    elif args.WAITED_ON_BY is not None:
+        found = store.waited_on_by(args.WAITED_ON_BY)
+    elif args.LOCK_STATE is not None:
+        found = store.with_lock(args.LOCK_STATE)
+    elif args.CHASSIS is not None:
+        found = [a_chassis for a_chassis in [store.chassis(args.CHASSIS)] if a_chassis is not None]
+    else:
+        found = store.all_chassis()
+
+    for a_chassis in found:
+        print(f"{a_chassis['Name']!s} [{a_chassis['Ip']!s}] {a_chassis['Lock']!s} "
+              f"owners: {', '.join(a_chassis['Owners'])!s} waiters: {', '.join(a_chassis['Waiters'])!s}")
+
+    store.close()
+    exit(0 if found else 1)
@@ -0,0 +1,108 @@
+import unittest
+import chassis_manager
+import configparser
+import fleet_sync
+import json
+import lock
+import os
+import shutil
+import sqlite_backend
+import status_backend
+import tempfile
+
+
+class SQLiteBackendTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, "status.db")
+        self._store = sqlite_backend.SQLiteStore(self._path)
+
+    def tearDown(self) -> None:
+        self._store.close()
+        shutil.rmtree(self._dir)
+
+    def _fill(self):
+        self._store.update("gullu", "10.10.10.10", "EXCLUSIVE", ["alice@pavilion.io"], ["bob@pavilion.io"])
+        self._store.update("pillu", "10.10.10.11", "SHARED", ["alice@pavilion.io", "bob@pavilion.io"])
+        self._store.update("tillu", "10.10.10.12", "FREE")
+
+    def test_fleet_queries(self):
+        self._fill()
+
+        self.assertEqual([a_chassis["Name"] for a_chassis in self._store.owned_by("alice@pavilion.io")],
+                         ["gullu", "pillu"])
+        self.assertEqual([a_chassis["Name"] for a_chassis in self._store.with_lock("free")], ["tillu"])
+        self.assertEqual([a_chassis["Name"] for a_chassis in self._store.waited_on_by("bob@pavilion.io")],
+                         ["gullu"])
+        self.assertEqual(self._store.chassis("pillu")["Owners"], ["alice@pavilion.io", "bob@pavilion.io"])
+        self.assertIsNone(self._store.chassis("nope"))
+        self.assertEqual(len(self._store.all_chassis()), 3)
+
+    def test_update_replaces_owners_and_waiters(self):
+        self._fill()
+        self._store.update("gullu", "10.10.10.10", "FREE")
+
+        gullu = self._store.chassis("gullu")
+        self.assertEqual((gullu["Lock"], gullu["Owners"], gullu["Waiters"]), ("FREE", [], []))
+        self.assertEqual([a_chassis["Name"] for a_chassis in self._store.owned_by("alice@pavilion.io")], ["pillu"])
+
+    def test_chassis_found_by_ip_is_renamed(self):
+        self._fill()
+        self._store.update("gullu2", "10.10.10.10", "SHARED", ["carol@pavilion.io"])
+
+        self.assertIsNone(self._store.chassis("gullu"))
+        self.assertEqual(self._store.chassis("gullu2")["Owners"], ["carol@pavilion.io"])
+        self.assertEqual(len(self._store.all_chassis()), 3)
+
+    def test_wal_and_indexes(self):
+        self.assertEqual(self._store._conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+        for query, index in [("SELECT chassis FROM owners WHERE email = 'x'", "owners_email"),
+                             ("SELECT name FROM chassis WHERE ip = 'x'", "chassis_ip"),
+                             ("SELECT name FROM chassis WHERE lock = 'FREE'", "chassis_lock")]:
+            plan = " ".join(row[3] for row in self._store._conn.execute("EXPLAIN QUERY PLAN " + query))
+            self.assertIn(index, plan)
+
+    def test_backend_from_config(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"Sync": {"backend": "sqlite", "database": self._path}})
+
+        backend = status_backend.open_backend("gullu", "10.10.10.10", config)
+        self.assertIsInstance(backend, status_backend.StatusBackend)
+        self.assertEqual(backend.update_info("EXCLUSIVE", [lock.Owner({"Name": "a", "Email": "a@pavilion.io"})], []),
+                         (True, None))
+        self.assertEqual(self._store.chassis("gullu")["Owners"], ["a@pavilion.io"])
+
+    def test_unknown_backend(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"Sync": {"backend": "sqlite3"}})
+
+        with self.assertRaisesRegex(status_backend.UnknownBackend, "sqlite3"):
+            status_backend.open_backend("gullu", "10.10.10.10", config)
+
+        with self.assertRaises(TypeError):
+            status_backend.StatusBackend()
+
+    def test_fleet_sync_to_database(self):
+        dirs = []
+
+        for name, lock_type, owners in [("gullu", "EXCLUSIVE", ["a@pavilion.io"]), ("pillu", "FREE", [])]:
+            chassis_dir = os.path.join(self._dir, name)
+            os.makedirs(chassis_dir)
+
+            with open(chassis_dir + chassis_manager.config_file_name, "w") as config_file:
+                config_file.write(f"[Chassis]\nname = {name!s}\nip = 10.0.0.{len(dirs)!s}\n")
+
+            with open(chassis_dir + lock.lock_file_name, "w") as lock_file:
+                json.dump({"Type": lock_type, "Owners": [{"Name": "x", "Email": email} for email in owners],
+                           "Waiters": []}, lock_file)
+
+            dirs.append(chassis_dir)
+
+        self.assertEqual(fleet_sync.sync_store(dirs, self._store), 2)
+        self.assertEqual([a_chassis["Name"] for a_chassis in self._store.owned_by("a@pavilion.io")], ["gullu"])
+        self.assertEqual(self._store.chassis("pillu")["Lock"], "FREE")
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import bench
+import os
+
+
+class StartupTest(unittest.TestCase):
+    def test_read_only_commands_skip_heavy_modules(self):
+        for command in bench.startup_commands:
+            result = bench.run_startup(command, runs=1)
+
+            self.assertIn("chassis_manager", result["modules"])
+            self.assertEqual(sorted(set(bench.startup_forbidden) & result["modules"]), [])
+
+    # Wall clock budgets depend on the machine and its load, they only run
+    # when asked for.
+    @unittest.skipUnless(os.environ.get("CHM_TIMING_TESTS"), "set CHM_TIMING_TESTS=1 to check the import budget")
+    def test_import_budget(self):
+        for command in bench.startup_commands:
+            result = bench.run_startup(command, runs=3)
+            self.assertLess(result["import_ms"], bench.startup_budget_ms)
+
+    def test_parse_importtime(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 | encodings",
+            "import time:       200 |        300 | site",
+            "import time:        50 |         50 |   json.decoder",
+            "import time:       100 |        150 | json",
+            "import time:       400 |        400 | argparse",
+        ])
+
+        modules, total_us = bench._parse_importtime(output)
+        self.assertEqual(modules, {"json.decoder", "json", "argparse"})
+        self.assertEqual(total_us, 550)
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
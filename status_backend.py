@@ -0,0 +1,65 @@
+import abc
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+default_backend = "gsheet"
+backends = ["gsheet", "sqlite", "fake"]
+
+"""
+******************************
+******* Exceptions ***********
+******************************
+"""
+
+
+class UnknownBackend(Exception):
+    pass
+
+
+"""
+******************************
+******* Status Backend *******
+******************************
+"""
+
+
+class StatusBackend(abc.ABC):
+    # The consolidated view of one chassis. The lock file stays the source
+    # of truth, a backend only shows its latest state to everybody else.
+    @abc.abstractmethod
+    def update_info(self, lock, owners=None, waiters=None):
+        pass
+
+
+def backend_name(config):
+    # [Sync] backend = gsheet, sqlite or fake
+    if 'Sync' not in config:
+        return default_backend
+
+    return config['Sync'].get('backend', default_backend)
+
+
+def open_backend(name, ip, config):
+    backend = backend_name(config)
+
+    if backend not in backends:
+        # A typo must not send the chassis state to the shared Google sheet
+        raise UnknownBackend(f"Unknown [Sync] backend '{backend!s}', use one of {', '.join(backends)!s}")
+
+    if backend == "sqlite":
+        import sqlite_backend
+        return sqlite_backend.SQLiteBackend(name, ip, sqlite_backend.database_from_config(config))
+
+    # gspread and the oauth client are only loaded for the sheet
+    import gsheet
+
+    if backend == "fake":
+        # Keeps the pushes in a local file shared by every process, for load
+        # tests that must not hit the real sheet.
+        import fake_gsheet
+        return gsheet.GSheet(name, ip, fake_gsheet.FileWorksheet(fake_gsheet.sheet_from_config(config)))
+
+    return gsheet.GSheet(name, ip)
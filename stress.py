@@ -0,0 +1,348 @@
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import bench
+import chm_client
+import fake_gsheet
+import gsheet
+import history
+import lock
+import sheet_sync
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+# Relative weight of every command in the random mix
+command_mix = {
+    "exclusive": 25,
+    "shared": 25,
+    "unlock": 30,
+    "owners": 15,
+    "history": 5
+}
+
+monitor_interval = 0.005
+daemon_start_timeout = 10
+sync_timeout = 30
+
+chassis_name = "stress"
+chassis_ip = "127.0.0.1"
+
+"""
+******************************
+******* Utility Functions ****
+******************************
+"""
+
+
+def _argv(command, email):
+    if command in ["exclusive", "shared"]:
+        return ["--lock", "--lock-type", command, "--name", email.split("@")[0], "--email", email]
+
+    if command == "unlock":
+        return ["--unlock", "--email", email]
+
+    if command == "owners":
+        return ["--lock-owners"]
+
+    return ["--lock-history", "--tail", "10"]
+
+
+def check_state(text):
+    # The invariants every lock file written by any version must hold
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return ["corrupt lock file"]
+
+    violations = []
+    owners = [a_owner["Email"] for a_owner in data.get("Owners", [])]
+
+    if data.get("Type") == "EXCLUSIVE" and len(owners) > 1:
+        violations.append(f"{len(owners)!s} exclusive owners")
+
+    if data.get("Type") == "FREE" and owners:
+        violations.append("free lock with owners")
+
+    if data.get("Type") in ["EXCLUSIVE", "SHARED"] and not owners:
+        violations.append(f"{data['Type']!s} lock without owners")
+
+    if len(set(owners)) != len(owners):
+        violations.append("duplicate owners")
+
+    return violations
+
+
+def check_sheet(text, rows):
+    # The sheet row must end up showing the final lock state
+    data = json.loads(text)
+    expected = gsheet.build_row(chassis_name, chassis_ip, data["Type"], data["Owners"], data["Waiters"])
+    found = [row for row in rows if row[:2] == expected[:2]]
+
+    if len(found) != 1:
+        return [f"{len(found)!s} sheet rows for the chassis"]
+
+    if found[0] + [''] * (len(expected) - len(found[0])) != expected:
+        return [f"sheet shows {found[0]!s}, lock file {expected!s}"]
+
+    return []
+
+
+def check_history(results, history_dir):
+    # Every lock, unlock and denied lock leaves exactly one history entry
+    expected = {"Lock": 0, "Unlock": 0, "Queried": 0}
+
+    for a_result in results:
+        if a_result["Command"] in ["exclusive", "shared"]:
+            expected["Lock" if a_result["Output"] == "Lock acquired successfully\n" else "Queried"] += 1
+
+        if a_result["Command"] == "unlock" and a_result["Output"].endswith("Lock released successfully\n"):
+            expected["Unlock"] += 1
+
+    found = {"Lock": 0, "Unlock": 0, "Queried": 0}
+
+    for a_record in history.HistoryLog(history_dir).records():
+        action = "Lock" if a_record["Action"] in ["Exclusive lock", "Shared lock"] else a_record["Action"]
+
+        if action in found:
+            found[action] += 1
+
+    return [f"{action!s}: {expected[action]!s} expected, {found[action]!s} in history"
+            for action in expected if expected[action] != found[action]]
+
+
+"""
+******************************
+******* Stress ***************
+******************************
+"""
+
+
+class StressRun:
+    def __init__(self, users, ops, seed=None, use_daemon=False):
+        self._users = users
+        self._ops = ops
+        self._random = random.Random(seed)
+        self._use_daemon = use_daemon
+        self._work_dir = None
+        self._daemon = None
+        self._violations = []
+        self._violations_lock = threading.Lock()
+        self._running = False
+
+    def _setup(self):
+        # A scratch copy of the scripts, so the run has its own lock file,
+        # history, spool and daemon socket and never touches the real sheet.
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        self._work_dir = tempfile.mkdtemp(prefix="chm_stress_")
+
+        for path in glob.glob(os.path.join(src_dir, "*.py")):
+            shutil.copy(path, self._work_dir)
+
+        with open(os.path.join(self._work_dir, "chm_config.conf"), "w") as config_file:
+            config_file.write(f"[Chassis]\nname = {chassis_name!s}\nip = {chassis_ip!s}\n\n[Sync]\nbackend = fake\n")
+
+        if self._use_daemon:
+            self._start_daemon()
+
+    def _start_daemon(self):
+        self._daemon = subprocess.Popen([sys.executable, os.path.join(self._work_dir, "chm_daemon.py")],
+                                        cwd=self._work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        socket_path = self._work_dir + chm_client.socket_file_name
+        deadline = time.monotonic() + daemon_start_timeout
+
+        while not os.path.exists(socket_path):
+            if time.monotonic() > deadline or self._daemon.poll() is not None:
+                raise RuntimeError("Chassis manager daemon did not start")
+
+            time.sleep(0.05)
+
+    def _teardown(self):
+        if self._daemon is not None:
+            self._daemon.terminate()
+            self._daemon.wait(10)
+
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def _wait_for_sync(self):
+        # The last states are still being pushed by a background flusher
+        spooled = [self._work_dir + sheet_sync.spool_file_name, self._work_dir + sheet_sync.inflight_file_name]
+        deadline = time.monotonic() + sync_timeout
+
+        while any(os.path.exists(path) for path in spooled):
+            if time.monotonic() > deadline:
+                return False
+
+            time.sleep(0.05)
+
+        return True
+
+    def _sheet_rows(self):
+        try:
+            with open(self._work_dir + fake_gsheet.sheet_file_name) as sheet_file:
+                return json.load(sheet_file)
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def _violation(self, text):
+        with self._violations_lock:
+            self._violations.append(text)
+
+    def _monitor(self):
+        lock_path = self._work_dir + lock.lock_file_name
+
+        while self._running:
+            try:
+                with open(lock_path) as lock_file:
+                    text = lock_file.read()
+            except FileNotFoundError:
+                text = None
+
+            if text is not None:
+                for a_violation in check_state(text):
+                    self._violation(a_violation)
+
+            time.sleep(monitor_interval)
+
+    def _user(self, index, commands):
+        email = f"user{index!s}@pavilion.io"
+        results = []
+        daemon_args = [] if self._use_daemon else ["--no-daemon"]
+
+        for a_command in commands:
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, os.path.join(self._work_dir, "main.py")] + daemon_args
+                                  + _argv(a_command, email),
+                                  cwd=self._work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            latency = time.perf_counter() - start
+
+            if proc.returncode != 0:
+                self._violation(f"{a_command!s} by {email!s} exited with {proc.returncode!s}: {proc.stdout.strip()!s}")
+
+            results.append({"Command": a_command, "Email": email, "Latency": latency, "Output": proc.stdout})
+
+        return results
+
+    def run(self):
+        names = list(command_mix)
+        weights = [command_mix[name] for name in names]
+        plans = [self._random.choices(names, weights, k=self._ops) for _ in range(self._users)]
+
+        self._setup()
+        self._running = True
+        monitor = threading.Thread(target=self._monitor)
+        monitor.start()
+
+        try:
+            start = time.perf_counter()
+
+            with ThreadPoolExecutor(max_workers=self._users) as pool:
+                results = [a_result for user_results in pool.map(self._user, range(self._users), plans)
+                           for a_result in user_results]
+
+            elapsed = time.perf_counter() - start
+        finally:
+            self._running = False
+            monitor.join()
+
+        try:
+            with open(self._work_dir + lock.lock_file_name) as lock_file:
+                text = lock_file.read()
+        except FileNotFoundError:
+            text = None
+
+        final_violations = check_state(text) if text is not None else []
+
+        for a_violation in final_violations:
+            self._violation(f"final state: {a_violation!s}")
+
+        if text is not None and not final_violations:
+            if not self._wait_for_sync():
+                self._violation("sheet sync did not finish")
+            else:
+                for a_violation in check_sheet(text, self._sheet_rows()):
+                    self._violation(f"sheet: {a_violation!s}")
+
+        for a_violation in check_history(results, self._work_dir + lock.history_dir_name):
+            self._violation(f"lost history, {a_violation!s}")
+
+        self._teardown()
+
+        return {
+            "ops": len(results),
+            "seconds": elapsed,
+            "throughput": len(results) / elapsed if elapsed else 0.0,
+            "latencies": {name: [a_result["Latency"] for a_result in results if a_result["Command"] == name]
+                          for name in names},
+            "violations": sorted(set(self._violations))
+        }
+
+
+"""
+******************************
+******* The Main *************
+******************************
+"""
+
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description="chassis manager stress test")
+
+    parser.add_argument('-u', '--users', dest="USERS", type=int, default=100,
+                        help="Number of simulated users running commands at the same time")
+
+    parser.add_argument('-o', '--ops', dest="OPS", type=int, default=10,
+                        help="Number of commands every user runs")
+
+    parser.add_argument('--seed', dest="SEED", type=int, required=False,
+                        help="Seed for the random command mix")
+
+    parser.add_argument('--daemon', action='store_true', dest="DAEMON", required=False,
+                        help="Serve the commands through a chassis manager daemon")
+
+    parser.add_argument('--json', action='store_true', dest="JSON", required=False,
+                        help="Print the results as JSON")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+    result = StressRun(args.USERS, args.OPS, args.SEED, args.DAEMON).run()
+
+    if args.JSON:
+        summary = {name: {"p50_ms": bench._percentile(samples, 50) * 1000,
+                          "p99_ms": bench._percentile(samples, 99) * 1000,
+                          "count": len(samples)}
+                   for name, samples in result["latencies"].items()}
+        print(json.dumps({"ops": result["ops"], "seconds": result["seconds"],
+                          "throughput": result["throughput"], "latency": summary,
+                          "violations": result["violations"]}, indent=2, sort_keys=True))
+    else:
+        print(f"{result['ops']!s} commands by {args.USERS!s} users in {result['seconds']:.1f} s, "
+              f"{result['throughput']:.1f} commands/s")
+
+        for name, samples in result["latencies"].items():
+            if samples:
+                print(f"  {name!s:<10} {len(samples)!s:>6} runs   p50 {bench._percentile(samples, 50) * 1000:8.1f} ms   "
+                      f"p99 {bench._percentile(samples, 99) * 1000:8.1f} ms")
+
+        for a_violation in result["violations"]:
+            print(f"VIOLATION: {a_violation!s}")
+
+        print("No invariant violations" if not result["violations"] else "Invariant violations FOUND")
+
+    exit(1 if result["violations"] else 0)
@@ -0,0 +1,48 @@
+import unittest
+import json
+import stress
+
+
+class CheckStateTest(unittest.TestCase):
+    def _state(self, lock_type, owners):
+        return json.dumps({"Type": lock_type, "Owners": [{"Name": "x", "Email": email} for email in owners],
+                           "Waiters": []})
+
+    def test_valid_states(self):
+        self.assertEqual(stress.check_state(self._state("FREE", [])), [])
+        self.assertEqual(stress.check_state(self._state("EXCLUSIVE", ["a@pavilion.io"])), [])
+        self.assertEqual(stress.check_state(self._state("SHARED", ["a@pavilion.io", "b@pavilion.io"])), [])
+
+    def test_violations(self):
+        self.assertEqual(stress.check_state('{"Type": "FREE", "Own'), ["corrupt lock file"])
+        self.assertEqual(stress.check_state(self._state("EXCLUSIVE", ["a@pavilion.io", "b@pavilion.io"])),
+                         ["2 exclusive owners"])
+        self.assertEqual(stress.check_state(self._state("FREE", ["a@pavilion.io"])), ["free lock with owners"])
+        self.assertEqual(stress.check_state(self._state("SHARED", ["a@pavilion.io", "a@pavilion.io"])),
+                         ["duplicate owners"])
+
+
+class CheckSheetTest(unittest.TestCase):
+    def test_sheet_rows(self):
+        text = json.dumps({"Type": "SHARED", "Owners": [{"Name": "x", "Email": "a@pavilion.io"}],
+                           "Waiters": [{"Name": "y", "Email": "b@pavilion.io"}]})
+        header = ["Name", "IP", "Lock", "Owners", "Waiters"]
+        row = [stress.chassis_name, stress.chassis_ip, "SHARED", "a@pavilion.io", "b@pavilion.io"]
+
+        self.assertEqual(stress.check_sheet(text, [header, row]), [])
+        self.assertEqual(stress.check_sheet(text, [header]), ["0 sheet rows for the chassis"])
+        self.assertEqual(stress.check_sheet(text, [header, row[:3]]),
+                         [f"sheet shows {row[:3]!s}, lock file {row!s}"])
+
+
+class StressRunTest(unittest.TestCase):
+    def test_small_run(self):
+        result = stress.StressRun(users=3, ops=3, seed=7).run()
+
+        self.assertEqual(result["ops"], 9)
+        self.assertEqual(result["violations"], [])
+        self.assertEqual(sum(len(samples) for samples in result["latencies"].values()), 9)
+
+
+if __name__ == "__main__":
+    runner = unittest.main()
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+"""
+******************************
+******* Macros ***************
+******************************
+"""
+# Where every command appends its timing record, set from the [Timing]
+# section of the chassis config. None keeps the records in memory only.
+log_file = None
+
+_local = threading.local()
+
+"""
+******************************
+******* Spans ****************
+******************************
+"""
+
+
+def start():
+    # Spans are only recorded between start and finish, and only on the
+    # thread that called start. Everywhere else span costs one lookup.
+    _local.spans = []
+    _local.depth = 0
+    _local.start = time.perf_counter()
+
+
+@contextmanager
+def span(name):
+    spans = getattr(_local, "spans", None)
+
+    if spans is None:
+        yield
+        return
+
+    record = [name, _local.depth, 0.0]
+    spans.append(record)
+    _local.depth += 1
+    begin = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record[2] = time.perf_counter() - begin
+        _local.depth -= 1
+
+
+def set_log_file(path):
+    global log_file
+    log_file = path or None
+
+
+def configure(config):
+    # [Timing] log = /path/to/timing.jsonl
+    if 'Timing' in config:
+        set_log_file(config['Timing'].get('log'))
+
+
+def finish(command):
+    spans = getattr(_local, "spans", None)
+
+    if spans is None:
+        return None
+
+    record = {
+        "Time": str(datetime.now()),
+        "Pid": os.getpid(),
+        "Command": command,
+        "Total": round((time.perf_counter() - _local.start) * 1000, 3),
+        "Spans": [{"Name": name, "Depth": depth, "Ms": round(seconds * 1000, 3)} for name, depth, seconds in spans]
+    }
+    _local.spans = None
+
+    if log_file is not None:
+        _append_record(log_file, record)
+
+    return record
+
+
+def _append_record(path, record):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    except OSError:
+        return
+
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def print_report(record):
+    print("Profile")
+
+    for a_span in record["Spans"]:
+        label = "  " * (a_span["Depth"] + 1) + a_span["Name"]
+        print(f"{label!s:<40} {a_span['Ms']:10.2f} ms")
+
+    print(f"{'  total'!s:<40} {record['Total']:10.2f} ms")
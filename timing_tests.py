@@ -0,0 +1,88 @@
+import contextlib
+import io
+import json
+import main
+import os
+import shutil
+import tempfile
+import timing
+import unittest
+
+
+class TimingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._old_log = timing.log_file
+
+    def tearDown(self) -> None:
+        timing.finish(None)
+        timing.log_file = self._old_log
+        shutil.rmtree(self._dir)
+
+    def test_spans_nest(self):
+        timing.start()
+
+        with timing.span("outer"):
+            with timing.span("inner"):
+                pass
+
+        with timing.span("next"):
+            pass
+
+        record = timing.finish("lock")
+        self.assertEqual(record["Command"], "lock")
+        self.assertEqual([(a_span["Name"], a_span["Depth"]) for a_span in record["Spans"]],
+                         [("outer", 0), ("inner", 1), ("next", 0)])
+        self.assertGreaterEqual(record["Total"], record["Spans"][0]["Ms"])
+
+    def test_nothing_recorded_without_start(self):
+        with timing.span("ignored"):
+            pass
+
+        self.assertIsNone(timing.finish("lock"))
+
+    def test_span_closed_on_error(self):
+        timing.start()
+
+        with self.assertRaises(ValueError):
+            with timing.span("failing"):
+                raise ValueError()
+
+        with timing.span("after"):
+            pass
+
+        record = timing.finish("lock")
+        self.assertEqual([a_span["Depth"] for a_span in record["Spans"]], [0, 0])
+
+    def test_records_are_appended_to_the_log(self):
+        path = os.path.join(self._dir, "timing.jsonl")
+        timing.set_log_file(path)
+
+        for command in ["lock", "unlock"]:
+            timing.start()
+            with timing.span("lock.write"):
+                pass
+            timing.finish(command)
+
+        with open(path) as log:
+            records = [json.loads(line) for line in log]
+
+        self.assertEqual([a_record["Command"] for a_record in records], ["lock", "unlock"])
+        self.assertEqual(records[0]["Spans"][0]["Name"], "lock.write")
+
+    def test_profile_prints_breakdown(self):
+        output = io.StringIO()
+        args = main.parse_user_args(["--lock", "--profile"])
+
+        with contextlib.redirect_stdout(output):
+            code = main.run(args)
+
+        # Even a command that is turned down gets its breakdown
+        self.assertEqual(code, 1)
+        self.assertIn("Please specify the lock type", output.getvalue())
+        self.assertIn("Profile", output.getvalue())
+        self.assertIn("total", output.getvalue())
+
+
+if __name__ == "__main__":
+    runner = unittest.main()